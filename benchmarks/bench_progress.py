@@ -0,0 +1,265 @@
+"""Микробенчмарки UserProgress и отрисовки вопросов.
+
+Каждая операция измеряется на реальном банке и на синтетических банках
+из 1k, 10k и 100k вопросов. Для операции записываются время одного
+вызова (наименьшая из медиан нескольких серий), медианный пик памяти,
+выделенной за вызов (tracemalloc), и число блоков памяти, оставшихся
+занятыми после вызова (sys.getallocatedblocks).
+
+    python benchmarks/bench_progress.py --save benchmarks/baseline.json
+    python benchmarks/bench_progress.py --compare benchmarks/baseline.json
+
+При сравнении операции, ставшие медленнее или прожорливее порога
+(--threshold, по умолчанию 25%), отмечаются, а код возврата равен 1.
+Время сравнимо только между прогонами на одной машине, поэтому базовую
+линию стоит записывать там же, где проверяются изменения.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# Импорт бота не должен трогать рабочую базу сессий и засорять вывод логами
+os.environ['SESSION_DB_PATH'] = ':memory:'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import bot  # noqa: E402
+from question_bank import QuestionBank, load_question_bank  # noqa: E402
+
+SYNTHETIC_SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000}
+# Серии замеров времени: минимальное время и число повторов в серии
+TIME_SERIES = 5
+MIN_TIME = 0.05
+MIN_ROUNDS = 10
+MAX_ROUNDS = 5_000
+ALLOCATION_ROUNDS = 200
+PEAK_ROUNDS = 25
+# Рост метрики меньше этой величины считается шумом: пик памяти зависит от длины текстов выпавшего вопроса
+NOISE_FLOORS = {'time_ns': 0, 'peak_bytes': 1024, 'retained_blocks': 1}
+
+
+def make_synthetic_records(size, seed=1):
+    """Строит банк заданного размера с вариантами разной длины и 1–2 правильными ответами"""
+    rng = random.Random(seed)
+    words = ['раствор', 'повязка', 'давление', 'асептика', 'инъекция', 'пульс', 'катетер', 'дренаж']
+    records = []
+    for question_id in range(size):
+        options = [
+            f"Вариант {index + 1}: {' '.join(rng.choices(words, k=rng.randint(1, 5)))}"
+            for index in range(rng.randint(3, 6))
+        ]
+        records.append({
+            'id': question_id,
+            'question': f"Синтетический вопрос {question_id}: {' '.join(rng.choices(words, k=8))}",
+            'options': options,
+            'correct_answers': rng.sample(options, rng.randint(1, 2)),
+        })
+    return records
+
+
+def load_bank(name):
+    if name == 'real':
+        return load_question_bank(bot.QUESTION_BANK_PATH, bot.QUESTION_SOURCE_PATH)
+    return QuestionBank.from_records(make_synthetic_records(SYNTHETIC_SIZES[name]))
+
+
+def new_progress(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    return progress
+
+
+class Benchmark:
+    """Операция с подготовкой: setup() возвращает аргумент для одного вызова run()"""
+
+    def __init__(self, setup, run):
+        self.setup = setup
+        self.run = run
+
+
+def make_benchmarks(bank):
+    """Набор операций для банка"""
+    rng = random.Random(2)
+    banks = bot.BankRegistry(bank)
+    state = {'progress': new_progress(banks)}
+
+    def progress_with_question():
+        progress = state['progress']
+        if progress.is_test_complete():
+            progress = state['progress'] = new_progress(banks)
+        progress.get_current_question()
+        return progress
+
+    def fresh_draw():
+        # Следующий вопрос выбирается после ответа на текущий
+        progress = progress_with_question()
+        progress.handle_correct_answer(progress.current_question_id)
+        if progress.is_test_complete():
+            progress = state['progress'] = new_progress(banks)
+        return progress
+
+    mistakes_count = max(1, len(bank.ids) // 10)
+    mistakes_progress = new_progress(banks)
+    for question_id in rng.sample(list(bank.ids), mistakes_count):
+        mistakes_progress.mistakes[question_id] = 1
+        mistakes_progress.review_deck.add(question_id, 0)
+
+    def practice_ready():
+        mistakes_progress.mistakes_practice_mode = False
+        return mistakes_progress
+
+    def keyboard_arguments():
+        question_id = rng.choice(bank.ids)
+        options = bank.options[question_id]
+        return options, bot.choose_option_order(len(options), rng.getrandbits(32)), rng.getrandbits(len(options)), False
+
+    def text_arguments():
+        progress = progress_with_question()
+        progress.selected_mask = 1
+        return progress
+
+    return {
+        'initialize_test': Benchmark(lambda: bot.UserProgress(banks), lambda progress: progress.initialize_test()),
+        'get_current_question': Benchmark(fresh_draw, lambda progress: progress.get_current_question()),
+        'handle_correct_answer': Benchmark(
+            progress_with_question, lambda progress: progress.handle_correct_answer(progress.current_question_id)
+        ),
+        'handle_incorrect_answer': Benchmark(
+            progress_with_question, lambda progress: progress.handle_incorrect_answer(progress.current_question_id, 1)
+        ),
+        'start_mistakes_practice': Benchmark(practice_ready, lambda progress: progress.start_mistakes_practice()),
+        'create_question_keyboard': Benchmark(
+            keyboard_arguments, lambda arguments: bot.create_question_keyboard(*arguments)
+        ),
+        'format_question_text': Benchmark(
+            text_arguments, lambda progress: bot.format_question_text(progress, progress.current_question_id)
+        ),
+    }
+
+
+def measure(benchmark):
+    """Возвращает время вызова, пик памяти и число оставшихся блоков"""
+    # Время — минимум из медиан нескольких серий: так меньше влияют посторонние процессы
+    medians = []
+    rounds = 0
+    for _ in range(TIME_SERIES):
+        timings = []
+        total = 0.0
+        while (total < MIN_TIME or len(timings) < MIN_ROUNDS) and len(timings) < MAX_ROUNDS:
+            argument = benchmark.setup()
+            started = time.perf_counter_ns()
+            benchmark.run(argument)
+            elapsed = time.perf_counter_ns() - started
+            timings.append(elapsed)
+            total += elapsed / 1e9
+        medians.append(statistics.median(timings))
+        rounds += len(timings)
+
+    gc.collect()
+    gc.disable()
+    try:
+        # Результаты держатся до конца замера, чтобы их блоки тоже учитывались
+        results = []
+        retained = 0
+        for _ in range(ALLOCATION_ROUNDS):
+            argument = benchmark.setup()
+            blocks_before = sys.getallocatedblocks()
+            results.append(benchmark.run(argument))
+            retained += sys.getallocatedblocks() - blocks_before
+        retained_blocks = retained / ALLOCATION_ROUNDS
+
+        peaks = []
+        tracemalloc.start()
+        for _ in range(PEAK_ROUNDS):
+            argument = benchmark.setup()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            benchmark.run(argument)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+    finally:
+        gc.enable()
+
+    return {
+        'time_ns': int(min(medians)),
+        'rounds': rounds,
+        'peak_bytes': int(statistics.median(peaks)),
+        'retained_blocks': round(retained_blocks, 2),
+    }
+
+
+def run_suite(bank_names, operations):
+    results = {}
+    for name in bank_names:
+        # Банки строятся по одному: большие банки в памяти замедляют сборщик мусора при замерах остальных
+        bank = load_bank(name)
+        gc.collect()
+        random.seed(3)
+        benchmarks = make_benchmarks(bank)
+        results[name] = {}
+        for operation in operations or benchmarks:
+            results[name][operation] = measure(benchmarks[operation])
+            print(f"{name:>5} {operation:<26} {results[name][operation]}", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Печатает изменения относительно базовой линии; возвращает число регрессий"""
+    regressions = 0
+    for bank_name, operations in results.items():
+        for operation, current in operations.items():
+            previous = baseline.get(bank_name, {}).get(operation)
+            if previous is None:
+                continue
+            marks = []
+            for metric, noise in NOISE_FLOORS.items():
+                before, after = previous[metric], current[metric]
+                change = (after - before) / abs(before) if before else (1.0 if after > 0 else 0.0)
+                marks.append(f"{metric} {before} -> {after} ({change:+.0%})")
+                if change > threshold and after - before >= noise:
+                    marks[-1] += ' РЕГРЕССИЯ'
+                    regressions += 1
+            print(f"{bank_name:>5} {operation:<26} " + '; '.join(marks))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--banks', default='real,1k,10k,100k', help='банки через запятую: real, 1k, 10k, 100k')
+    parser.add_argument('--operations', help='операции через запятую; по умолчанию все')
+    parser.add_argument('--save', help='записать результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с результатами из JSON')
+    parser.add_argument('--threshold', type=float, default=0.25, help='допустимый рост метрики, доля')
+    args = parser.parse_args()
+
+    operations = args.operations.split(',') if args.operations else None
+    results = run_suite(args.banks.split(','), operations)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, ensure_ascii=False, indent=2)
+            baseline_file.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    elif not args.save:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
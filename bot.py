@@ -1,1151 +1,1509 @@
 import os
 import logging
+import logging.handlers
+import asyncio
+import atexit
+import contextlib
+import functools
+import heapq
+import itertools
+import json
+import multiprocessing
+import queue
 import random
 import re
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler
+from telegram.request import HTTPXRequest
+
+from metrics import MetricsRegistry
+from question_bank import load_question_bank
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Сколько записей о рядовых нажатиях в секунду попадает в лог; остальные только подсчитываются
+LOG_TAP_RATE = float(os.getenv('LOG_TAP_RATE', '5'))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладет записи в очередь без форматирования: строка собирается в потоке записи"""
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitedLogger(logging.LoggerAdapter):
+    """Пропускает не больше rate записей в секунду и сообщает, сколько пропущено.
+
+    Лишние вызовы отбрасываются до создания записи, поэтому почти ничего не стоят.
+    """
+
+    def __init__(self, logger, rate):
+        super().__init__(logger, {})
+        self.rate = rate
+        self.window_start = 0.0
+        self.passed = 0
+        self.suppressed = 0
+
+    def isEnabledFor(self, level):
+        if not self.logger.isEnabledFor(level):
+            return False
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            self.window_start = now
+            self.passed = 0
+        if self.passed >= self.rate:
+            self.suppressed += 1
+            return False
+        self.passed += 1
+        return True
+
+    def process(self, msg, kwargs):
+        if self.suppressed:
+            msg = f"{msg} [пропущено похожих записей: {self.suppressed}]"
+            self.suppressed = 0
+        return msg, kwargs
+
+
+# Запись в stderr идет в отдельном потоке, обработчики на event loop только кладут записи в очередь
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+logging.basicConfig(level=LOG_LEVEL, handlers=[DeferredQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger(__name__)
+# Рядовые события каждого нажатия; ошибки пишутся через logger без ограничений
+tap_logger = RateLimitedLogger(logger.getChild('taps'), LOG_TAP_RATE)
 
-# Получение токена из переменных окружения
+# Получение токена из переменных окружения; проверяется при запуске в main(),
+# чтобы модуль можно было импортировать в инструментах и бенчмарках
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN не установлен!")
-    exit(1)
-
-# Медицинские вопросы (полностью обновленные)
-TEST_DATA = [
-    {
-        'question': 'Общие принципы лечения вывихов',
-        'options': [
-            'Иммобилизация, санация, диета',
-            'Вправление, репозиция, санаторно-курортное лечение',
-            'Репозиция, иммобилизация, реабилитация',
-            'Вправление, фиксация, реабилитация',
-            'Операция, реабилитация, фиксация'
-        ],
-        'correct_answers': ['Вправление, фиксация, реабилитация']
-    },
-    {
-        'question': 'При гипогликемическом состоянии необходимо',
-        'options': [
-            'Напоить больного сладким чаем',
-            'Срочно ввести простой инсулин',
-            'Дать щелочное питье'
-        ],
-        'correct_answers': ['Напоить больного сладким чаем']
-    },
-    {
-        'question': 'Запах ацетона изо рта наблюдается у больного при коме',
-        'options': [
-            'Гипогликемической',
-            'Гипергликемической',
-            'Печеночной',
-            'Уремической'
-        ],
-        'correct_answers': ['Гипергликемической']
-    },
-    {
-        'question': 'Влажные кожные покровы характерны для комы',
-        'options': [
-            'Гипергликемической',
-            'Гипогликемической',
-            'Уремической',
-            'Почечной'
-        ],
-        'correct_answers': ['Гипогликемической']
-    },
-    {
-        'question': 'Заболевания, которые приводят к развитию гипергликемической комы',
-        'options': [
-            'Инфаркт миокарда',
-            'Вирусный гепатит',
-            'Мочекаменная болезнь',
-            'Сахарный диабет',
-            'Аспирационная пневмония'
-        ],
-        'correct_answers': ['Сахарный диабет']
-    },
-    {
-        'question': 'Жировая эмболия наблюдается при',
-        'options': [
-            'Эфирных судорогах',
-            'Тиреоидном кризе',
-            'Переломах длинных трубчатых костей',
-            'Переливании крови',
-            'Гемотрансфузионном шоке'
-        ],
-        'correct_answers': ['Переломах длинных трубчатых костей']
-    },
-    {
-        'question': 'При проникающем ранении глазного яблока накладывается',
-        'options': [
-            'Т-образная повязка',
-            'Крестообразная повязка на оба глаза (бинокулярная)',
-            'Praщевидная повязка'
-        ],
-        'correct_answers': ['Крестообразная повязка на оба глаза (бинокулярная)']
-    },
-    {
-        'question': 'Инородное тело, воткнувшееся в глазное яблоко, удалять',
-        'options': [
-            'Можно',
-            'Нельзя'
-        ],
-        'correct_answers': ['Нельзя']
-    },
-    {
-        'question': 'При отравлении метиловым спиртом антидотом является',
-        'options': [
-            'Этиловый спирт 70%',
-            'Атропин',
-            'Унитиол',
-            'Тиосульфат натрия'
-        ],
-        'correct_answers': ['Этиловый спирт 70%']
-    },
-    {
-        'question': 'Гематома-это скопление крови',
-        'options': [
-            'В плевральной полости',
-            'В полости сустава',
-            'В брюшной полости',
-            'Пропитывание тканей кровью',
-            'Ограниченное тканями'
-        ],
-        'correct_answers': ['Ограниченное тканями']
-    },
-    {
-        'question': 'При правильном наложения венозных жгутов пульс на периферических сосудах',
-        'options': [
-            'сохраняется',
-            'исчезает'
-        ],
-        'correct_answers': ['исчезает']
-    },
-    {
-        'question': 'Количество единиц антибиотика в 1 мл растворителя при разведении его для постановки внутрикожной пробы',
-        'options': [
-            '10 000 ЕД.',
-            '100 000 ЕД.',
-            '500 000 ЕД.',
-            '1 000 000 ЕД.'
-        ],
-        'correct_answers': ['100 000 ЕД.']
-    },
-    {
-        'question': 'Место постановки внутрикожной пробы',
-        'options': [
-            'Наружная поверхность бедра',
-            'Верхний наружный квадрат ягодицы',
-            'Под лопатку',
-            'Средняя треть внутренней поверхности предплечья'
-        ],
-        'correct_answers': ['Средняя треть внутренней поверхности предплечья']
-    },
-    {
-        'question': 'При взятии крови одновременно на несколько биохимических анализов необходимо исходить из расчета, что на один анализ берется',
-        'options': [
-            '1 мл крови',
-            '2 мл крови',
-            '3 мл крови',
-            '4 мл крови'
-        ],
-        'correct_answers': ['2 мл крови']
-    },
-    {
-        'question': 'Особое влияние стресс оказывает на показатели анализов',
-        'options': [
-            'Клинических',
-            'Биохимических',
-            'Бактериологических',
-            'Серологических'
-        ],
-        'correct_answers': ['Биохимических']
-    },
-    {
-        'question': 'Мокроту для бактериологического исследования необходимо собрать в',
-        'options': [
-            'Чистую банку',
-            'Стерильную банку',
-            'Карманную плевательницу',
-            'Чистую пробирку'
-        ],
-        'correct_answers': ['Стерильную банку']
-    },
-    {
-        'question': 'При учете суточного диуреза мочегонные средства отменяются за',
-        'options': [
-            '6 ч',
-            '12 ч',
-            '24 ч',
-            '8 ч'
-        ],
-        'correct_answers': ['24 ч']
-    },
-    {
-        'question': 'Целью сбора мочи по зимницкому является исследование функции почек',
-        'options': [
-            'Секреторной и выделительной',
-            'Секреторной и экскреторной',
-            'Концентрационной и выделительной'
-        ],
-        'correct_answers': ['Концентрационной и выделительной']
-    },
-    {
-        'question': 'Суточный диурез измеряется для определения',
-        'options': [
-            'Концентрационной функции',
-            'Патологических элементов в моче',
-            'Выделительной функции'
-        ],
-        'correct_answers': ['Выделительной функции']
-    },
-    {
-        'question': 'Для общего анализа мочи собирается',
-        'options': [
-            'Средняя порция мочи',
-            'Вся выделенная моча',
-            'Моча, выделенная за сутки',
-            'Первая порция'
-        ],
-        'correct_answers': ['Средняя порция мочи']
-    },
-    {
-        'question': 'При определении сахара в моче из суточного диуреза на этикетке необходимо указать',
-        'options': [
-            'Общее количество мочи, выделенное за сутки',
-            'Количество мочи, доставленное в емкости',
-            'Количество жидкости, потребляемой за сутки',
-            'Количество съеденного сахара'
-        ],
-        'correct_answers': ['Общее количество мочи, выделенное за сутки']
-    },
-    {
-        'question': 'Нормальное артериальное давление - это давление (мм рт.ст.)',
-        'options': [
-            'Меньше 120/80',
-            'Меньше 130/85',
-            'Больше 130/85',
-            'Больше 140/90'
-        ],
-        'correct_answers': ['Меньше 130/85']
-    },
-    {
-        'question': 'Плевральную пункцию проводят с целью',
-        'options': [
-            'Разъединения плевральных сращений',
-            'Отсасывание мокроты из бронхов',
-            'Уменьшение болевого синдрома',
-            'Удаление жидкости из плевральной полости'
-        ],
-        'correct_answers': ['Удаление жидкости из плевральной полости']
-    },
-    {
-        'question': 'Кратковременная потеря сознания - это',
-        'options': [
-            'Кома',
-            'Коллапс',
-            'Обморок',
-            'Сопор'
-        ],
-        'correct_answers': ['Обморок']
-    },
-    {
-        'question': 'Скопление жидкости в брюшной полости - это',
-        'options': [
-            'Анасарка',
-            'Гидроторакс',
-            'Асцит',
-            'Гидроперикардит'
-        ],
-        'correct_answers': ['Асцит']
-    },
-    {
-        'question': 'Медсестра может определить наличие отеков у пациента на ногах методом',
-        'options': [
-            'Взвешивания',
-            'Пальпации',
-            'Измерения суточного диуреза',
-            'Аускультации',
-            'Перкуссии'
-        ],
-        'correct_answers': ['Пальпации']
-    },
-    {
-        'question': 'Если пациенту впервые назначен инсулин, медсестра объясняет пациенту, что он',
-        'options': [
-            'Снижает уровень холестерина в крови',
-            'Способствует усвоению глюкозы крови клетками',
-            'Стимулирует деятельность клеток поджелудочной железы',
-            'Способствует выведению сахара из организма'
-        ],
-        'correct_answers': ['Способствует усвоению глюкозы крови клетками']
-    },
-    {
-        'question': 'Характер боли во время приступа стенокардии',
-        'options': [
-            'Ноющая',
-            'Тупая',
-            'Колющая',
-            'Сжимающая'
-        ],
-        'correct_answers': ['Сжимающая']
-    },
-    {
-        'question': 'При стенокардии боль локализуется',
-        'options': [
-            'За грудиной, в области сердца',
-            'В области сердца, в правом подреберье',
-            'В правом подреберье, в поясничной области',
-            'В поясничной области'
-        ],
-        'correct_answers': ['За грудиной, в области сердца']
-    },
-    {
-        'question': 'Приступ стенокардии купируется',
-        'options': [
-            'Настойкой валерианы',
-            'Димедролом',
-            'Нитроглицерином',
-            'Анаприлином'
-        ],
-        'correct_answers': ['Нитроглицерином']
-    },
-    {
-        'question': 'Причины бронхитов',
-        'options': [
-            'Риккетсии и простейшие',
-            'Простейшие и грибы',
-            'Грибы и бактерии',
-            'Бактерии и вирусы'
-        ],
-        'correct_answers': ['Бактерии и вирусы']
-    },
-    {
-        'question': 'Аллергены, вызывающие приступы бронхиальной астмы',
-        'options': [
-            'Домашняя пыль',
-            'Домашняя пыль и продукты пчеловодства',
-            'Домашняя пыль, продукты пчеловодства и антибиотики',
-            'Домашняя пыль, продукты пчеловодства, антибиотики и пыльца растений'
-        ],
-        'correct_answers': ['Домашняя пыль, продукты пчеловодства, антибиотики и пыльца растений']
-    },
-    {
-        'question': 'При ирригоскопии исследуемый орган -',
-        'options': [
-            'Желудок',
-            'Желчный пузырь',
-            'Толстый кишечник',
-            'Тонкий кишечник',
-            'Пищевод'
-        ],
-        'correct_answers': ['Толстый кишечник']
-    },
-    {
-        'question': 'Экг-это запись',
-        'options': [
-            'Функциональных шумов сердца',
-            'Электрических колебаний, возникающих в сердце',
-            'Ультразвуковых волн',
-            'Тонов сердца'
-        ],
-        'correct_answers': ['Электрических колебаний, возникающих в сердце']
-    },
-    {
-        'question': 'Лекарства в катетер, стоящий в центральной вене, вводят',
-        'options': [
-            'Через заглушку',
-            'Заглушку отсоединяют'
-        ],
-        'correct_answers': ['Через заглушку']
-    },
-    {
-        'question': 'Асептическая повязка вокруг катетера в центральной вене меняется не реже чем',
-        'options': [
-            '2 раза в сут',
-            '1 раз в сут',
-            'Через 2 сут',
-            'Через 3 сут'
-        ],
-        'correct_answers': ['1 раз в сут']
-    },
-    {
-        'question': 'При длительной инфузионной терапии для обеспечения и поддержания периферического венозного доступа применяется',
-        'options': [
-            'Венепункция',
-            'Венесекция',
-            'Катетеризация'
-        ],
-        'correct_answers': ['Катетеризация']
-    },
-    {
-        'question': 'Подлокотник (клеенчатая подушка) при венозном доступе используется для',
-        'options': [
-            'Стабилизации руки в местах сгиба (суставах)',
-            'Ограничения движения пациентов',
-            'Удобства пациента'
-        ],
-        'correct_answers': ['Стабилизации руки в местах сгиба (суставах)']
-    },
-    {
-        'question': 'Для обеспечения венозного наполнения конечности при венозном доступе используется',
-        'options': [
-            'Жгут',
-            'Подлокотник',
-            'Давящая повязка'
-        ],
-        'correct_answers': ['Жгут']
-    },
-    {
-        'question': 'Повторное использование колпачков и заглушек на катетере',
-        'options': [
-            'Допускается',
-            'Разрешается',
-            'Запрещается'
-        ],
-        'correct_answers': ['Запрещается']
-    },
-    {
-        'question': 'Возможные осложнения периферического венозного катетера (пвк)',
-        'options': [
-            'Флебит и тромбофлебит',
-            'Инфильтрация и экстравазация',
-            'Гематома, тромбоз, тромбофлебит',
-            'Инфильтрация, экстравазация, гематома, тромбоз, флебит, тромбофлебит'
-        ],
-        'correct_answers': ['Инфильтрация, экстравазация, гематома, тромбоз, флебит, тромбофлебит']
-    },
-    {
-        'question': 'Профилактические мероприятия в лпо проводятся исходя из положения, что каждый пациент расценивается как потенциальный источник',
-        'options': [
-            'Гемоконтактных инфекций (гепатит В, С, ВИЧ)',
-            'Педикулеза',
-            'Кишечных инфекций',
-            'Туберкулеза',
-            'Венерических болезней'
-        ],
-        'correct_answers': ['Гемоконтактных инфекций (гепатит В, С, ВИЧ)']
-    },
-    {
-        'question': 'Все пациенты на догоспитальном этапе подлежат профилактическому обследованию на',
-        'options': [
-            'Туберкулез (флюорография)',
-            'Маркеры гепатитов В и С, сифилис',
-            'Дифтерию и кишечные инфекции',
-            'Кишечные инфекции',
-            'Стафилококк'
-        ],
-        'correct_answers': ['Туберкулез (флюорография)']
-    },
-    {
-        'question': 'В случае оперативного лечения пациенты на догоспитальном этапе подлежат профилактическому обследованию на',
-        'options': [
-            'Туберкулез (флюорография)',
-            'Маркеры гепатитов В и С, сифилис',
-            'Дифтерию и кишечные инфекции',
-            'Стафилококк',
-            'Кишечные инфекции'
-        ],
-        'correct_answers': ['Маркеры гепатитов В и С, сифилис', 'Туберкулез (флюорография)']
-    },
-    {
-        'question': 'Пациенты с инфекцией, вызванной резистентными золотистым стафилококком или энтерококком, изоляции в боксированные палаты',
-        'options': [
-            'Подлежат',
-            'Не подлежат'
-        ],
-        'correct_answers': ['Подлежат']
-    },
-    {
-        'question': 'Периодический инструктаж персонала, осуществляющего уборку, по санэпидрежиму и технике безопасности проводится не реже чем',
-        'options': [
-            'Ежемесячно',
-            'Ежеквартально',
-            '2 раза в год',
-            '1 раз в год'
-        ],
-        'correct_answers': ['2 раза в год']
-    },
-    {
-        'question': 'Как называется процесс обработки мед. отходов класс Б.В',
-        'options': [
-            'Утилизация',
-            'Дезинфекция',
-            'Обеззараживание',
-            'Замачивание'
-        ],
-        'correct_answers': ['Дезинфекция']
-    },
-    {
-        'question': 'Генеральная уборка помещений палатных отделений и кабинетов проводится по графику, но не реже',
-        'options': [
-            'раз в 3 дня',
-            '1 раз в неделю',
-            '1 раз в 10 дней',
-            'раз в месяц',
-            '1 раз в 20 дней'
-        ],
-        'correct_answers': ['раз в месяц']
-    },
-    {
-        'question': 'Частота проведения генеральной уборки в помещениях с асептическим режимом',
-        'options': [
-            '1 раз в 3 дня',
-            '1 раз в неделю',
-            '1 раз в 10 дней',
-            '1 раз в месяц',
-            '1 раз в 20дней'
-        ],
-        'correct_answers': ['1 раз в неделю']
-    },
-    {
-        'question': 'Генеральная уборка помещений палатных отделений должна проводиться с обработкой',
-        'options': [
-            'оконных стекол и стен',
-            'стен, потолка, оконных стекол',
-            'дверей, стен, оборудования, мебели и полов',
-            'стен, полов, оборудования, инвентаря',
-            'стен, полов, окон, дверей, мебели, оборудования, инвентаря, светильников'
-        ],
-        'correct_answers': ['стен, полов, окон, дверей, мебели, оборудования, инвентаря, светильников']
-    },
-    {
-        'question': 'Обеззараживание воздуха уфо в присутствии людей можно проводить, используя только',
-        'options': [
-            'Открытые облучатели',
-            'Закрытые облучатели',
-            'Рециркуляторы'
-        ],
-        'correct_answers': ['Рециркуляторы']
-    },
-    {
-        'question': 'В какой цветом собирают отходы класса Б',
-        'options': [
-            'Черный',
-            'Желтый',
-            'Красный',
-            'Белый'
-        ],
-        'correct_answers': ['Желтый']
-    },
-    {
-        'question': 'Сколько классов существует медицинских отходов в РФ',
-        'options': [
-            '6',
-            '4',
-            '5'
-        ],
-        'correct_answers': ['5']
-    },
-    {
-        'question': 'Эпидемически опасные отходы относятся к классу:',
-        'options': [
-            'Б',
-            'В'
-        ],
-        'correct_answers': ['Б']
-    },
-    {
-        'question': 'Текущая уборка процедурного кабинета проводится не менее чем',
-        'options': [
-            '1 раз в день перед началом работы',
-            '2 раза в день',
-            '3 раза в сутки'
-        ],
-        'correct_answers': ['2 раза в день']
-    },
-    {
-        'question': 'При увлажнении поверхностей помещения эффективность ультрафиолетового облучения',
-        'options': [
-            'Возрастает',
-            'Не изменяется',
-            'Снижается'
-        ],
-        'correct_answers': ['Снижается']
-    },
-    {
-        'question': 'Предметы ухода, оборудование и все, что соприкасается с неповрежденной кожей, подлежат только',
-        'options': [
-            'Дезинфекции',
-            'Предстерилизационной очистке',
-            'Стерилизации'
-        ],
-        'correct_answers': ['Дезинфекции']
-    },
-    {
-        'question': 'Метод дезинфекции манжетки для измерения давления',
-        'options': [
-            'Орошение дез раствором',
-            'Протирание 70% спиртом'
-        ],
-        'correct_answers': ['Протирание 70% спиртом']
-    },
-    {
-        'question': 'Метод дезинфекции термометра медицинского',
-        'options': [
-            'Протирание 70% спиртом',
-            'Орошение дез. средством'
-        ],
-        'correct_answers': ['Орошение дез. средством']
-    },
-    {
-        'question': 'Что Запрещено делать при обращении с медицинскими отходами:',
-        'options': [
-            'Ставить тару с мед. отходами на расстоянии 1,5 от отопительных приборов',
-            'Снимать иглу с использованных шприцов',
-            'Складывать острые инструменты в пакеты',
-            'Собирать отходы без перчаток'
-        ],
-        'correct_answers': ['Снимать иглу с использованных шприцов', 'Складывать острые инструменты в пакеты', 'Собирать отходы без перчаток']
-    },
-    {
-        'question': 'Правила обработки рук медицинского персонала и кожных покровов пациента лпо регламентируется',
-        'options': [
-            'СанПиН 2.1.3678-20',
-            'ОСТ-42-21-2-85'
-        ],
-        'correct_answers': ['СанПиН 2.1.3678-20']
-    },
-    {
-        'question': 'Цель гигиенического мытья рук медперсонала перед осмотром пациента',
-        'options': [
-            'Обеспечение кратковременной стерильности',
-            'Создание продолжительной стерильности',
-            'Профилактика профессионального заражения',
-            'Удаление транзиторной микрофлоры'
-        ],
-        'correct_answers': ['Удаление транзиторной микрофлоры']
-    },
-    {
-        'question': 'Цель гигиенической обработки рук медперсонала кожным антисептиком',
-        'options': [
-            'Снижение количества микроорганизмов',
-            'Создание продолжительной стерильности',
-            'Профилактика профессионального заражения',
-            'Удаление бытового загрязнения'
-        ],
-        'correct_answers': ['Снижение количества микроорганизмов']
-    },
-    {
-        'question': 'Цель дезинфекции рук медперсонала после инфекционного контакта',
-        'options': [
-            'Обеспечение кратковременной стерильности',
-            'Создание продолжительной стерильности',
-            'Профилактика профессионального заражения',
-            'Удаление бытового загрязнения'
-        ],
-        'correct_answers': ['Профилактика профессионального заражения']
-    },
-    {
-        'question': 'Стерильные перчатки надевают',
-        'options': [
-            'Сразу после обработки рук',
-            'После полного высыхания антисептика на коже'
-        ],
-        'correct_answers': ['После полного высыхания антисептика на коже']
-    },
-    {
-        'question': 'Вид обработки рук медперсонала перед накрыванием большого стерильного стола',
-        'options': [
-            'Хирургическая',
-            'Гигиеническая с антисептиком',
-            'Гигиеническое мытье с мылом и водой'
-        ],
-        'correct_answers': ['Хирургическая']
-    },
-    {
-        'question': 'Стерильные перчатки надеваются только для выполнения процедур',
-        'options': [
-            'стерильных',
-            'Нестерильных',
-            'Любых'
-        ],
-        'correct_answers': ['стерильных']
-    },
-    {
-        'question': 'Вид перчаток при заборе крови из вены на исследования',
-        'options': [
-            'Стерильные медицинские',
-            'Чистые продезинфицированные'
-        ],
-        'correct_answers': ['Чистые продезинфицированные']
-    },
-    {
-        'question': 'После каждого пациента перчатки',
-        'options': [
-            'Необходимо менять',
-            'Протирать дезинфектантом, не меняя'
-        ],
-        'correct_answers': ['Необходимо менять']
-    },
-    {
-        'question': 'Кожа инъекционного поля протирается стерильным ватным тампоном с кожным антисептиком',
-        'options': [
-            'Однократно',
-            'Последовательно дважды',
-            'Последовательно трижды в сут',
-            'раз в сут',
-            'Через 2 сут'
-        ],
-        'correct_answers': ['Однократно']
-    },
-    {
-        'question': 'Место пункции вены обрабатывается стерильными марлевыми тампонами с кожным антисептиком',
-        'options': [
-            'Однократно',
-            'Последовательно дважды',
-            'Последовательно трижды'
-        ],
-        'correct_answers': ['Последовательно дважды']
-    },
-    {
-        'question': 'Бактерицидные камеры, оснащенные ультрафиолетовыми лампами, допускаются к применению только',
-        'options': [
-            'для хранения стерильных инструментов',
-            'для стерилизации',
-            'Для дезинфекции'
-        ],
-        'correct_answers': ['для хранения стерильных инструментов']
-    },
-    {
-        'question': 'Самым распространненым резервуаром возбудителей на теле человека являются',
-        'options': [
-            'Мочевыводящие пути',
-            'руки',
-            'кровь',
-            'кишечник'
-        ],
-        'correct_answers': ['руки']
-    },
-    {
-        'question': 'Стерильный пинцет в процессе работы со стерильным материалом должен храниться',
-        'options': [
-            'В сухом виде в стерильной упаковке',
-            'В спиртовом растворе'
-        ],
-        'correct_answers': ['В сухом виде в стерильной упаковке']
-    },
-    {
-        'question': 'Требования к правилам личной гигиены пациентов в лпо регламентируются',
-        'options': [
-            'СанПиН 3.3686-21',
-            'Инструкциями ЛПО',
-            'Санитарным минимумом',
-            'Правилами внутреннего распорядка'
-        ],
-        'correct_answers': ['СанПиН 3.3686-21']
-    },
-    {
-        'question': 'При использовании одноразовых контейнеров для острого инструментария допускается их заполнение в течении:',
-        'options': [
-            '72 часа',
-            '24 часа'
-        ],
-        'correct_answers': ['72 часа']
-    },
-    {
-        'question': 'Герметизация одноразовых пакетов для сбора отходов класс Б в местах их образования осуществляется после заполнения пакета на :',
-        'options': [
-            '1/3',
-            '1/2',
-            '3/4',
-            '2/3'
-        ],
-        'correct_answers': ['3/4']
-    },
-    {
-        'question': 'К работе с мед. отходами допускаются лица',
-        'options': [
-            'старше 20 лет',
-            'старше 16 лет',
-            'Старше 18 лет',
-            'Неограниченный возраст'
-        ],
-        'correct_answers': ['Старше 18 лет']
-    },
-    {
-        'question': 'Количество сердечных сокращений в одну минуту у взрослого в норме:',
-        'options': [
-            '100-120',
-            '90-100',
-            '60-80',
-            '40-60'
-        ],
-        'correct_answers': ['60-80']
-    },
-    {
-        'question': 'По наполнению пульс различают',
-        'options': [
-            'Ритмичный, аритмичный',
-            'Скорый, медленный',
-            'Полный, нитевидный',
-            'Твердый, мягкий'
-        ],
-        'correct_answers': ['Полный, нитевидный']
-    },
-    {
-        'question': 'Время подсчета пульса при аритмии (в секундах)',
-        'options': [
-            '60',
-            '45',
-            '30',
-            '15'
-        ],
-        'correct_answers': ['60']
-    },
-    {
-        'question': 'В норме частота пульса у взрослого человека',
-        'options': [
-            '60-80 уд/мин',
-            '80-90 уд/мин',
-            '60-70 уд/мин',
-            '70-90 уд/мин'
-        ],
-        'correct_answers': ['60-80 уд/мин']
-    },
-    {
-        'question': 'Медсестра рекомендует пациенту использовать карманный ингалятор при',
-        'options': [
-            'Кровохаркании',
-            'Удушье',
-            'Сухом упорном кашле',
-            'Болях в грудной клетке'
-        ],
-        'correct_answers': ['Удушье']
-    },
-    {
-        'question': 'Бронхоэктатическая болезнь - это',
-        'options': [
-            'Острое гнойное заболевание легких',
-            'Хроническое гнойное заболевание легких',
-            'Аллергическое заболевание'
-        ],
-        'correct_answers': ['Хроническое гнойное заболевание легких']
-    },
-    {
-        'question': 'Для легочного кровотечения характерно',
-        'options': [
-            'Рвотные массы цвета «кофейной гущи»',
-            'Алая пенистая кровь при кашле',
-            'Темные сгустки крови в большом количестве',
-            'Прожилки крови в мокроте'
-        ],
-        'correct_answers': ['Алая пенистая кровь при кашле']
-    },
-    {
-        'question': 'Если у пациента появилось кровохарканье, то медсестра должна применить',
-        'options': [
-            'Щелочную ингаляцию',
-            'Отвлекающую терапию',
-            'Пузырь со льдом',
-            'Дренажное положение'
-        ],
-        'correct_answers': ['Пузырь со льдом']
-    },
-    {
-        'question': 'Клинические проявления анафилактического шока',
-        'options': [
-            'Нарушение сознания',
-            'Нарушение сознания, одышка',
-            'Нарушение сознания, одышка, снижение АД',
-            'Нарушение сознания, одышка, снижение АД, боли в животе'
-        ],
-        'correct_answers': ['Нарушение сознания, одышка, снижение АД']
-    },
-    {
-        'question': 'Клинические проявления крапивницы',
-        'options': [
-            'Кожный зуд',
-            'Отек век',
-            'Сыпь на коже',
-            'Удушье'
-        ],
-        'correct_answers': ['Сыпь на коже', 'Кожный зуд']
-    },
-    {
-        'question': 'Симптомы отека Квинке',
-        'options': [
-            'Боль за грудиной',
-            'Кожный зуд',
-            'Отек губ, век, носа',
-            'Падение артериального давления'
-        ],
-        'correct_answers': ['Отек губ, век, носа']
-    },
-    {
-        'question': 'Полное уничтожение микроорганизмов и их спор на инструментарии и белье достигается при',
-        'options': [
-            'дезинфекции',
-            'педстерилизационной обработке',
-            'стерилизации'
-        ],
-        'correct_answers': ['стерилизации']
-    },
-    {
-        'question': 'При желудочном кровотечении характерен кал',
-        'options': [
-            'Жирный, мажущийся, глинистый',
-            'Черный, дегтеобразный',
-            'Светлый желтый',
-            'В виде рисового отвара'
-        ],
-        'correct_answers': ['Черный, дегтеобразный']
-    },
-    {
-        'question': 'Медсестра заподозрила желудочное кровотечение по следующему высказыванию пациента',
-        'options': [
-            '«Осенью я очень похудел»',
-            '«Сегодня утром у меня был обильный стул черного цвета»',
-            '«Последние две недели боли в животе усилились»'
-        ],
-        'correct_answers': ['«Сегодня утром у меня был обильный стул черного цвета»']
-    },
-    {
-        'question': 'Парапроктит-это',
-        'options': [
-            'Доброкачественная опухоль прямой кишки',
-            'Острое гнойное воспаление жировой клетчатки около прямой кишки',
-            'Разрастание соединительной ткани',
-            'Воспаление слизистой прямой кишки'
-        ],
-        'correct_answers': ['Острое гнойное воспаление жировой клетчатки около прямой кишки']
-    },
-    {
-        'question': 'Бинтование начинают',
-        'options': [
-            'Непосредственно от раны, каждый тур бинта накладывается на предыдущий',
-            'От центра к периферии, каждый тур бинта должен перекрывать предыдущий',
-            'От периферии к центру, каждый оборот бинта должен перекрывать предыдущий наполовину или на две трети'
-        ],
-        'correct_answers': ['От периферии к центру, каждый оборот бинта должен перекрывать предыдущий наполовину или на две трети']
-    },
-    {
-        'question': 'Пострадавшему с ранением головы как первая медицинская помощь накладывается повязка',
-        'options': [
-            'Уздечка',
-            'Чепец',
-            'Косыночная',
-            'Дезо'
-        ],
-        'correct_answers': ['Чепец']
-    },
-    {
-        'question': 'Название повязки на области коленного сустава',
-        'options': [
-            'Спиральная',
-            'Черепашья',
-            'Циркулярная',
-            'Ползучая'
-        ],
-        'correct_answers': ['Черепашья']
-    },
-    {
-        'question': 'При переломе нижней челюсти следует наложить',
-        'options': [
-            'Чепец',
-            'Уздечку',
-            'Praщевидную',
-            'Крестообразную'
-        ],
-        'correct_answers': ['Praщевидную']
-    },
-    {
-        'question': 'Типовая повязка - это повязка, которая накладывается',
-        'options': [
-            'В местах, типичных для различных травм и заболевании',
-            'Из стандартных перевязочных материалов',
-            'В различных областях тела одинаковыми турами бинта'
-        ],
-        'correct_answers': ['Из стандартных перевязочных материалов']
-    },
-    {
-        'question': 'Этиловый спирт антимикробным, дубящим и обезжиривающим действием',
-        'options': [
-            'Обладает',
-            'Нет, не обладает'
-        ],
-        'correct_answers': ['Обладает']
-    },
-    {
-        'question': 'Дренирование гнойной раны тампоном с гипертоническим раствором - это вид антисептики',
-        'options': [
-            'Химический',
-            'Биологический',
-            'Физический'
-        ],
-        'correct_answers': ['Физический']
-    }
-]
 
-# Хранение данных пользователей
-user_data = {}
+# Несколько ботов в одном процессе: JSON-файл со списком ботов (см. load_bot_configs);
+# без него запускается один бот с настройками из переменных окружения
+BOTS_CONFIG = os.getenv('BOTS_CONFIG')
+BOT_NAME = os.getenv('BOT_NAME', 'bot')  # Имя бота в метриках и логах
+# Размер общего пула HTTP-соединений ботов процесса
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '256'))
+
+# Адрес Bot API; переопределяется для локального Bot API сервера или тестового стенда
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес сервиса, без пути
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Максимум одновременно обрабатываемых обновлений (разных пользователей)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+
+# Окно, в течение которого несколько нажатий на варианты ответа
+# отображаются одним редактированием сообщения; 0 — без задержки
+ANSWER_DEBOUNCE_SECONDS = float(os.getenv('ANSWER_DEBOUNCE_SECONDS', '0.3'))
+
+# Кеш готовых клавиатур вопросов
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '20000'))
+RENDER_CACHE_PREWARM = os.getenv('RENDER_CACHE_PREWARM', '0') == '1'
+
+# Исходящие запросы к Bot API: лимиты, повторы и предохранитель
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # запросов в секунду на бота
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # запросов в секунду в один чат
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+OUTBOUND_BREAKER_THRESHOLD = int(os.getenv('OUTBOUND_BREAKER_THRESHOLD', '5'))
+OUTBOUND_BREAKER_COOLDOWN = float(os.getenv('OUTBOUND_BREAKER_COOLDOWN', '30'))
+
+# Хранилище сессий пользователей
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '5'))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+
+# Банк вопросов: исходник и скомпилированный файл (python question_bank.py compile ...)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTION_SOURCE_PATH = os.getenv('QUESTION_SOURCE_PATH', os.path.join(BASE_DIR, 'questions.json'))
+QUESTION_BANK_PATH = os.getenv('QUESTION_BANK_PATH', os.path.join(BASE_DIR, 'questions.bank'))
+# Период проверки файлов банка на изменения в секундах; 0 — только по команде /reload_bank
+BANK_WATCH_INTERVAL = float(os.getenv('BANK_WATCH_INTERVAL', '0'))
+
+# Число процессов-обработчиков; при WORKERS > 1 основной процесс только получает обновления
+# и раздает их обработчикам по id пользователя, а сессии хранятся в общем SESSION_DB_PATH.
+# Метрики обработчика i отдаются на METRICS_PORT + i, метрики раздачи — на METRICS_PORT + WORKERS
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Упавший обработчик перезапускается; если он падает чаще WORKER_MAX_RESTARTS раз
+# за WORKER_RESTART_WINDOW секунд, его обновления отбрасываются до перезапуска бота
+WORKER_MAX_RESTARTS = int(os.getenv('WORKER_MAX_RESTARTS', '5'))
+WORKER_RESTART_WINDOW = float(os.getenv('WORKER_RESTART_WINDOW', '60'))
+
+# Эндпоинт метрик в формате Prometheus; 0 — выключен
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Число ошибок на одной странице просмотра ошибок; не больше 50, чтобы каждой
+# ошибке на странице оставалось хотя бы ~80 символов из лимита сообщения
+MISTAKES_PAGE_SIZE = min(50, max(1, int(os.getenv('MISTAKES_PAGE_SIZE', '10'))))
+
+# Число вопросов в билете теста; 0 — весь банк
+EXAM_SIZE = int(os.getenv('EXAM_SIZE', '0'))
+
+# Интервалы повторения ошибок по ящикам Лейтнера в секундах; после последнего вопрос считается выученным
+REVIEW_INTERVALS = tuple(
+    float(interval) for interval in os.getenv('REVIEW_INTERVALS', '86400,259200,604800,1209600').split(',')
+)
+
+# Пользователи с доступом к служебным командам
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
 
+# Для вопросов с небольшим числом вариантов все перестановки строятся заранее,
+# чтобы показ вопроса не создавал новых кортежей
+MAX_PRECOMPUTED_PERMUTATION_SIZE = 6
+
+
+@functools.lru_cache(maxsize=None)
+def get_option_permutations(size):
+    """Возвращает все перестановки индексов вариантов ответа"""
+    return tuple(itertools.permutations(range(size)))
+
+
+def choose_option_order(size, key):
+    """Выбирает порядок показа вариантов ответа, однозначно заданный ключом"""
+    if size <= MAX_PRECOMPUTED_PERMUTATION_SIZE:
+        permutations = get_option_permutations(size)
+        return permutations[key % len(permutations)]
+    return tuple(random.Random(key).sample(range(size), size))
+
+
+def mix32(value):
+    """Перемешивает биты 32-битного числа; результат одинаков во всех процессах"""
+    value &= 0xFFFFFFFF
+    value = ((value >> 16) ^ value) * 0x45D9F3B & 0xFFFFFFFF
+    value = ((value >> 16) ^ value) * 0x45D9F3B & 0xFFFFFFFF
+    return (value >> 16) ^ value
+
+
+class SeededPermutation:
+    """Псевдослучайная перестановка чисел 0..size-1, вычисляемая поэлементно.
+
+    Четырехраундовая несбалансированная сеть Фейстеля переставляет числа
+    из bit_length(size - 1) бит, а значения за пределами size прогоняются
+    через сеть повторно, пока не попадут в диапазон (в среднем меньше двух
+    раз). Перестановка целиком задается seed и номером потока и в памяти не
+    хранится.
+    """
+
+    __slots__ = ('size', 'high_bits', 'low_bits', 'keys')
+
+    ROUNDS = 4
+
+    def __init__(self, size, seed, stream):
+        bits = max(2, (size - 1).bit_length())
+        self.size = size
+        self.high_bits = bits // 2
+        self.low_bits = bits - self.high_bits
+        self.keys = tuple(
+            mix32(seed ^ mix32(stream * self.ROUNDS + round_index)) for round_index in range(self.ROUNDS)
+        )
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        high_bits, low_bits = self.high_bits, self.low_bits
+        high_mask, low_mask = (1 << high_bits) - 1, (1 << low_bits) - 1
+        value = index
+        while True:
+            for key in self.keys:
+                # Младшие биты уходят наверх, старшие смешиваются с ними и уходят вниз
+                low = value & low_mask
+                value = (low << high_bits) | ((value >> low_bits) ^ mix32(low ^ key)) & high_mask
+                high_bits, low_bits = low_bits, high_bits
+                high_mask, low_mask = low_mask, high_mask
+            if value < self.size:
+                return value
+
+
+# Загруженные банки всех ботов процесса по версии: одинаковые банки разных
+# ботов хранятся в памяти один раз и делят декодированные вопросы. Ссылки
+# слабые: банк освобождается, когда его не держат ни боты, ни сессии
+shared_banks = weakref.WeakValueDictionary()
+
+
+def share_bank(bank):
+    """Возвращает уже загруженный банк той же версии, если он есть"""
+    shared = shared_banks.setdefault(bank.version, bank)
+    if shared is not bank:
+        logger.info("Банк вопросов %s уже загружен, используется общий экземпляр", bank.version)
+    return shared
+
+
+class BankRegistry:
+    """Версии банка вопросов одного бота.
+
+    Текущая версия используется для новых тестов; начатые сессии продолжают
+    работать с той версией, с которой начинались. Прежние версии хранятся,
+    пока на них ссылаются сессии в памяти (см. SessionStore.release_unused_banks).
+    """
+
+    def __init__(self, bank, bank_path=None, source_path=None):
+        self.bank_path = bank_path
+        self.source_path = source_path
+        self.current = bank
+        self.versions = {bank.version: bank}
+        self._covered = {}  # (версия id, версия банка) -> есть ли в банке все id этой версии
+
+    @classmethod
+    def load(cls, bank_path, source_path):
+        return cls(share_bank(load_question_bank(bank_path, source_path)), bank_path, source_path)
+
+    def release(self, in_use):
+        """Забывает прежние версии, которых нет в in_use; возвращает их список"""
+        released = [
+            version for version in self.versions if version != self.current.version and version not in in_use
+        ]
+        for version in released:
+            del self.versions[version]
+        return released
+
+    def covers(self, bank, version, ids):
+        """Проверяет, что в bank есть все вопросы ids версии version"""
+        key = (version, bank.version)
+        covered = self._covered.get(key)
+        if covered is None:
+            covered = self._covered[key] = all(question_id in bank for question_id in ids)
+        return covered
+
+
+class ReviewDeck:
+    """Колода интервального повторения ошибок по системе Лейтнера.
+
+    Для каждого вопроса хранятся номер ящика и время следующего повторения,
+    очередь повторений — min-куча (время, id). Ошибка возвращает вопрос в
+    нулевой ящик к немедленному повторению, правильный ответ переносит его в
+    следующий ящик и откладывает на REVIEW_INTERVALS[ящик]; после последнего
+    ящика вопрос удаляется из колоды. Записи кучи с устаревшим временем
+    пропускаются при выборе и вычищаются перестроением кучи.
+    """
+
+    __slots__ = ('cards', 'heap')
 
-class UserProgress:
     def __init__(self):
-        self.current_question_index = 0
+        self.cards = {}  # id вопроса -> (ящик, время повторения)
+        self.heap = []
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, question_id):
+        return question_id in self.cards
+
+    def _schedule(self, question_id, box, due):
+        self.cards[question_id] = (box, due)
+        heapq.heappush(self.heap, (due, question_id))
+        if len(self.heap) > 2 * len(self.cards) + 16:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [(due, question_id) for question_id, (_, due) in self.cards.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, question_id, now):
+        """Ставит вопрос с ошибкой в нулевой ящик к немедленному повторению"""
+        self._schedule(question_id, 0, now)
+
+    def next_due(self, now):
+        """Возвращает id вопроса, повторение которого наступило раньше всех, или None"""
+        heap = self.heap
+        while heap:
+            due, question_id = heap[0]
+            card = self.cards.get(question_id)
+            if card is not None and card[1] == due:
+                return question_id if due <= now else None
+            heapq.heappop(heap)
+        return None
+
+    def due_count(self, now):
+        """Возвращает число вопросов, которые пора повторить"""
+        return sum(1 for _, due in self.cards.values() if due <= now)
+
+    def review(self, question_id, correct, now):
+        """Учитывает ответ на вопрос колоды; возвращает True, если вопрос выучен"""
+        box = self.cards[question_id][0]
+        if not correct:
+            self._schedule(question_id, 0, now)
+            return False
+        if box >= len(REVIEW_INTERVALS):
+            del self.cards[question_id]
+            return True
+        self._schedule(question_id, box + 1, now + REVIEW_INTERVALS[box])
+        return False
+
+    def restrict(self, keep):
+        """Оставляет в колоде только вопросы, для которых keep(id) истинно"""
+        self.cards = {question_id: card for question_id, card in self.cards.items() if keep(question_id)}
+        self._rebuild()
+
+    def to_state(self):
+        """Возвращает состояние колоды для сохранения: [id, ящик, время] на вопрос"""
+        return [[question_id, box, due] for question_id, (box, due) in self.cards.items()]
+
+    @classmethod
+    def from_state(cls, state):
+        """Восстанавливает колоду из сохраненного состояния"""
+        deck = cls()
+        deck.cards = {question_id: (box, due) for question_id, box, due in state}
+        deck._rebuild()
+        return deck
+
+
+def write_varint(buffer, value):
+    """Дописывает неотрицательное число в буфер в формате varint (LEB128)"""
+    while value >= 0x80:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, offset):
+    """Читает число varint; возвращает (значение, смещение после него)"""
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+# Компактный формат сессии: формат, версия банка (8 байт), флаги, затем поля varint;
+# время повторения ошибок хранится в миллисекундах, чтобы не терялся порядок ошибок одной секунды.
+# Формат 2 отличается только отсутствием списка ошибок, исправленных в текущем проходе
+SESSION_FORMAT = 3
+SESSION_HEADER = struct.Struct('<B8sB')
+SESSION_FLAG_PRACTICE = 1
+SESSION_FLAG_CURRENT = 2
+SESSION_FLAG_TICKET = 4  # За заголовком версия банка (8 байт), по которой выбран билет
+
+
+class UserProgress:
+    """Прогресс пользователя.
+
+    Билет теста не хранится списком: вопросы билета, их порядок в каждом
+    проходе и порядок вариантов восстанавливаются из seed. Первый проход
+    идет по билету, следующие — по еще не исправленным ошибкам этого теста,
+    каждый раз в новом порядке. Состояние теста — seed, номер прохода,
+    позиция в нем, битовая маска исправленных ошибок и ошибки, исправленные
+    в текущем проходе. Список ошибок прохода строится один раз при его
+    начале и сокращается от прохода к проходу, поэтому выбор вопроса не
+    зависит от числа уже исправленных ошибок.
+
+    Позиции билета указывают в список id той версии банка, на которой он
+    выбран. Если сессия переходит на другую версию, в которой есть все
+    вопросы билета, она сохраняет этот список и продолжает тест.
+    """
+
+    def __init__(self, banks):
+        self.banks = banks  # Версии банка вопросов бота
+        self.bank = banks.current  # Версия банка, с которой работает сессия
+        self.seed = 0  # Задает билет, порядок вопросов и порядок вариантов
+        self.ticket_size = 0
+        self.ticket_version = None  # Версия банка билета, если она не совпадает с bank
+        self.ticket_ids = None  # id вопросов версии ticket_version
+        self.pass_number = 0  # 0 — проход по билету, дальше — повторы ошибок
+        self.cursor = 0  # Позиция в порядке текущего прохода
+        self.fixed = bytearray()  # Бит i установлен, если i-я ошибка теста исправлена при повторе
+        self.pass_fixed = []  # Номера ошибок, исправленных в текущем проходе повторов
+        self.draws = 0  # Сколько вопросов выбрано; от этого зависит порядок вариантов
         self.score = 0
-        self.mistakes = []
-        self.shuffled_questions = []
-        self.pending_questions = []
-        self.answered_correctly = set()
+        self.mistakes = {}  # id вопроса -> маска ответа пользователя, в порядке появления ошибок
         self.current_attempts = 0
         self.mistakes_practice_mode = False
-        self.mistakes_to_practice = []
-        self.selected_answers = []
-        self.current_question_data = None
-        self.current_shuffled_options = []
-        self.option_to_index_map = {}  # Маппинг текста ответа на индекс
+        self.review_deck = ReviewDeck()  # Ошибки всех тестов для интервального повторения
+        self.practice_total = 0  # Вопросов к повторению на начало отработки
+        self.practice_done = 0
+        self.selected_mask = 0  # Бит i установлен, если выбран вариант options[i]
+        self.current_slot = None  # Номер ошибки, если текущий вопрос из прохода повторов
+        self.current_question_id = None
+        self.option_order = ()  # Порядок показа вариантов: индексы в options
+        self.dirty = False  # Есть изменения, еще не записанные в хранилище
+        self.last_render = None  # (id сообщения, хеш текста, хеш клавиатуры) последнего показа
+        self._ticket = None  # Перестановки и списки повторов, вычисляемые по seed
+        self._order = None
+        self._retry_ids = None
+        self._pass_slots = None
 
     def initialize_test(self):
         """Инициализирует тест с нуля"""
         logger.info("Инициализация нового теста")
-        self.shuffled_questions = TEST_DATA.copy()
-        random.shuffle(self.shuffled_questions)
-        self.pending_questions = self.shuffled_questions.copy()
-        self.answered_correctly.clear()
-        self.current_question_index = 0
+        current = self.banks.current
+        if self.bank is not current:
+            self.review_deck.restrict(current.__contains__)
+        self.bank = current
+        self.start_ticket()
         self.score = 0
         self.mistakes.clear()
         self.current_attempts = 0
         self.mistakes_practice_mode = False
-        self.mistakes_to_practice.clear()
-        self.selected_answers.clear()
-        self.current_question_data = None
-        self.current_shuffled_options.clear()
-        self.option_to_index_map.clear()
-        logger.info(f"Тест инициализирован с {len(self.shuffled_questions)} вопросами")
-
-    def shuffle_options(self, question_data):
-        """Перемешивает варианты ответов для вопроса"""
-        options = question_data['options'].copy()
-        random.shuffle(options)
-        return options
-
-    def get_current_question(self):
-        """Получает текущий вопрос"""
-        if self.mistakes_practice_mode:
-            if not self.mistakes_to_practice:
-                return None
-            if self.current_question_index >= len(self.mistakes_to_practice):
-                self.current_question_index = 0
-                random.shuffle(self.mistakes_to_practice)
-            return self.mistakes_to_practice[self.current_question_index]
+        self.practice_total = 0
+        self.practice_done = 0
+        self.selected_mask = 0
+        self.release_current_question()
+        logger.info("Тест инициализирован с %d вопросами", self.ticket_size)
+
+    def start_ticket(self):
+        """Выбирает новый билет: EXAM_SIZE вопросов банка или весь банк"""
+        bank_size = len(self.bank.ids)
+        self.ticket_version = self.ticket_ids = None
+        self.seed = random.getrandbits(32)
+        self.ticket_size = EXAM_SIZE if 0 < EXAM_SIZE < bank_size else bank_size
+        self.pass_number = 0
+        self.cursor = 0
+        self.fixed = bytearray()
+        self.pass_fixed = []
+        self.draws = 0
+        self._ticket = self._order = self._retry_ids = self._pass_slots = None
+        self.dirty = True
+
+    def get_ticket_question(self, position):
+        """Возвращает id вопроса на позиции билета"""
+        ids = self.bank.ids if self.ticket_ids is None else self.ticket_ids
+        if self.ticket_size == len(ids):
+            return ids[position]
+        # Первые ticket_size элементов перестановки банка — выборка без повторов
+        if self._ticket is None:
+            self._ticket = SeededPermutation(len(ids), self.seed, 0)
+        return ids[self._ticket[position]]
+
+    def keep_ticket(self, version, ids):
+        """Оставляет билет, выбранный по списку ids версии version, если все его вопросы есть в bank"""
+        self.ticket_version, self.ticket_ids = version, ids
+        if self.ticket_size == len(ids):
+            covered = self.banks.covers(self.bank, version, ids)
+        else:
+            covered = all(self.get_ticket_question(position) in self.bank for position in range(self.ticket_size))
+        if not covered:
+            self.ticket_version = self.ticket_ids = None
+            self._ticket = None
+        return covered
+
+    def get_retry_ids(self):
+        """Возвращает ошибки теста в порядке появления для проходов повтора"""
+        if self._retry_ids is None:
+            self._retry_ids = list(self.mistakes)
+        return self._retry_ids
+
+    def get_pass_slots(self):
+        """Возвращает номера ошибок, не исправленных к началу текущего прохода повторов"""
+        if self._pass_slots is None:
+            # После загрузки сессии: к началу прохода не были исправлены и те, что исправлены в нем
+            fixed_in_pass = set(self.pass_fixed)
+            self._pass_slots = [
+                index for index in range(len(self.get_retry_ids()))
+                if not self.is_fixed(index) or index in fixed_in_pass
+            ]
+        return self._pass_slots
+
+    def get_pass_order(self):
+        """Возвращает порядок текущего прохода"""
+        if self._order is None:
+            size = self.ticket_size if self.pass_number == 0 else len(self.get_pass_slots())
+            self._order = SeededPermutation(size, self.seed, self.pass_number + 1)
+        return self._order
+
+    def is_fixed(self, index):
+        """Проверяет, исправлена ли ошибка с номером index"""
+        return self.fixed[index >> 3] & (1 << (index & 7))
+
+    def start_retry_pass(self):
+        """Начинает следующий проход по ошибкам, еще не исправленным к его началу"""
+        if self.pass_number == 0:
+            self.fixed = bytearray((len(self.mistakes) + 7) // 8)
+            self._pass_slots = list(range(len(self.get_retry_ids())))
         else:
-            if not self.pending_questions:
+            self._pass_slots = [index for index in self.get_pass_slots() if not self.is_fixed(index)]
+        self.pass_fixed = []
+        self.pass_number += 1
+        self.cursor = 0
+        self._order = None
+
+    def draw_test_question(self):
+        """Выбирает следующий вопрос теста; возвращает (номер ошибки или None, id) или None"""
+        passes_started = False
+        while self.score < self.ticket_size:
+            order = self.get_pass_order()
+            if self.cursor < len(order):
+                index = order[self.cursor]
+                self.cursor += 1
+                if self.pass_number == 0:
+                    return None, self.get_ticket_question(index)
+                slot = self.get_pass_slots()[index]
+                return slot, self.get_retry_ids()[slot]
+            if passes_started:
+                # Проход без неисправленных ошибок: состояние не сходится со счетом
+                logger.error("Нет вопросов для повтора при счете %d из %d", self.score, self.ticket_size)
                 return None
-            if self.current_question_index >= len(self.pending_questions):
-                self.current_question_index = 0
-                random.shuffle(self.pending_questions)
-            return self.pending_questions[self.current_question_index]
+            self.start_retry_pass()
+            passes_started = True
+        return None
 
-    def is_answer_correct(self, selected_options, question_data):
+    def get_current_question(self):
+        """Получает id текущего вопроса, при необходимости выбирая следующий"""
+        if self.current_question_id is None:
+            if self.mistakes_practice_mode:
+                slot, question_id = None, self.review_deck.next_due(time.time())
+                if question_id is None:
+                    return None
+            else:
+                drawn = self.draw_test_question()
+                if drawn is None:
+                    return None
+                slot, question_id = drawn
+            self.current_slot = slot
+            self.current_question_id = question_id
+            self.draws += 1
+            self.option_order = self.get_option_order()
+            self.dirty = True
+        return self.current_question_id
+
+    def get_option_order(self):
+        """Порядок вариантов текущего вопроса, определяемый seed и номером выбора"""
+        size = len(self.bank.options[self.current_question_id])
+        return choose_option_order(size, mix32(self.seed ^ mix32(self.draws)))
+
+    def release_current_question(self):
+        """Сбрасывает текущий вопрос, чтобы следующим был выбран новый"""
+        self.current_slot = None
+        self.current_question_id = None
+        self.option_order = ()
+        self.dirty = True
+
+    def is_answer_correct(self, selected_mask, question_id):
         """Проверяет правильность ответа"""
-        correct_answers = set(question_data['correct_answers'])
-        selected_answers = set(selected_options)
-        return selected_answers == correct_answers
+        return selected_mask == self.bank.correct_masks[question_id]
 
-    def handle_correct_answer(self, question_data):
+    def handle_correct_answer(self, question_id):
         """Обрабатывает правильный ответ"""
-        question_text = question_data['question']
-        self.answered_correctly.add(question_text)
-
         if self.mistakes_practice_mode:
-            self.mistakes_to_practice = [q for q in self.mistakes_to_practice if q['question'] != question_text]
-            self.mistakes = [m for m in self.mistakes if m['question'] != question_text]
-        else:
-            self.pending_questions = [q for q in self.pending_questions if q['question'] != question_text]
+            self.mistakes.pop(question_id, None)
+            if question_id in self.review_deck:
+                self.review_deck.review(question_id, True, time.time())
+            self.practice_done += 1
+        elif self.current_slot is not None:
+            self.fixed[self.current_slot >> 3] |= 1 << (self.current_slot & 7)
+            self.pass_fixed.append(self.current_slot)
 
         self.score += 1
         self.current_attempts = 0
-        self.selected_answers.clear()
-
-        if not self.mistakes_practice_mode:
-            self.current_question_index += 1
+        self.selected_mask = 0
+        self.release_current_question()
 
-    def handle_incorrect_answer(self, question_data, user_answers):
+    def handle_incorrect_answer(self, question_id, selected_mask):
         """Обрабатывает неправильный ответ"""
-        question_text = question_data['question']
-
-        if not self.mistakes_practice_mode:
-            if not any(m['question'] == question_text for m in self.mistakes):
-                mistake_info = {
-                    'question': question_text,
-                    'user_answer': ", ".join(user_answers),
-                    'correct_answer': ", ".join(question_data['correct_answers']),
-                }
-                self.mistakes.append(mistake_info)
+        if self.mistakes_practice_mode:
+            if question_id in self.review_deck:
+                self.review_deck.review(question_id, False, time.time())
+        else:
+            if question_id not in self.mistakes:
+                self.mistakes[question_id] = selected_mask
+            self.review_deck.add(question_id, time.time())
 
         self.current_attempts += 1
-        self.selected_answers.clear()
-
-        if not self.mistakes_practice_mode:
-            self.current_question_index += 1
+        self.selected_mask = 0
+        self.release_current_question()
 
     def is_test_complete(self):
-        """Проверяет завершение теста"""
+        """Проверяет завершение теста или отработки"""
         if self.mistakes_practice_mode:
-            return len(self.mistakes_to_practice) == 0
-        else:
-            return len(self.pending_questions) == 0
+            return self.review_deck.next_due(time.time()) is None
+        return self.score >= self.ticket_size
+
+    def get_total_questions(self):
+        """Возвращает количество вопросов в тесте"""
+        return self.ticket_size
+
+    def get_answered_count(self):
+        """Возвращает количество правильно отвеченных вопросов теста"""
+        return self.score
+
+    def get_remaining_count(self):
+        """Возвращает количество еще не отвеченных правильно вопросов теста"""
+        return self.ticket_size - self.score
 
     def get_progress_text(self):
         """Возвращает текст прогресса"""
         if self.mistakes_practice_mode:
-            total_mistakes = len(self.mistakes) + len(self.mistakes_to_practice)
-            remaining = len(self.mistakes_to_practice)
-            return f"Отработка ошибок: {total_mistakes - remaining}/{total_mistakes}"
+            total_mistakes = max(self.practice_total, self.practice_done)
+            return f"Отработка ошибок: {self.practice_done}/{total_mistakes}"
         else:
-            total_questions = len(self.shuffled_questions)
-            answered = len(self.answered_correctly)
-            remaining = len(self.pending_questions)
+            total_questions = self.get_total_questions()
+            answered = self.get_answered_count()
+            remaining = self.get_remaining_count()
             return f"Прогресс: {answered}/{total_questions} | Осталось: {remaining}"
 
+    def has_due_reviews(self):
+        """Проверяет, есть ли ошибки, которые пора повторить"""
+        return self.review_deck.next_due(time.time()) is not None
+
     def start_mistakes_practice(self):
-        """Начинает режим отработки ошибок"""
-        if not self.mistakes:
+        """Начинает отработку ошибок, повторение которых уже наступило"""
+        practice_total = self.review_deck.due_count(time.time())
+        if not practice_total:
             logger.warning("Попытка начать отработку ошибок при их отсутствии")
             return False
 
         self.mistakes_practice_mode = True
-        self.mistakes_to_practice.clear()
-
-        for mistake in self.mistakes:
-            for original_question in TEST_DATA:
-                if original_question['question'] == mistake['question']:
-                    self.mistakes_to_practice.append(original_question.copy())
-                    break
-
-        if not self.mistakes_to_practice:
-            logger.error("Не удалось найти вопросы для отработки ошибок")
-            return False
-
-        random.shuffle(self.mistakes_to_practice)
-        self.current_question_index = 0
+        self.practice_total = practice_total
+        self.practice_done = 0
+        self.release_current_question()
         self.score = 0
         self.current_attempts = 0
-        self.selected_answers.clear()
-        logger.info(f"Начата отработка {len(self.mistakes_to_practice)} ошибок")
+        self.selected_mask = 0
+        self.dirty = True
+        logger.info("Начата отработка %d ошибок", practice_total)
         return True
 
-    def toggle_answer_selection(self, answer_text):
-        """Добавляет или удаляет ответ из выбранных"""
-        if answer_text in self.selected_answers:
-            self.selected_answers.remove(answer_text)
+    def toggle_answer_selection(self, option_index):
+        """Добавляет или удаляет вариант ответа из выбранных"""
+        self.selected_mask ^= 1 << option_index
+        self.dirty = True
+
+    def migrate_to_current_bank(self):
+        """Переносит сессию на текущую версию банка с новым билетом.
+
+        Вызывается, когда прежний билет не восстановить: неизвестен список id
+        его версии или части его вопросов больше нет. Незавершенный тест
+        начинается заново. Ошибки прошлого билета остаются в колоде
+        повторения; удаленные из банка вопросы отбрасываются.
+        """
+        current = self.bank = self.banks.current
+        self.review_deck.restrict(current.__contains__)
+        if self.mistakes_practice_mode:
+            self.mistakes = {
+                question_id: mask for question_id, mask in self.mistakes.items() if question_id in current
+            }
+        else:
+            self.mistakes.clear()
+            self.score = 0
+        self.start_ticket()
+        self.current_attempts = 0
+        self.selected_mask = 0
+        self.release_current_question()
+
+    def to_bytes(self):
+        """Сериализует прогресс для хранилища сессий"""
+        flags = SESSION_FLAG_PRACTICE if self.mistakes_practice_mode else 0
+        if self.current_question_id is not None:
+            flags |= SESSION_FLAG_CURRENT
+        if self.ticket_version is not None:
+            flags |= SESSION_FLAG_TICKET
+        data = bytearray(SESSION_HEADER.pack(SESSION_FORMAT, bytes.fromhex(self.bank.version), flags))
+        if self.ticket_version is not None:
+            data += bytes.fromhex(self.ticket_version)
+        for value in (
+            self.seed, self.ticket_size, self.pass_number, self.cursor, self.draws, self.score,
+            self.current_attempts, self.selected_mask, self.practice_total, self.practice_done,
+        ):
+            write_varint(data, value)
+        if self.current_question_id is not None:
+            write_varint(data, self.current_question_id)
+
+        write_varint(data, len(self.mistakes))
+        for question_id, mask in self.mistakes.items():
+            write_varint(data, question_id)
+            write_varint(data, mask)
+        write_varint(data, len(self.fixed))
+        data += self.fixed
+        write_varint(data, len(self.pass_fixed))
+        for index in self.pass_fixed:
+            write_varint(data, index)
+
+        write_varint(data, len(self.review_deck))
+        for question_id, (box, due) in self.review_deck.cards.items():
+            write_varint(data, question_id)
+            write_varint(data, box)
+            write_varint(data, int(due * 1000))
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data, banks, load_ids=None):
+        """Восстанавливает прогресс из хранилища.
+
+        Порядок вопросов и вариантов восстанавливается из seed. Если версия
+        банка сессии больше не загружена (например, после перезапуска),
+        сессия переходит на текущую версию. Билет при этом сохраняется, если
+        load_ids(версия) вернет список id его версии и все вопросы билета есть
+        в текущей; иначе тест начинается заново (см. migrate_to_current_bank).
+        """
+        if data[:1] == b'{':
+            return cls.from_json(data, banks)
+        session_format, version, flags = SESSION_HEADER.unpack_from(data)
+        if session_format not in (2, SESSION_FORMAT):
+            raise ValueError(f"неизвестный формат сессии {session_format}")
+
+        progress = cls(banks)
+        offset = SESSION_HEADER.size
+        ticket_version = version.hex()
+        if flags & SESSION_FLAG_TICKET:
+            ticket_version = data[offset:offset + 8].hex()
+            offset += 8
+        values = []
+        for _ in range(10):
+            value, offset = read_varint(data, offset)
+            values.append(value)
+        (
+            progress.seed, progress.ticket_size, progress.pass_number, progress.cursor, progress.draws,
+            progress.score, progress.current_attempts, progress.selected_mask,
+            progress.practice_total, progress.practice_done,
+        ) = values
+        progress.mistakes_practice_mode = bool(flags & SESSION_FLAG_PRACTICE)
+        current_question_id = None
+        if flags & SESSION_FLAG_CURRENT:
+            current_question_id, offset = read_varint(data, offset)
+
+        count, offset = read_varint(data, offset)
+        for _ in range(count):
+            question_id, offset = read_varint(data, offset)
+            progress.mistakes[question_id], offset = read_varint(data, offset)
+        size, offset = read_varint(data, offset)
+        progress.fixed = bytearray(data[offset:offset + size])
+        offset += size
+        if session_format == SESSION_FORMAT:
+            count, offset = read_varint(data, offset)
+            for _ in range(count):
+                index, offset = read_varint(data, offset)
+                progress.pass_fixed.append(index)
+        elif progress.pass_number > 0 and not progress.mistakes_practice_mode:
+            # Состав прохода повторов в формате 2 не восстановить: проход начинается заново
+            progress.cursor = 0
+            progress.selected_mask = 0
+            current_question_id = None
+
+        cards = []
+        count, offset = read_varint(data, offset)
+        for _ in range(count):
+            question_id, offset = read_varint(data, offset)
+            box, offset = read_varint(data, offset)
+            due, offset = read_varint(data, offset)
+            cards.append((question_id, box, due / 1000))
+        progress.review_deck = ReviewDeck.from_state(cards)
+
+        bank = banks.versions.get(version.hex())
+        if bank is None:
+            progress.bank = banks.current
+            progress.review_deck.restrict(banks.current.__contains__)
+            if current_question_id is not None and current_question_id not in banks.current:
+                current_question_id = None
+        else:
+            progress.bank = bank
+        if ticket_version != progress.bank.version:
+            ids = load_ids(ticket_version) if load_ids is not None else None
+            if ids is None or not progress.keep_ticket(ticket_version, ids):
+                logger.info(
+                    "Сессия версии банка %s переносится на версию %s с новым билетом",
+                    ticket_version, banks.current.version,
+                )
+                progress.migrate_to_current_bank()
+                return progress
+            if bank is None:
+                logger.info("Сессия версии банка %s продолжается на версии %s", ticket_version, banks.current.version)
+
+        if current_question_id is not None:
+            progress.current_question_id = current_question_id
+            if not progress.mistakes_practice_mode and progress.pass_number > 0:
+                progress.current_slot = progress.get_pass_slots()[progress.get_pass_order()[progress.cursor - 1]]
+            progress.option_order = progress.get_option_order()
+        return progress
+
+    @classmethod
+    def from_json(cls, data, banks):
+        """Восстанавливает сессию, сохраненную в прежнем формате JSON, с новым билетом"""
+        state = json.loads(data)
+        progress = cls(banks)
+        progress.mistakes_practice_mode = state['practice']
+        progress.score = state['score']
+        progress.mistakes = dict(state['mistakes'])
+        if 'deck' in state:
+            progress.review_deck = ReviewDeck.from_state(state['deck'])
+            progress.practice_total, progress.practice_done = state['practice_progress']
+        else:
+            for question_id in progress.mistakes:
+                progress.review_deck.add(question_id, 0)
+            progress.practice_total = len(progress.mistakes)
+        progress.migrate_to_current_bank()
+        return progress
+
+
+class SessionStore:
+    """Сессии пользователей в памяти с отложенной записью в SQLite.
+
+    Сессия загружается из базы при первом обращении пользователя. Изменения
+    не пишутся на каждое нажатие: периодический flush() сохраняет одной
+    транзакцией только измененные с прошлой записи сессии.
+
+    В памяти держится не больше max_size сессий; давно не использовавшиеся
+    и простаивающие дольше idle_ttl секунд вытесняются. Несохраненные
+    изменения вытесненной сессии остаются в сериализованном виде до
+    ближайшей записи, а сама сессия загружается снова при следующем
+    обращении пользователя.
+
+    Вместе с сессиями в базу пишется список id каждой версии банка, на
+    которую они ссылаются: по нему сессия, загруженная уже после смены
+    версии (например, после перезапуска), восстанавливает свой билет.
+    """
+
+    def __init__(self, path, banks, max_size=10000, idle_ttl=1800.0):
+        self.path = path
+        self.banks = banks
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()  # В порядке последнего обращения
+        self._last_access = {}
+        self._spilled = {}  # Сериализованные несохраненные сессии вытесненных пользователей
+        self._in_flight = {}  # Сериализованные сессии, записываемые прямо сейчас
+        self._touched = set()  # Пользователи, чьи сессии могли измениться с прошлой записи
+        self._saved_versions = set()  # Версии банка, список id которых уже записан в базу
+        self._bank_ids = {}  # Списки id выгруженных версий банка, прочитанные из базы
+        self._reader = None
+        self._writer = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {
+            'hits': 0,
+            'loads': 0,
+            'misses': 0,
+            'evicted_size': 0,
+            'evicted_idle': 0,
+            'spilled': 0,
+        }
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS bank_ids (version TEXT PRIMARY KEY, ids BLOB NOT NULL)")
+        connection.commit()
+        return connection
+
+    def get_bank_ids(self, version):
+        """Список id вопросов версии банка или None, если он неизвестен"""
+        bank = self.banks.versions.get(version)
+        if bank is not None:
+            return bank.ids
+        ids = self._bank_ids.get(version)
+        if ids is None:
+            if self._reader is None:
+                self._reader = self._connect()
+            row = self._reader.execute("SELECT ids FROM bank_ids WHERE version = ?", (version,)).fetchone()
+            if row is None:
+                return None
+            ids = self._bank_ids[version] = memoryview(row[0]).cast('I')
+        return ids
+
+    def _decode(self, user_id, data):
+        try:
+            return UserProgress.from_bytes(data, self.banks, self.get_bank_ids)
+        except (ValueError, KeyError, TypeError, IndexError, struct.error):
+            logger.exception("Не удалось загрузить сессию пользователя %s", user_id)
+            return None
+
+    def _load(self, user_id):
+        data = self._spilled.pop(user_id, None)
+        if data is not None:
+            progress = self._decode(user_id, data)
+            if progress is not None:
+                # Изменения еще не записаны в базу
+                progress.dirty = True
+            return progress
+
+        data = self._in_flight.get(user_id)
+        if data is not None:
+            return self._decode(user_id, data)
+
+        if self._reader is None:
+            self._reader = self._connect()
+        row = self._reader.execute("SELECT state FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        return self._decode(user_id, row[0])
+
+    def _remember(self, user_id, progress):
+        self._sessions[user_id] = progress
+        self._sessions.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+        self._touched.add(user_id)
+        while len(self._sessions) > self.max_size:
+            self._evict(next(iter(self._sessions)), 'evicted_size')
+
+    def _evict(self, user_id, reason):
+        progress = self._sessions.pop(user_id)
+        del self._last_access[user_id]
+        if progress.dirty:
+            self._spilled[user_id] = progress.to_bytes()
+            progress.dirty = False
+            self.stats['spilled'] += 1
+        self.stats[reason] += 1
+
+    def get(self, user_id):
+        progress = self._sessions.get(user_id)
+        if progress is not None:
+            self.stats['hits'] += 1
         else:
-            self.selected_answers.append(answer_text)
+            progress = self._load(user_id)
+            if progress is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['loads'] += 1
+        self._remember(user_id, progress)
+        return progress
+
+    def __setitem__(self, user_id, progress):
+        progress.dirty = True
+        self._spilled.pop(user_id, None)
+        self._remember(user_id, progress)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def evict_idle(self):
+        """Вытесняет сессии, простаивающие дольше idle_ttl"""
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._sessions:
+            user_id = next(iter(self._sessions))
+            if self._last_access[user_id] > deadline:
+                break
+            self._evict(user_id, 'evicted_idle')
+            evicted += 1
+        return evicted
+
+    def bank_versions_in_use(self):
+        """Версии банка, на которые ссылаются сессии в памяти, включая вытесненные и записываемые"""
+        versions = {progress.bank.version for progress in self._sessions.values()}
+        for data in itertools.chain(self._spilled.values(), self._in_flight.values()):
+            if data[:1] != b'{':
+                versions.add(SESSION_HEADER.unpack_from(data)[1].hex())
+        return versions
+
+    def release_unused_banks(self):
+        """Освобождает прежние версии банка, не нужные сессиям в памяти.
+
+        Сессии этих версий, уже записанные в базу, при загрузке переносятся на
+        текущую версию, как после перезапуска бота.
+        """
+        released = self.banks.release(self.bank_versions_in_use())
+        if released:
+            logger.info("Освобождены версии банка вопросов: %s", ', '.join(released))
+        return released
+
+    def get_stats(self):
+        """Возвращает статистику кеша сессий"""
+        return dict(self.stats, size=len(self._sessions), max_size=self.max_size, pending_spilled=len(self._spilled))
+
+    def _collect_dirty_rows(self):
+        now = time.time()
+        rows = [(user_id, data, now) for user_id, data in self._spilled.items()]
+        self._spilled.clear()
+        for user_id in self._touched:
+            progress = self._sessions.get(user_id)
+            if progress is not None and progress.dirty:
+                rows.append((user_id, progress.to_bytes(), now))
+                progress.dirty = False
+        self._touched.clear()
+        return rows
+
+    def _collect_bank_rows(self, rows):
+        """Списки id версий банка, на которые ссылаются rows и которых еще нет в базе"""
+        versions = set()
+        for _, data, _ in rows:
+            _, version, flags = SESSION_HEADER.unpack_from(data)
+            versions.add(version.hex())
+            if flags & SESSION_FLAG_TICKET:
+                versions.add(data[SESSION_HEADER.size:SESSION_HEADER.size + 8].hex())
+        bank_rows = []
+        for version in versions - self._saved_versions:
+            bank = self.banks.versions.get(version)
+            ids = bank.ids if bank is not None else self._bank_ids.get(version)
+            if ids is not None:
+                bank_rows.append((version, bytes(ids)))
+        return bank_rows
+
+    def _write_rows(self, rows, bank_rows):
+        if self._writer is None:
+            self._writer = self._connect()
+            # Первая запись процесса: забываем версии, на которые не ссылается ни одна сессия
+            with self._writer:
+                self._writer.execute(
+                    "DELETE FROM bank_ids WHERE version NOT IN ("
+                    "SELECT lower(hex(substr(state, 2, 8))) FROM sessions "
+                    "UNION SELECT lower(hex(substr(state, 11, 8))) FROM sessions)"
+                )
+        with self._writer:
+            self._writer.executemany("INSERT OR IGNORE INTO bank_ids (version, ids) VALUES (?, ?)", bank_rows)
+            self._writer.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, state, updated_at) VALUES (?, ?, ?)", rows
+            )
+
+    async def flush(self):
+        """Записывает измененные сессии одной транзакцией"""
+        async with self._flush_lock:
+            rows = self._collect_dirty_rows()
+            if not rows:
+                return 0
+            self._in_flight = {user_id: data for user_id, data, _ in rows}
+            bank_rows = self._collect_bank_rows(rows)
+            try:
+                await asyncio.to_thread(self._write_rows, rows, bank_rows)
+            except sqlite3.Error:
+                logger.exception("Ошибка записи %d сессий", len(rows))
+                for user_id, data, _ in rows:
+                    progress = self._sessions.get(user_id)
+                    if progress is not None:
+                        progress.dirty = True
+                        self._touched.add(user_id)
+                    else:
+                        self._spilled.setdefault(user_id, data)
+                return 0
+            finally:
+                self._in_flight = {}
+            self._saved_versions.update(version for version, _ in bank_rows)
+            logger.info("Сохранено сессий: %d", len(rows))
+            return len(rows)
+
+    async def run_flusher(self, interval):
+        """Периодически вытесняет простаивающие сессии и записывает измененные"""
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            if evicted:
+                logger.info("Вытеснено простаивающих сессий: %d, статистика: %s", evicted, self.get_stats())
+            await self.flush()
+            self.release_unused_banks()
+
+    def close(self):
+        for connection in (self._reader, self._writer):
+            if connection is not None:
+                connection.close()
+        self._reader = None
+        self._writer = None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с очередностью внутри пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно, а обновления
+    одного пользователя — строго по очереди, под его собственной блокировкой.
+    Блокировка удаляется, как только ее никто не держит и не ждет, поэтому
+    память под блокировки растет только с числом активных пользователей.
+    Место в общем лимите обработки обновление занимает только после того,
+    как дождалось своей очереди у пользователя.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user_id -> [блокировка, число владельцев и ожидающих]
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        """Блокировка, под которой обрабатываются обновления пользователя"""
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def active_users(self):
+        """Количество пользователей, для которых сейчас есть блокировка"""
+        return len(self._locks)
+
+    async def process_update(self, update, coroutine):
+        # Базовый класс берет семафор до do_process_update: обновления, ждущие
+        # блокировки своего пользователя, занимали бы места остальных
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        async with self.user_lock(user.id):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 
+class TokenBucket:
+    """Ведро токенов; баланс может уходить в минус, резервируя будущие слоты"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """Забирает токен и возвращает, сколько секунд ждать его появления"""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до появления целого токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def pause(self, now, seconds):
+        """Не выдает токенов ближайшие seconds секунд"""
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+# Приоритеты исходящих запросов (rate_limit_args методов бота). Массовые —
+# отложенные перерисовки, которые не двигают тест и уступают прямым ответам
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Методы, которые безопасно повторить, если ответ не был получен
+IDEMPOTENT_METHODS = frozenset({
+    'getMe', 'setWebhook', 'deleteWebhook', 'answerCallbackQuery', 'editMessageText', 'editMessageReplyMarkup',
+})
+
+# Методы, которые не расходуют лимиты на отправку сообщений
+UNLIMITED_METHODS = frozenset({'getMe', 'setWebhook', 'deleteWebhook', 'answerCallbackQuery'})
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Единая очередь исходящих запросов к Bot API.
+
+    Соблюдает общий лимит бота и лимит на каждый чат, пропуская интерактивные
+    ответы раньше массовых рассылок. На RetryAfter приостанавливает отправку
+    в чат (или всю отправку, если у запроса нет чата) на указанное время и
+    повторяет запрос; запросы вне лимитов просто повторяются после паузы.
+    Идемпотентные методы при сетевых ошибках повторяются с экспоненциальной
+    задержкой и случайным разбросом. После серии сетевых ошибок подряд
+    предохранитель размыкается: до конца паузы запросы сразу отклоняются,
+    затем один пробный запрос решает, замкнуть ли его снова. Пробный запрос,
+    завершившийся без ответа API (например, отмененный), только освобождает
+    место для следующей пробы.
+    """
+
+    def __init__(self, name, global_rate, chat_rate, chat_burst, max_retries, breaker_threshold, breaker_cooldown):
+        self.name = name  # Имя бота в метриках
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._chat_buckets = {}
+        self._waiters = []  # (приоритет, номер, future) ожидающих общего лимита
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._consecutive_failures = 0
+        self._breaker_open_until = 0.0
+        self._probe = None  # Метка запроса, который сейчас идет пробным
+        self.queue_depth = 0
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'retry_after': 0,
+            'network_errors': 0,
+            'rejected': 0,
+            'breaker_opened': 0,
+            'max_queue_depth': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if not value.is_idle(now)
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _dispatch(self):
+        while self._waiters:
+            delay = self.global_bucket.wait_time(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.global_bucket.reserve(time.monotonic())
+                future.set_result(None)
+        self._dispatcher = None
+
+    async def _acquire(self, priority, chat_id):
+        now = time.monotonic()
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id, now).reserve(now)
+            if delay:
+                await asyncio.sleep(delay)
+
+        if not self._waiters and self.global_bucket.wait_time(time.monotonic()) == 0:
+            self.global_bucket.reserve(time.monotonic())
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        await future
+
+    def _check_breaker(self, request):
+        if self._consecutive_failures < self.breaker_threshold:
+            return
+        if time.monotonic() < self._breaker_open_until or self._probe is not None:
+            self.stats['rejected'] += 1
+            raise NetworkError("Bot API недоступен, запрос отклонен предохранителем")
+        # Пауза истекла: пропускаем один пробный запрос
+        self._probe = request
+
+    def _record_success(self):
+        self._consecutive_failures = 0
+        self._probe = None
+
+    def _record_failure(self):
+        self.stats['network_errors'] += 1
+        self._consecutive_failures += 1
+        self._probe = None
+        if self._consecutive_failures >= self.breaker_threshold:
+            if time.monotonic() >= self._breaker_open_until:
+                self.stats['breaker_opened'] += 1
+                logger.error("Предохранитель исходящих запросов разомкнут на %s с", self.breaker_cooldown)
+            self._breaker_open_until = time.monotonic() + self.breaker_cooldown
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        limited = endpoint not in UNLIMITED_METHODS
+        self.stats['requests'] += 1
+        request = object()
+        try:
+            return await self._send(request, callback, args, kwargs, endpoint, priority, chat_id, limited)
+        finally:
+            # Проба, не дождавшаяся ответа API, не должна держать предохранитель разомкнутым
+            if self._probe is request:
+                self._probe = None
+
+    async def _send(self, request, callback, args, kwargs, endpoint, priority, chat_id, limited):
+        attempt = 0
+        while True:
+            self._check_breaker(request)
+            if limited:
+                started = time.monotonic()
+                self.queue_depth += 1
+                self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue_depth)
+                try:
+                    await self._acquire(priority, chat_id)
+                finally:
+                    self.queue_depth -= 1
+                waited = time.monotonic() - started
+                self.stats['wait_time_total'] += waited
+                self.stats['wait_time_max'] = max(self.stats['wait_time_max'], waited)
+
+            request_started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                observe_api_request(self.name, endpoint, 'retry_after', request_started)
+                self._record_success()
+                self.stats['retry_after'] += 1
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("%s: превышен лимит Telegram, повтор через %s с", endpoint, e.retry_after)
+                now = time.monotonic()
+                if not limited:
+                    # Метод не берет токенов из ведер: ждет только сам запрос, остальная отправка идет
+                    await asyncio.sleep(float(e.retry_after))
+                elif chat_id is not None:
+                    self._chat_bucket(chat_id, now).pause(now, float(e.retry_after))
+                else:
+                    self.global_bucket.pause(now, float(e.retry_after))
+            except BadRequest:
+                # Ошибка в самом запросе: сеть и API в порядке, повтор не поможет
+                observe_api_request(self.name, endpoint, 'bad_request', request_started)
+                self._record_success()
+                raise
+            except NetworkError as e:
+                observe_api_request(self.name, endpoint, 'network_error', request_started)
+                self._record_failure()
+                if endpoint not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    raise
+                backoff = random.uniform(0, min(10.0, 0.5 * 2 ** attempt))
+                logger.warning("%s: сетевая ошибка (%s), повтор через %.2f с", endpoint, e, backoff)
+                await asyncio.sleep(backoff)
+            except TelegramError:
+                # API ответил (например, Forbidden): связь есть, предохранитель замыкается
+                observe_api_request(self.name, endpoint, 'error', request_started)
+                self._record_success()
+                raise
+            except Exception:
+                observe_api_request(self.name, endpoint, 'error', request_started)
+                raise
+            else:
+                observe_api_request(self.name, endpoint, 'ok', request_started)
+                self._record_success()
+                return result
+            attempt += 1
+            self.stats['retries'] += 1
+
+    def get_stats(self):
+        """Возвращает статистику очереди исходящих запросов"""
+        return dict(
+            self.stats,
+            queue_depth=self.queue_depth,
+            breaker_open=self._consecutive_failures >= self.breaker_threshold,
+            wait_time_total=round(self.stats['wait_time_total'], 3),
+            wait_time_max=round(self.stats['wait_time_max'], 3),
+        )
+
+
+# Метрики работы бота; у метрик одного бота метка bot с его именем
+metrics = MetricsRegistry()
+handler_latency = metrics.histogram('bot_handler_duration_seconds', 'Длительность обработчиков', ('handler', 'bot'))
+api_latency = metrics.histogram(
+    'bot_api_request_duration_seconds', 'Длительность запросов к Bot API', ('bot', 'method')
+)
+api_requests = metrics.counter('bot_api_requests_total', 'Запросы к Bot API по результату', ('bot', 'method', 'outcome'))
+tests_started = metrics.counter('bot_tests_started_total', 'Начатые тесты', ('bot',))
+tests_finished = metrics.counter('bot_tests_finished_total', 'Завершенные тесты', ('bot', 'reason'))
+update_errors = metrics.counter(
+    'bot_update_errors_total', 'Необработанные исключения при обработке обновлений', ('bot',)
+)
+log_errors = metrics.counter('bot_log_errors_total', 'Записи лога уровня ERROR и выше', ('logger',))
+worker_restarts = metrics.counter('bot_worker_restarts_total', 'Перезапуски упавших обработчиков', ('worker',))
+worker_dropped_updates = metrics.counter(
+    'bot_worker_dropped_updates_total', 'Обновления, отброшенные из-за недоступного обработчика', ('worker',)
+)
+sessions_in_memory = metrics.gauge('bot_sessions_in_memory', 'Сессии пользователей в памяти', labelnames=('bot',))
+pending_renders = metrics.gauge(
+    'bot_pending_selection_renders', 'Отложенные перерисовки выбранных ответов', labelnames=('bot',)
+)
+outbound_queue_depth = metrics.gauge(
+    'bot_outbound_queue_depth', 'Исходящие запросы в ожидании отправки', labelnames=('bot',)
+)
+bank_questions = metrics.gauge('bot_question_bank_questions', 'Вопросы в текущей версии банка', labelnames=('bot',))
+bank_versions = metrics.gauge('bot_question_bank_versions', 'Загруженные версии банка вопросов', labelnames=('bot',))
+
+
+def observe_api_request(bot_name, endpoint, outcome, started):
+    """Учитывает запрос к Bot API в метриках"""
+    api_latency.observe(time.perf_counter() - started, bot_name, endpoint)
+    api_requests.inc(bot_name, endpoint, outcome)
+
+
+class ErrorCountingHandler(logging.Handler):
+    """Считает записи лога уровня ERROR и выше для метрик"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record):
+        log_errors.inc(record.name)
+
+
+logging.getLogger().addHandler(ErrorCountingHandler())
+
+
+class CourseBot:
+    """Один бот процесса: токен, банк вопросов, сессии пользователей и очередь исходящих запросов.
+
+    Обработчики получают его из context.bot_data['course'].
+    """
+
+    def __init__(self, name, token, banks, session_db_path):
+        self.name = name
+        self.token = token
+        self.banks = banks
+        self.sessions = SessionStore(session_db_path, banks, SESSION_CACHE_SIZE, SESSION_IDLE_TTL)
+        self.scheduler = OutboundScheduler(
+            name,
+            OUTBOUND_GLOBAL_RATE,
+            OUTBOUND_CHAT_RATE,
+            OUTBOUND_CHAT_BURST,
+            OUTBOUND_MAX_RETRIES,
+            OUTBOUND_BREAKER_THRESHOLD,
+            OUTBOUND_BREAKER_COOLDOWN,
+        )
+        # Отложенные перерисовки вопроса после выбора ответов: user_id -> задача
+        self.pending_selection_renders = {}
+
+        sessions_in_memory.track(lambda: len(self.sessions), name)
+        pending_renders.track(lambda: len(self.pending_selection_renders), name)
+        outbound_queue_depth.track(lambda: self.scheduler.queue_depth, name)
+        bank_questions.track(lambda: len(self.banks.current.ids), name)
+        bank_versions.track(lambda: len(self.banks.versions), name)
+
+
+def get_course(context: ContextTypes.DEFAULT_TYPE):
+    """Возвращает бота, которому пришло обновление"""
+    return context.bot_data['course']
+
+
+def timed_handler(function):
+    """Декоратор обработчика: длительность пишется с метками обработчика и бота"""
+    return handler_latency.time(function, lambda update, context, *args, **kwargs: (get_course(context).name,))
+
+
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
-    logger.info(f"Пользователь {update.effective_user.id} запустил бота")
+    logger.info("Пользователь %s запустил бота", update.effective_user.id)
     welcome_text = """
 🏥 Медицинский тест-бот
 
@@ -1159,104 +1517,333 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(welcome_text)
 
 
+@timed_handler
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Служебная статистика кешей и отправки сообщений"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning("Пользователь %s запросил статистику без прав администратора", user_id)
+        return
+
+    course = get_course(context)
+    bank = course.banks.current
+    sessions_text = "\n".join(f"{name}: {value}" for name, value in course.sessions.get_stats().items())
+    markup_text = "\n".join(f"{name}: {value}" for name, value in question_markup_cache.get_stats().items())
+    render_text = "\n".join(f"{name}: {value}" for name, value in render_stats.items())
+    outbound_text = "\n".join(f"{name}: {value}" for name, value in course.scheduler.get_stats().items())
+    await update.message.reply_text(
+        f"🤖 Бот: {course.name}\n"
+        f"📚 Банк вопросов: {bank.version}, {len(bank.ids)} вопросов, "
+        f"загружено версий: {len(course.banks.versions)}\n\n"
+        f"📈 Сессии:\n{sessions_text}\n\n🧩 Клавиатуры:\n{markup_text}\n\n"
+        f"✏️ Сообщения:\n{render_text}\n\n📤 Исходящие запросы:\n{outbound_text}"
+    )
+
+
+@timed_handler
+async def reload_bank(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перезагрузка банка вопросов без перезапуска бота"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning("Пользователь %s запросил перезагрузку банка без прав администратора", user_id)
+        return
+
+    course = get_course(context)
+    try:
+        changed = await reload_question_bank(course)
+    except Exception as e:
+        logger.exception("Ошибка перезагрузки банка вопросов")
+        await update.message.reply_text(f"❌ Банк не перезагружен: {e}")
+        return
+
+    if changed is None:
+        await update.message.reply_text(f"Банк вопросов не изменился: {course.banks.current.version}")
+    else:
+        bank = course.banks.current
+        await update.message.reply_text(
+            f"✅ Загружен банк {bank.version}: {len(bank.ids)} вопросов, изменено {len(changed)}"
+        )
+
+
+def start_new_test(course, user_id):
+    """Создает сессию нового теста; колода повторения ошибок переходит из прошлой сессии"""
+    previous = course.sessions.get(user_id)
+    progress = UserProgress(course.banks)
+    if previous is not None:
+        progress.bank = previous.bank
+        progress.review_deck = previous.review_deck
+    progress.initialize_test()
+    course.sessions[user_id] = progress
+    tests_started.inc(course.name)
+    return progress
+
+
+@timed_handler
 async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало тестирования"""
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} начал тест")
+    logger.info("Пользователь %s начал тест", user_id)
+
+    cancel_selection_render(context, user_id)
 
-    user_data[user_id] = UserProgress()
-    user_data[user_id].initialize_test()
+    start_new_test(get_course(context), user_id)
     await send_question(update, context, user_id)
 
 
-async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Отправка вопроса пользователю"""
-    logger.info(f"Отправка вопроса пользователю {user_id}")
+@timed_handler
+async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, priority=PRIORITY_INTERACTIVE):
+    """Отправка вопроса пользователю; priority — приоритет запроса в OutboundScheduler"""
+    tap_logger.info("Отправка вопроса пользователю %s", user_id)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id}")
+        logger.error("Прогресс не найден для пользователя %s", user_id)
         await handle_user_not_found(update)
         return
 
     if progress.is_test_complete():
-        logger.info(f"Тест завершен для пользователя {user_id}")
+        logger.info("Тест завершен для пользователя %s", user_id)
         await finish_test(update, context, user_id)
         return
 
-    question_data = progress.get_current_question()
-    if not question_data:
-        logger.error(f"Вопрос не найден для пользователя {user_id}")
+    question_id = progress.get_current_question()
+    if question_id is None:
+        logger.error("Вопрос не найден для пользователя %s", user_id)
         await finish_test(update, context, user_id)
         return
 
-    # Подготавливаем данные вопроса
-    shuffled_options = progress.shuffle_options(question_data)
-    progress.current_question_data = question_data
-    progress.current_shuffled_options = shuffled_options
-    progress.option_to_index_map.clear()
-
-    # Создаем маппинг текста ответа на индекс
-    for idx, option in enumerate(shuffled_options):
-        progress.option_to_index_map[option] = idx
-
-    # Создаем клавиатуру
-    keyboard = create_question_keyboard(progress, shuffled_options)
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Берем готовую клавиатуру из кеша
+    reply_markup = question_markup_cache.get(
+        progress.bank, question_id, progress.option_order, progress.selected_mask, progress.mistakes_practice_mode
+    )
 
     # Формируем текст вопроса
-    question_text = format_question_text(progress, question_data)
+    question_text = format_question_text(progress, question_id)
 
     # Отправляем сообщение
     try:
-        if update.callback_query:
-            await update.callback_query.edit_message_text(question_text, reply_markup=reply_markup)
-        else:
-            await update.message.reply_text(question_text, reply_markup=reply_markup)
-        logger.info(f"Вопрос отправлен пользователю {user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка отправки вопроса пользователю {user_id}: {e}")
+        await render_message(update, progress, question_text, reply_markup, priority)
+        tap_logger.info("Вопрос отправлен пользователю %s", user_id)
+    except Exception:
+        logger.exception("Ошибка отправки вопроса пользователю %s", user_id)
         await handle_error(update, "Произошла ошибка при отправке вопроса")
 
 
-def create_question_keyboard(progress, shuffled_options):
+# Формат callback_data: символ версии, символ операции и, для выбора ответа,
+# десятичный индекс варианта. Например, "1s3" — выбрать вариант options[3].
+CALLBACK_VERSION = '1'
+OP_SELECT = 's'
+OP_SUBMIT = 'a'
+OP_NEXT = 'n'
+OP_FINISH_TEST = 'f'
+OP_FINISH_PRACTICE = 'F'
+OP_END_TEST = 'e'
+OP_CONFIRM_END = 'c'
+OP_CONTINUE = 'u'
+OP_VIEW_MISTAKES = 'v'
+OP_RESTART = 'r'
+OP_PRACTICE = 'p'
+OP_END_MISTAKES = 'x'
+OP_MISTAKES_PAGE = 'm'
+
+# Ограничение длины callback_data в Telegram
+MAX_CALLBACK_DATA_LENGTH = 64
+# Ограничение длины текста сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+def encode_callback(opcode, argument=None):
+    """Кодирует операцию и ее аргумент в callback_data"""
+    if argument is None:
+        return f"{CALLBACK_VERSION}{opcode}"
+    return f"{CALLBACK_VERSION}{opcode}{argument}"
+
+
+CB_SUBMIT = encode_callback(OP_SUBMIT)
+CB_NEXT = encode_callback(OP_NEXT)
+CB_FINISH_TEST = encode_callback(OP_FINISH_TEST)
+CB_FINISH_PRACTICE = encode_callback(OP_FINISH_PRACTICE)
+CB_END_TEST = encode_callback(OP_END_TEST)
+CB_CONFIRM_END = encode_callback(OP_CONFIRM_END)
+CB_CONTINUE = encode_callback(OP_CONTINUE)
+CB_VIEW_MISTAKES = encode_callback(OP_VIEW_MISTAKES)
+CB_RESTART = encode_callback(OP_RESTART)
+CB_PRACTICE = encode_callback(OP_PRACTICE)
+CB_END_MISTAKES = encode_callback(OP_END_MISTAKES)
+
+# Кнопки, отправленные до перехода на компактный формат
+LEGACY_CALLBACKS = {
+    'submit_answers': CB_SUBMIT,
+    'next_question': CB_NEXT,
+    'finish_test_now': CB_FINISH_TEST,
+    'finish_mistakes_practice': CB_FINISH_PRACTICE,
+    'end_test': CB_END_TEST,
+    'confirm_end_test': CB_CONFIRM_END,
+    'continue_test': CB_CONTINUE,
+    'view_mistakes': CB_VIEW_MISTAKES,
+    'restart_test': CB_RESTART,
+    'practice_mistakes': CB_PRACTICE,
+    'end_mistakes_session': CB_END_MISTAKES,
+}
+
+
+# Счетчики показа экранов: сколько запросов к API отправлено и сколько сэкономлено
+render_stats = {
+    'sent': 0,
+    'edited': 0,
+    'markup_only': 0,
+    'skipped': 0,
+    'not_modified': 0,
+}
+
+
+async def render_message(update: Update, progress, text, reply_markup=None, priority=PRIORITY_INTERACTIVE):
+    """Показывает экран: редактирует сообщение с нажатой кнопкой или отправляет новое.
+
+    Прогресс запоминает хеши последнего показанного в сообщении текста и
+    клавиатуры: повтор того же экрана не отправляется вовсе, а при
+    неизменном тексте обновляется только клавиатура. Правки идут через
+    методы бота, а не ярлыки query, чтобы передать OutboundScheduler priority.
+    """
+    text_hash = hash(text)
+    markup_hash = hash(reply_markup)
+    query = update.callback_query
+    if not query:
+        message = await update.message.reply_text(text, reply_markup=reply_markup)
+        progress.last_render = (message.message_id, text_hash, markup_hash)
+        render_stats['sent'] += 1
+        return
+
+    message_id = query.message.message_id if query.message else None
+    last_render = progress.last_render
+    if last_render is not None and last_render[0] == message_id and last_render[1] == text_hash:
+        if last_render[2] == markup_hash:
+            render_stats['skipped'] += 1
+            return
+        edit = query.get_bot().edit_message_reply_markup(
+            chat_id=query.message.chat_id, message_id=message_id, reply_markup=reply_markup, rate_limit_args=priority
+        )
+        stat = 'markup_only'
+    else:
+        edit = query.get_bot().edit_message_text(
+            text, chat_id=query.message.chat_id, message_id=message_id, reply_markup=reply_markup,
+            rate_limit_args=priority,
+        )
+        stat = 'edited'
+    try:
+        await edit
+        render_stats[stat] += 1
+    except BadRequest as e:
+        # Сообщение уже показывает этот экран (например, после повторного нажатия)
+        if 'not modified' not in str(e):
+            raise
+        render_stats['not_modified'] += 1
+    progress.last_render = (message_id, text_hash, markup_hash)
+
+
+def create_question_keyboard(options, option_order, selected_mask, practice_mode):
     """Создает клавиатуру для вопроса"""
     keyboard = []
 
-    # Кнопки вариантов ответов
-    for option in shuffled_options:
-        prefix = "✅ " if option in progress.selected_answers else ""
-        # Используем индекс варианта ответа как callback_data
-        index = progress.option_to_index_map[option]
-        keyboard.append([InlineKeyboardButton(f"{prefix}{option}", callback_data=f"select_{index}")])
+    # Кнопки вариантов ответов в порядке показа
+    for index in option_order:
+        prefix = "✅ " if selected_mask >> index & 1 else ""
+        # Используем индекс варианта ответа в банке как callback_data
+        keyboard.append([InlineKeyboardButton(f"{prefix}{options[index]}", callback_data=encode_callback(OP_SELECT, index))])
 
     # Кнопка отправки ответа
-    if progress.selected_answers:
-        keyboard.append([InlineKeyboardButton("🚀 Отправить ответ", callback_data="submit_answers")])
+    if selected_mask:
+        keyboard.append([InlineKeyboardButton("🚀 Отправить ответ", callback_data=CB_SUBMIT)])
 
     # Кнопка завершения теста (только в основном режиме)
-    if not progress.mistakes_practice_mode:
-        keyboard.append([InlineKeyboardButton("🚪 Завершить тестирование", callback_data="end_test")])
+    if not practice_mode:
+        keyboard.append([InlineKeyboardButton("🚪 Завершить тестирование", callback_data=CB_END_TEST)])
 
     return keyboard
 
 
-def format_question_text(progress, question_data):
+class QuestionMarkupCache:
+    """LRU-кеш готовых клавиатур вопросов.
+
+    Клавиатура зависит только от вопроса, порядка вариантов, выбранных
+    вариантов и режима, поэтому одна и та же разметка переиспользуется
+    всеми пользователями в одинаковом состоянии. Вопрос входит в ключ
+    отпечатком содержимого, так что неизмененные вопросы разных версий
+    банка делят записи кеша, а измененные получают новые.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._markups = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bank, question_id, option_order, selected_mask, practice_mode):
+        key = (bank.fingerprints[question_id], option_order, selected_mask, practice_mode)
+        markup = self._markups.get(key)
+        if markup is not None:
+            self.hits += 1
+            self._markups.move_to_end(key)
+            return markup
+
+        self.misses += 1
+        markup = InlineKeyboardMarkup(
+            create_question_keyboard(bank.options[question_id], option_order, selected_mask, practice_mode)
+        )
+        self._store(key, markup)
+        return markup
+
+    def _store(self, key, markup):
+        self._markups[key] = markup
+        if len(self._markups) > self.max_size:
+            self._markups.popitem(last=False)
+
+    def prewarm(self, bank, question_ids=None):
+        """Заполняет кеш клавиатурами вопросов без выбранных ответов"""
+        for question_id in bank.ids if question_ids is None else question_ids:
+            options = bank.options[question_id]
+            if len(options) > MAX_PRECOMPUTED_PERMUTATION_SIZE:
+                continue
+            for option_order in get_option_permutations(len(options)):
+                if len(self._markups) >= self.max_size:
+                    return len(self._markups)
+                key = (bank.fingerprints[question_id], option_order, 0, False)
+                self._store(key, InlineKeyboardMarkup(create_question_keyboard(options, option_order, 0, False)))
+        return len(self._markups)
+
+    def get_stats(self):
+        """Возвращает статистику кеша клавиатур"""
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(hit_rate, 3),
+            'size': len(self._markups),
+            'max_size': self.max_size,
+        }
+
+
+question_markup_cache = QuestionMarkupCache(RENDER_CACHE_SIZE)
+
+
+def format_question_text(progress, question_id):
     """Форматирует текст вопроса"""
     progress_text = progress.get_progress_text()
     attempts_text = f" (Попытка: {progress.current_attempts + 1})" if progress.current_attempts > 0 else ""
 
-    correct_count = len(question_data['correct_answers'])
+    bank = progress.bank
+    correct_count = len(bank.correct_answers[question_id])
     correct_info = f"\n📌 Правильных ответов: {correct_count}" if correct_count > 1 else ""
 
     if progress.mistakes_practice_mode:
-        question_text = f"📝 {progress_text}{attempts_text}{correct_info}\nВопрос: {question_data['question']}"
+        question_text = f"📝 {progress_text}{attempts_text}{correct_info}\nВопрос: {bank.questions[question_id]}"
     else:
-        question_text = f"{progress_text}{attempts_text}{correct_info}\nВопрос: {question_data['question']}"
+        question_text = f"{progress_text}{attempts_text}{correct_info}\nВопрос: {bank.questions[question_id]}"
 
     # Показываем выбранные ответы
-    if progress.selected_answers:
-        selected_text = "\n\n✅ Выбрано: " + ", ".join(progress.selected_answers)
+    if progress.selected_mask:
+        selected_text = "\n\n✅ Выбрано: " + bank.format_options(question_id, progress.selected_mask)
         question_text += selected_text
 
     return question_text
@@ -1279,193 +1866,226 @@ async def handle_error(update, message):
         await update.message.reply_text(message)
 
 
-async def handle_answer_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed_handler
+async def handle_answer_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
     """Обработчик выбора ответов"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} выбрал ответ: {query.data}")
+    tap_logger.info("Пользователь %s выбрал ответ: %d", user_id, index)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при выборе ответа")
+        logger.error("Прогресс не найден для пользователя %s при выборе ответа", user_id)
         await query.edit_message_text("Тест не начат. Используйте /start_test")
         return
 
-    if not progress.current_shuffled_options:
-        logger.error(f"Варианты ответов не найдены для пользователя {user_id}")
+    if progress.current_question_id is None:
+        logger.error("Варианты ответов не найдены для пользователя %s", user_id)
         await query.answer("Ошибка: варианты ответов не загружены", show_alert=True)
         return
 
-    try:
-        index = int(query.data.replace("select_", ""))
-        if index < 0 or index >= len(progress.current_shuffled_options):
-            logger.error(f"Неверный индекс ответа {index} для пользователя {user_id}")
-            await query.answer("Ошибка: неверный вариант ответа", show_alert=True)
-            return
+    if index >= len(progress.option_order):
+        logger.error("Неверный индекс ответа %d для пользователя %s", index, user_id)
+        await query.answer("Ошибка: неверный вариант ответа", show_alert=True)
+        return
 
-        original_text = progress.current_shuffled_options[index]
-        progress.toggle_answer_selection(original_text)
+    progress.toggle_answer_selection(index)
+    if ANSWER_DEBOUNCE_SECONDS <= 0:
         await send_question(update, context, user_id)
-    except (ValueError, IndexError) as e:
-        logger.error(f"Ошибка обработки выбора ответа для пользователя {user_id}: {e}")
-        await query.answer("Ошибка: не удалось обработать выбор", show_alert=True)
+    else:
+        pending = get_course(context).pending_selection_renders
+        if user_id not in pending:
+            pending[user_id] = context.application.create_task(
+                render_selection_later(update, context, user_id), update=update
+            )
+
 
+def user_lock(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Блокировка обновлений пользователя для работы вне обработчика"""
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        return processor.user_lock(user_id)
+    return contextlib.nullcontext()
 
+
+@timed_handler
+async def render_selection_later(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Перерисовывает вопрос по окончании окна нажатий с последним выбором"""
+    pending = get_course(context).pending_selection_renders
+    try:
+        await asyncio.sleep(ANSWER_DEBOUNCE_SECONDS)
+        async with user_lock(context, user_id):
+            if pending.pop(user_id, None) is not None:
+                await send_question(update, context, user_id, PRIORITY_BULK)
+    finally:
+        if pending.get(user_id) is asyncio.current_task():
+            del pending[user_id]
+
+
+def cancel_selection_render(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Отменяет отложенную перерисовку: следующий экран покажет актуальное состояние"""
+    task = get_course(context).pending_selection_renders.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+
+@timed_handler
 async def handle_answer_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик отправки ответов"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} отправил ответ")
+    tap_logger.info("Пользователь %s отправил ответ", user_id)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при отправке ответа")
+        logger.error("Прогресс не найден для пользователя %s при отправке ответа", user_id)
         await query.edit_message_text("Тест не начат. Используйте /start_test")
         return
 
-    if not progress.current_question_data:
-        logger.error(f"Вопрос не найден для пользователя {user_id} при отправке ответа")
+    if progress.current_question_id is None:
+        logger.error("Вопрос не найден для пользователя %s при отправке ответа", user_id)
         await query.edit_message_text("Ошибка: вопрос не найден")
         return
 
-    if not progress.selected_answers:
+    if not progress.selected_mask:
         await query.answer("Сначала выберите хотя бы один ответ!", show_alert=True)
         return
 
-    question_data = progress.current_question_data
-    is_correct = progress.is_answer_correct(progress.selected_answers, question_data)
+    question_id = progress.current_question_id
+    selected_mask = progress.selected_mask
+    is_correct = progress.is_answer_correct(selected_mask, question_id)
 
-    user_answers_text = ", ".join(progress.selected_answers)
-    correct_answers_text = ", ".join(question_data['correct_answers'])
+    user_answers_text = progress.bank.format_options(question_id, selected_mask)
+    correct_answers_text = ", ".join(progress.bank.correct_answers[question_id])
 
-    logger.info(f"Ответ пользователя {user_id}: {user_answers_text}, правильный: {is_correct}")
+    tap_logger.info("Ответ пользователя %s: %s, правильный: %s", user_id, user_answers_text, is_correct)
 
     if is_correct:
-        progress.handle_correct_answer(question_data)
+        progress.handle_correct_answer(question_id)
         result_text = f"✅ Правильно!\n{progress.get_progress_text()}"
     else:
-        progress.handle_incorrect_answer(question_data, progress.selected_answers)
+        progress.handle_incorrect_answer(question_id, selected_mask)
         result_text = f"❌ Неправильно!\nВаш ответ: {user_answers_text}\nПравильный ответ: {correct_answers_text}\n{progress.get_progress_text()}"
 
     # Создаем кнопки для продолжения
     keyboard = []
     if not progress.is_test_complete():
-        keyboard.append([InlineKeyboardButton("Следующий вопрос →", callback_data="next_question")])
+        keyboard.append([InlineKeyboardButton("Следующий вопрос →", callback_data=CB_NEXT)])
     else:
         if progress.mistakes_practice_mode:
-            keyboard.append([InlineKeyboardButton("🏁 Завершить отработку", callback_data="finish_mistakes_practice")])
+            keyboard.append([InlineKeyboardButton("🏁 Завершить отработку", callback_data=CB_FINISH_PRACTICE)])
         else:
-            keyboard.append([InlineKeyboardButton("🏁 Завершить тест", callback_data="finish_test_now")])
+            keyboard.append([InlineKeyboardButton("🏁 Завершить тест", callback_data=CB_FINISH_TEST)])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        await query.edit_message_text(
-            f"{result_text}\n\nНажмите для продолжения:",
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки результата пользователю {user_id}: {e}")
+        await render_message(update, progress, f"{result_text}\n\nНажмите для продолжения:", reply_markup)
+    except Exception:
+        logger.exception("Ошибка отправки результата пользователю %s", user_id)
 
 
+@timed_handler
 async def next_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Переход к следующему вопросу"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} переходит к следующему вопросу")
+    tap_logger.info("Пользователь %s переходит к следующему вопросу", user_id)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при переходе к следующему вопросу")
+        logger.error("Прогресс не найден для пользователя %s при переходе к следующему вопросу", user_id)
         await query.edit_message_text("Тест не начат. Используйте /start_test")
         return
 
-    # В режиме отработки увеличиваем индекс при переходе
-    if progress.mistakes_practice_mode and not progress.is_test_complete():
-        progress.current_question_index += 1
-
     await send_question(update, context, user_id)
 
 
+@timed_handler
 async def handle_end_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик досрочного завершения теста"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} запросил завершение теста")
+    logger.info("Пользователь %s запросил завершение теста", user_id)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при запросе завершения теста")
+        logger.error("Прогресс не найден для пользователя %s при запросе завершения теста", user_id)
         await query.edit_message_text("Тест не начат. Используйте /start_test")
         return
 
     keyboard = [
-        [InlineKeyboardButton("✅ Да, завершить", callback_data="confirm_end_test")],
-        [InlineKeyboardButton("❌ Нет, продолжить", callback_data="continue_test")]
+        [InlineKeyboardButton("✅ Да, завершить", callback_data=CB_CONFIRM_END)],
+        [InlineKeyboardButton("❌ Нет, продолжить", callback_data=CB_CONTINUE)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(
+    await render_message(
+        update, progress,
         f"Вы уверены, что хотите завершить тестирование?\n{progress.get_progress_text()}",
-        reply_markup=reply_markup
+        reply_markup
     )
 
 
+@timed_handler
 async def confirm_end_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подтверждение досрочного завершения теста"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} подтвердил завершение теста")
+    logger.info("Пользователь %s подтвердил завершение теста", user_id)
 
     await finish_test(update, context, user_id, early_exit=True)
 
 
+@timed_handler
 async def continue_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Продолжение теста после отмены выхода"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} продолжил тест")
+    logger.info("Пользователь %s продолжил тест", user_id)
 
     await send_question(update, context, user_id)
 
 
+@timed_handler
 async def finish_test_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Завершение теста после последнего вопроса"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} завершил тест")
+    logger.info("Пользователь %s завершил тест", user_id)
 
     await finish_test(update, context, user_id)
 
 
+@timed_handler
 async def finish_mistakes_practice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Завершение отработки ошибок"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при завершении отработки ошибок")
+        logger.error("Прогресс не найден для пользователя %s при завершении отработки ошибок", user_id)
         await query.edit_message_text("Сессия не найдена")
         return
 
@@ -1473,33 +2093,37 @@ async def finish_mistakes_practice(update: Update, context: ContextTypes.DEFAULT
         result_text = f"📊 Отработка завершена!\nОсталось ошибок: {len(progress.mistakes)}"
     else:
         result_text = "🎉 Поздравляем! Вы исправили все ошибки! 🏆"
+    if progress.review_deck:
+        result_text += f"\nВопросов на интервальном повторении: {len(progress.review_deck)}"
 
     keyboard = [
-        [InlineKeyboardButton("📝 Посмотреть ошибки", callback_data="view_mistakes")],
-        [InlineKeyboardButton("🔄 Новый тест", callback_data="restart_test")],
-        [InlineKeyboardButton("🚪 Завершить", callback_data="end_mistakes_session")]
+        [InlineKeyboardButton("📝 Посмотреть ошибки", callback_data=CB_VIEW_MISTAKES)],
+        [InlineKeyboardButton("🔄 Новый тест", callback_data=CB_RESTART)],
+        [InlineKeyboardButton("🚪 Завершить", callback_data=CB_END_MISTAKES)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(result_text, reply_markup=reply_markup)
+    await render_message(update, progress, result_text, reply_markup)
 
 
+@timed_handler
 async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, early_exit=False):
     """Завершение теста и вывод результатов"""
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
     if not progress:
-        logger.error(f"Прогресс не найден для пользователя {user_id} при завершении теста")
+        logger.error("Прогресс не найден для пользователя %s при завершении теста", user_id)
         await handle_user_not_found(update)
         return
 
-    total_questions = len(progress.shuffled_questions)
+    total_questions = progress.get_total_questions()
+    tests_finished.inc(get_course(context).name, 'early_exit' if early_exit else 'completed')
 
     if early_exit:
-        answered = len(progress.answered_correctly)
+        answered = progress.get_answered_count()
         result_text = (
             f"📊 Тест завершен досрочно!\n"
             f"Правильно отвечено: {answered}/{total_questions}\n"
-            f"Осталось вопросов: {len(progress.pending_questions)}\n\n"
+            f"Осталось вопросов: {progress.get_remaining_count()}\n\n"
         )
     else:
         result_text = (
@@ -1515,144 +2139,781 @@ async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE, user_i
         result_text += "Поздравляем! Все ответы правильные! 🏆"
 
     keyboard = []
-    if progress.mistakes:
-        keyboard.append([InlineKeyboardButton("📝 Отработать ошибки", callback_data="practice_mistakes")])
-    keyboard.append([InlineKeyboardButton("🔄 Новый тест", callback_data="restart_test")])
+    if progress.has_due_reviews():
+        keyboard.append([InlineKeyboardButton("📝 Отработать ошибки", callback_data=CB_PRACTICE)])
+    keyboard.append([InlineKeyboardButton("🔄 Новый тест", callback_data=CB_RESTART)])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        if update.callback_query:
-            await update.callback_query.edit_message_text(result_text, reply_markup=reply_markup)
-        else:
-            await update.message.reply_text(result_text, reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Ошибка завершения теста для пользователя {user_id}: {e}")
+        await render_message(update, progress, result_text, reply_markup)
+    except Exception:
+        logger.exception("Ошибка завершения теста для пользователя %s", user_id)
+
+
+def utf16_length(text):
+    """Длина текста в единицах UTF-16, в которых Telegram считает лимиты"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def shorten(text, limit):
+    """Обрезает текст до limit единиц UTF-16 с многоточием"""
+    encoded = text.encode('utf-16-le')
+    if len(encoded) <= 2 * limit:
+        return text
+    # Половинка суррогатной пары на границе отбрасывается
+    return encoded[:2 * (limit - 1)].decode('utf-16-le', 'ignore') + '…'
+
+
+def build_mistakes_page(progress, page):
+    """Строит текст и клавиатуру одной страницы ошибок; разбираются только ошибки этой страницы"""
+    bank = progress.bank
+    pages = (len(progress.mistakes) + MISTAKES_PAGE_SIZE - 1) // MISTAKES_PAGE_SIZE
+    page = min(page, pages - 1)
+    start = page * MISTAKES_PAGE_SIZE
+
+    header = f"📋 Ваши ошибки (страница {page + 1} из {pages}):\n\n"
+    entries = []
+    # islice пропускает предыдущие страницы без обращения к банку
+    mistakes = itertools.islice(progress.mistakes.items(), start, start + MISTAKES_PAGE_SIZE)
+    for i, (question_id, user_mask) in enumerate(mistakes, start + 1):
+        entries.append(
+            f"{i}. Вопрос: {bank.questions[question_id]}\n"
+            f" Ваш ответ: ❌ {bank.format_options(question_id, user_mask)}\n"
+            f" Правильный: ✅ {', '.join(bank.correct_answers[question_id])}\n\n"
+        )
+    # Страница из длинных вопросов не должна выходить за лимит сообщения (Telegram считает в UTF-16)
+    budget = MAX_MESSAGE_LENGTH - utf16_length(header)
+    if sum(map(utf16_length, entries)) > budget:
+        entries = [shorten(entry.rstrip('\n'), budget // len(entries) - 2) + '\n\n' for entry in entries]
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=encode_callback(OP_MISTAKES_PAGE, page - 1)))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=encode_callback(OP_MISTAKES_PAGE, page + 1)))
+    keyboard = [navigation] if navigation else []
+    if progress.has_due_reviews():
+        keyboard.append([InlineKeyboardButton("📝 Отработать ошибки", callback_data=CB_PRACTICE)])
+    keyboard.append([InlineKeyboardButton("🚪 Завершить", callback_data=CB_END_MISTAKES)])
+    return header + ''.join(entries), InlineKeyboardMarkup(keyboard)
+
+
+def build_no_mistakes_screen(progress):
+    """Экран без ошибок текущего теста: предлагает отработку, если пора повторить ошибки прошлых тестов"""
+    due = progress.review_deck.due_count(time.time())
+    if not due:
+        return "🎉 У вас нет ошибок! Отличный результат!", None
+    keyboard = [
+        [InlineKeyboardButton("📝 Отработать ошибки", callback_data=CB_PRACTICE)],
+        [InlineKeyboardButton("🚪 Завершить", callback_data=CB_END_MISTAKES)]
+    ]
+    text = f"В этом тесте ошибок нет, но пора повторить вопросы прошлых тестов: {due}"
+    return text, InlineKeyboardMarkup(keyboard)
 
 
+@timed_handler
 async def show_mistakes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать ошибки пользователя"""
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} запросил просмотр ошибок")
+    logger.info("Пользователь %s запросил просмотр ошибок", user_id)
 
-    progress = user_data.get(user_id)
+    progress = get_course(context).sessions.get(user_id)
 
     if not progress:
         await update.message.reply_text("Вы еще не проходили тестирование. Используйте /start_test")
         return
 
     if not progress.mistakes:
-        await update.message.reply_text("🎉 У вас нет ошибок! Отличный результат!")
+        text, reply_markup = build_no_mistakes_screen(progress)
+        await render_message(update, progress, text, reply_markup)
         return
 
-    mistakes_text = "📋 Ваши ошибки:\n\n"
-    for i, mistake in enumerate(progress.mistakes, 1):
-        mistakes_text += (
-            f"{i}. Вопрос: {mistake['question']}\n"
-            f" Ваш ответ: ❌ {mistake['user_answer']}\n"
-            f" Правильный: ✅ {mistake['correct_answer']}\n\n"
-        )
-
-    keyboard = [
-        [InlineKeyboardButton("📝 Отработать ошибки", callback_data="practice_mistakes")],
-        [InlineKeyboardButton("🚪 Завершить", callback_data="end_mistakes_session")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(mistakes_text, reply_markup=reply_markup)
+    mistakes_text, reply_markup = build_mistakes_page(progress, 0)
+    await render_message(update, progress, mistakes_text, reply_markup)
 
 
-async def handle_mistakes_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик действий с ошибками"""
+async def get_mistakes_session(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    """Отвечает на callback действия с ошибками и возвращает прогресс пользователя"""
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} выполнил действие с ошибками: {query.data}")
-
-    progress = user_data.get(user_id)
+    tap_logger.info("Пользователь %s выполнил действие с ошибками: %s", user_id, action)
 
+    progress = get_course(context).sessions.get(user_id)
     if not progress:
         await query.edit_message_text("Сессия не найдена")
+    return progress
+
+
+@timed_handler
+async def view_mistakes(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """Просмотр страницы ошибок из меню"""
+    progress = await get_mistakes_session(update, context, "view_mistakes")
+    if not progress:
         return
 
-    if query.data == "view_mistakes":
-        if not progress.mistakes:
-            await query.edit_message_text("У вас нет ошибок!")
-            return
+    if not progress.mistakes:
+        text, reply_markup = build_no_mistakes_screen(progress)
+        await render_message(update, progress, text, reply_markup)
+        return
 
-        mistakes_text = "📋 Ваши ошибки:\n\n"
-        for i, mistake in enumerate(progress.mistakes, 1):
-            mistakes_text += (
-                f"{i}. {mistake['question']}\n"
-                f" Ваш ответ: ❌ {mistake['user_answer']}\n"
-                f" Правильный: ✅ {mistake['correct_answer']}\n\n"
-            )
+    mistakes_text, reply_markup = build_mistakes_page(progress, page)
+    await render_message(update, progress, mistakes_text, reply_markup)
 
-        keyboard = [
-            [InlineKeyboardButton("📝 Отработать ошибки", callback_data="practice_mistakes")],
-            [InlineKeyboardButton("🚪 Завершить", callback_data="end_mistakes_session")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(mistakes_text, reply_markup=reply_markup)
 
-    elif query.data == "restart_test":
-        user_data[user_id] = UserProgress()
-        user_data[user_id].initialize_test()
-        await send_question(update, context, user_id)
+@timed_handler
+async def restart_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало нового теста из меню"""
+    if not await get_mistakes_session(update, context, "restart_test"):
+        return
 
-    elif query.data == "practice_mistakes":
-        if progress.mistakes:
-            if progress.start_mistakes_practice():
-                await send_question(update, context, user_id)
-            else:
-                await query.edit_message_text("Не удалось начать отработку ошибок.")
+    user_id = update.effective_user.id
+    start_new_test(get_course(context), user_id)
+    await send_question(update, context, user_id)
+
+
+@timed_handler
+async def practice_mistakes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход к отработке ошибок из меню"""
+    progress = await get_mistakes_session(update, context, "practice_mistakes")
+    if not progress:
+        return
+
+    query = update.callback_query
+    if progress.has_due_reviews():
+        if progress.start_mistakes_practice():
+            await send_question(update, context, update.effective_user.id)
         else:
-            await query.edit_message_text("У вас нет ошибок для отработки!")
+            await query.edit_message_text("Не удалось начать отработку ошибок.")
+    else:
+        await query.edit_message_text("У вас нет ошибок для отработки!")
+
 
-    elif query.data == "end_mistakes_session":
-        await query.edit_message_text("Работа с ошибками завершена. Используйте /start_test для нового теста.")
+@timed_handler
+async def end_mistakes_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Завершение работы с ошибками"""
+    if not await get_mistakes_session(update, context, "end_mistakes_session"):
+        return
+
+    await update.callback_query.edit_message_text(
+        "Работа с ошибками завершена. Используйте /start_test для нового теста."
+    )
 
-    elif query.data == "finish_mistakes_practice":
-        await finish_mistakes_practice(update, context)
+
+# Обработчики callback-запросов: операция -> (обработчик, есть ли числовой аргумент)
+CALLBACK_ROUTES = {
+    OP_SELECT: (handle_answer_selection, True),
+    OP_SUBMIT: (handle_answer_submission, False),
+    OP_NEXT: (next_question, False),
+    OP_FINISH_TEST: (finish_test_now, False),
+    OP_FINISH_PRACTICE: (finish_mistakes_practice, False),
+    OP_END_TEST: (handle_end_test, False),
+    OP_CONFIRM_END: (confirm_end_test, False),
+    OP_CONTINUE: (continue_test, False),
+    OP_VIEW_MISTAKES: (view_mistakes, False),
+    OP_MISTAKES_PAGE: (view_mistakes, True),
+    OP_RESTART: (restart_test, False),
+    OP_PRACTICE: (practice_mistakes, False),
+    OP_END_MISTAKES: (end_mistakes_session, False),
+}
+
+
+def decode_callback(data):
+    """Разбирает callback_data; возвращает (обработчик, аргументы) или None"""
+    if not data or len(data) > MAX_CALLBACK_DATA_LENGTH:
+        return None
+    if data[0] != CALLBACK_VERSION:
+        if data.startswith('select_'):
+            data = encode_callback(OP_SELECT, data[len('select_'):])
+        else:
+            data = LEGACY_CALLBACKS.get(data)
+            if data is None:
+                return None
+
+    route = CALLBACK_ROUTES.get(data[1:2])
+    if route is None:
+        return None
+    handler, has_argument = route
+    argument = data[2:]
+    if not has_argument:
+        return (handler, ()) if not argument else None
+    if not argument.isascii() or not argument.isdigit():
+        return None
+    return handler, (int(argument),)
+
+
+@timed_handler
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единый обработчик callback-запросов"""
+    query = update.callback_query
+    decoded = decode_callback(query.data)
+    if decoded is None:
+        logger.warning("Некорректные данные callback от пользователя %s: %r", update.effective_user.id, query.data)
+        await query.answer("Кнопка устарела. Используйте /start_test", show_alert=True)
+        return
+
+    handler, arguments = decoded
+    if handler is not handle_answer_selection:
+        cancel_selection_render(context, update.effective_user.id)
+    await handler(update, context, *arguments)
+
+
+def load_next_bank(banks):
+    """Загружает банк бота с диска и переносит в него декодированные данные текущей версии"""
+    bank = load_question_bank(banks.bank_path, banks.source_path)
+    if bank.version == banks.current.version:
+        return None, None
+    changed = bank.inherit(banks.current)
+    # Если эту версию уже загрузил другой бот процесса, используется его экземпляр
+    return share_bank(bank), changed
+
+
+async def reload_question_bank(course):
+    """Подменяет текущий банк бота новой версией; возвращает id измененных вопросов или None"""
+    banks = course.banks
+    bank, changed = await asyncio.to_thread(load_next_bank, banks)
+    if bank is None:
+        return None
+
+    # Новые тесты начинаются на новой версии, начатые сессии держат ссылку на свою
+    banks.versions[bank.version] = bank
+    previous, banks.current = banks.current, bank
+    course.sessions.release_unused_banks()
+    if RENDER_CACHE_PREWARM:
+        question_markup_cache.prewarm(bank, changed)
+    logger.info(
+        "Банк вопросов бота %s обновлен: %s -> %s, изменено вопросов: %d",
+        course.name, previous.version, bank.version, len(changed),
+    )
+    return changed
+
+
+def get_bank_files_state(banks):
+    """Время изменения файлов банка для отслеживания обновлений"""
+    return tuple(
+        os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        for path in (banks.bank_path, banks.source_path)
+    )
+
+
+async def watch_question_bank(course, interval):
+    """Периодически проверяет файлы банка бота и перезагружает его при изменении"""
+    known_state = get_bank_files_state(course.banks)
+    while True:
+        await asyncio.sleep(interval)
+        state = get_bank_files_state(course.banks)
+        if state == known_state:
+            continue
+        known_state = state
+        try:
+            await reload_question_bank(course)
+        except Exception:
+            logger.exception("Ошибка перезагрузки банка вопросов бота %s", course.name)
+
+
+async def handle_update_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Учет и запись исключений, не перехваченных обработчиками"""
+    update_errors.inc(get_course(context).name)
+    logger.error("Необработанная ошибка при обработке обновления", exc_info=context.error)
+
+
+async def post_init(application: Application):
+    """Запуск фоновой записи сессий, отслеживания банка вопросов и эндпоинта метрик"""
+    course = application.bot_data['course']
+    loop = asyncio.get_running_loop()
+    application.bot_data['session_flusher'] = loop.create_task(course.sessions.run_flusher(SESSION_FLUSH_INTERVAL))
+    if BANK_WATCH_INTERVAL > 0:
+        application.bot_data['bank_watcher'] = loop.create_task(watch_question_bank(course, BANK_WATCH_INTERVAL))
+    # Метрики всех ботов процесса отдает один эндпоинт
+    if METRICS_PORT and application.bot_data['serve_metrics']:
+        application.bot_data['metrics_server'] = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+
+async def post_stop(application: Application):
+    """Остановка фоновых задач и сохранение оставшихся изменений"""
+    for name in ('session_flusher', 'bank_watcher'):
+        task = application.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server is not None:
+        metrics_server.close()
+    await application.bot_data['course'].sessions.flush()
+
+
+async def post_shutdown(application: Application):
+    """Закрытие хранилища сессий"""
+    application.bot_data['course'].sessions.close()
+
+
+def get_webhook_options(url_path, port):
+    """Параметры webhook бота с путем url_path на порту port; WEBHOOK_URL проверяется в main()"""
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{url_path}"
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан, запросы к webhook не проверяются")
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': port,
+        'url_path': url_path,
+        'webhook_url': webhook_url,
+        'secret_token': WEBHOOK_SECRET,
+        'max_connections': WEBHOOK_MAX_CONNECTIONS,
+    }
+
+
+def build_webhook_server(routes):
+    """HTTP-сервер webhook для нескольких ботов на одном порту: бот выбирается по пути запроса.
+
+    routes — пары (путь webhook, приложение бота). Обновление проверяется по
+    WEBHOOK_SECRET и кладется в update_queue приложения, как это делает
+    Updater.start_webhook для одного бота.
+    """
+    import tornado.httpserver
+    import tornado.web
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        def initialize(self, bot_application):
+            self.bot_application = bot_application
+
+        async def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                raise tornado.web.HTTPError(403)
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            update = Update.de_json(data, self.bot_application.bot)
+            if update is not None:
+                await self.bot_application.update_queue.put(update)
+
+    def log_request(handler):
+        # Как в Updater.start_webhook: запрос на каждое обновление пишется в лог только при отладке
+        logger.debug("Webhook: %d %s", handler.get_status(), handler.request.path)
+
+    return tornado.httpserver.HTTPServer(tornado.web.Application(
+        [
+            (rf"/{re.escape(url_path)}/?", WebhookHandler, {'bot_application': application})
+            for url_path, application in routes
+        ],
+        log_function=log_request,
+    ))
+
+
+def run_webhook(application: Application):
+    """Запуск бота с получением обновлений через webhook"""
+    url_path = WEBHOOK_PATH.strip('/')
+    options = get_webhook_options(url_path, WEBHOOK_PORT)
+    logger.info("Бот успешно запущен и ожидает обновлений на %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, url_path)
+    application.run_webhook(**options)
+
+
+def load_bot_configs():
+    """Список ботов процесса: из файла BOTS_CONFIG или один бот из переменных окружения.
+
+    BOTS_CONFIG — JSON-список объектов с полями name, token (или token_env —
+    имя переменной окружения с токеном), questions, bank и sessions.
+    Относительные пути отсчитываются от каталога файла; незаданные пути
+    берутся из QUESTION_SOURCE_PATH, QUESTION_BANK_PATH и SESSION_DB_PATH,
+    причем база сессий получает суффикс с именем бота.
+    """
+    if not BOTS_CONFIG:
+        return [{
+            'name': BOT_NAME,
+            'token': BOT_TOKEN,
+            'questions': QUESTION_SOURCE_PATH,
+            'bank': QUESTION_BANK_PATH,
+            'sessions': SESSION_DB_PATH,
+        }]
+
+    with open(BOTS_CONFIG, encoding='utf-8') as config_file:
+        entries = json.load(config_file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("BOTS_CONFIG должен содержать непустой список ботов")
+
+    config_dir = os.path.dirname(os.path.abspath(BOTS_CONFIG))
+
+    def resolve(path):
+        return path if path == ':memory:' else os.path.join(config_dir, path)
+
+    configs = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Бот #{index + 1} в BOTS_CONFIG должен быть объектом")
+        name = str(entry.get('name') or f'bot{index + 1}')
+        if any(config['name'] == name for config in configs):
+            raise ValueError(f"Имя бота {name} в BOTS_CONFIG повторяется")
+        if 'sessions' in entry:
+            sessions = resolve(entry['sessions'])
+        elif SESSION_DB_PATH == ':memory:':
+            sessions = SESSION_DB_PATH
+        else:
+            root, extension = os.path.splitext(SESSION_DB_PATH)
+            sessions = f"{root}_{name}{extension}"
+        configs.append({
+            'name': name,
+            'token': entry['token'] if 'token' in entry else os.getenv(entry.get('token_env', 'BOT_TOKEN')),
+            'questions': resolve(entry['questions']) if 'questions' in entry else QUESTION_SOURCE_PATH,
+            'bank': resolve(entry['bank']) if 'bank' in entry else QUESTION_BANK_PATH,
+            'sessions': sessions,
+        })
+    return configs
+
+
+def create_courses(configs):
+    """Загружает банки и создает ботов по конфигурации; одинаковые банки загружаются один раз"""
+    courses = [
+        CourseBot(config['name'], config['token'], BankRegistry.load(config['bank'], config['questions']),
+                  config['sessions'])
+        for config in configs
+    ]
+    if RENDER_CACHE_PREWARM:
+        # Кеш клавиатур общий для ботов, поэтому общий банк заполняет его один раз
+        for bank in {id(course.banks.current): course.banks.current for course in courses}.values():
+            prewarmed = question_markup_cache.prewarm(bank)
+        logger.info("Кеш клавиатур заполнен заранее: %d", prewarmed)
+    return courses
+
+
+def build_application(course, with_updater=True, serve_metrics=True, request=None, get_updates_request=None):
+    """Создает приложение бота с обработчиками; без updater обновления кладутся в update_queue извне.
+
+    request и get_updates_request передаются, чтобы несколько ботов делили пул HTTP-соединений.
+    """
+    builder = (
+        Application.builder()
+        .token(course.token)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(course.scheduler)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder.base_url(TELEGRAM_API_URL)
+    if request is not None:
+        builder.request(request)
+    if get_updates_request is not None:
+        builder.get_updates_request(get_updates_request)
+    if not with_updater:
+        builder.updater(None)
+    application = builder.build()
+    application.bot_data['course'] = course
+    application.bot_data['serve_metrics'] = serve_metrics
+
+    # Регистрация обработчиков команд
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start_test", start_test))
+    application.add_handler(CommandHandler("my_mistakes", show_mistakes))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("reload_bank", reload_bank))
+
+    # Все callback'и разбираются одним обработчиком
+    application.add_handler(CallbackQueryHandler(route_callback))
+    application.add_error_handler(handle_update_error)
+    return application
+
+
+def run_worker(index, workers, connection):
+    """Точка входа процесса-обработчика: обрабатывает обновления, присланные диспетчером"""
+    global METRICS_PORT
+    # Процесс останавливает диспетчер, закрывая канал; сигналы терминала приходят всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    course = create_courses(load_bot_configs())[0]
+    # Общий лимит бота делится между обработчиками, метрики каждого — на своем порту
+    course.scheduler.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE / workers, OUTBOUND_GLOBAL_RATE / workers)
+    if METRICS_PORT:
+        METRICS_PORT += index
+    logger.info("Обработчик %d из %d запущен", index + 1, workers)
+    asyncio.run(serve_worker(course, connection))
+    logger.info("Обработчик %d из %d остановлен", index + 1, workers)
+
+
+async def serve_worker(course, connection):
+    """Передает обновления из канала диспетчера в приложение до закрытия канала"""
+    application = build_application(course, with_updater=False)
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+
+    def receive():
+        try:
+            data = connection.recv_bytes()
+        except (EOFError, OSError):
+            loop.remove_reader(connection.fileno())
+            if not closed.done():
+                closed.set_result(None)
+            return
+        application.update_queue.put_nowait(Update.de_json(json.loads(data), application.bot))
+
+    # Тот же порядок запуска и остановки, что в Application.run_polling
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    loop.add_reader(connection.fileno(), receive)
+    try:
+        await closed
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+
+class ShardDispatcher:
+    """Раздает обновления процессам-обработчикам по id пользователя.
+
+    Все обновления одного пользователя попадают в один процесс, поэтому его
+    сессия живет в памяти только там. Обновления передаются через каналы
+    multiprocessing отдельными потоками, чтобы медленный обработчик не
+    останавливал прием обновлений для остальных. Поток канала перезапускает
+    упавший обработчик и отправляет ему обновление, которое не удалось
+    передать; обработчик, который падает слишком часто, помечается
+    недоступным, и его обновления отбрасываются с учетом в метриках.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.stats = {'routed': [0] * workers, 'restarts': [0] * workers, 'dropped': [0] * workers}
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = [None] * workers
+        self._dead = [False] * workers
+        self._outboxes = []
+        self._senders = []
+
+    def start(self):
+        for index in range(self.workers):
+            sender = self._start_worker(index)
+            outbox = queue.SimpleQueue()
+            thread = threading.Thread(target=self._send_loop, args=(index, sender, outbox), daemon=True)
+            thread.start()
+            self._outboxes.append(outbox)
+            self._senders.append(thread)
+        logger.info("Запущено обработчиков: %d", self.workers)
+
+    def _start_worker(self, index):
+        """Запускает процесс обработчика и возвращает передающий конец его канала"""
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=run_worker, args=(index, self.workers, receiver), name=f'worker-{index + 1}'
+        )
+        process.start()
+        receiver.close()
+        self._processes[index] = process
+        return sender
+
+    def _restart_worker(self, index, sender, restart_times):
+        """Перезапускает упавший обработчик; None, если он падает слишком часто"""
+        sender.close()
+        process = self._processes[index]
+        process.join(5.0)
+        now = time.monotonic()
+        while restart_times and restart_times[0] < now - WORKER_RESTART_WINDOW:
+            restart_times.popleft()
+        if len(restart_times) >= WORKER_MAX_RESTARTS:
+            logger.error(
+                "Обработчик %d упал %d раз за %.0f с и больше не перезапускается, его обновления отбрасываются",
+                index + 1, len(restart_times) + 1, WORKER_RESTART_WINDOW,
+            )
+            self._dead[index] = True
+            return None
+        restart_times.append(now)
+        self.stats['restarts'][index] += 1
+        worker_restarts.inc(str(index + 1))
+        logger.error("Обработчик %d завершился с кодом %s, перезапуск", index + 1, process.exitcode)
+        return self._start_worker(index)
+
+    def _drop(self, index):
+        self.stats['dropped'][index] += 1
+        worker_dropped_updates.inc(str(index + 1))
+
+    def _send_loop(self, index, sender, outbox):
+        restart_times = deque()
+        while (data := outbox.get()) is not None:
+            while sender is not None:
+                try:
+                    sender.send_bytes(data)
+                    break
+                except OSError:
+                    sender = self._restart_worker(index, sender, restart_times)
+            if sender is None:
+                self._drop(index)
+        if sender is not None:
+            sender.close()
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Передает обновление обработчику, отвечающему за пользователя"""
+        user = update.effective_user
+        index = user.id % self.workers if user else 0
+        if self._dead[index]:
+            self._drop(index)
+            return
+        self.stats['routed'][index] += 1
+        self._outboxes[index].put(json.dumps(update.to_dict(), separators=(',', ':')).encode('utf-8'))
+
+    def stop(self, timeout=30.0):
+        """Закрывает каналы и ждет, пока обработчики сохранят сессии и завершатся"""
+        for outbox in self._outboxes:
+            outbox.put(None)
+        for thread in self._senders:
+            thread.join(timeout)
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.error("Обработчик %s не завершился за %.0f с, останавливается принудительно", process.name, timeout)
+                process.terminate()
+        logger.info("Обработчики остановлены, статистика раздачи: %s", self.stats)
+
+
+def build_dispatcher_application(dispatcher, token):
+    """Создает приложение, которое только получает обновления и раздает их обработчикам"""
+
+    async def serve_metrics(application: Application):
+        # Порты METRICS_PORT..METRICS_PORT + WORKERS - 1 заняты обработчиками
+        if METRICS_PORT:
+            application.bot_data['metrics_server'] = await metrics.serve(METRICS_HOST, METRICS_PORT + dispatcher.workers)
+
+    async def stop_metrics(application: Application):
+        metrics_server = application.bot_data.pop('metrics_server', None)
+        if metrics_server is not None:
+            metrics_server.close()
+
+    async def stop_workers(application: Application):
+        await asyncio.to_thread(dispatcher.stop)
+
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(serve_metrics)
+        .post_stop(stop_metrics)
+        .post_shutdown(stop_workers)
+    )
+    if TELEGRAM_API_URL:
+        builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, dispatcher.dispatch))
+    return application
+
+
+async def run_bots(applications):
+    """Запускает несколько ботов на одном event loop и работает до SIGINT или SIGTERM.
+
+    Порядок запуска и остановки каждого бота тот же, что в Application.run_polling,
+    но пул HTTP-соединений общий, поэтому приложения закрываются только после
+    остановки всех ботов.
+    """
+    loop = asyncio.get_running_loop()
+    stop_requested = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_requested.set)
+
+    started = []
+    webhook_routes = []
+    webhook_server = None
+    try:
+        for application in applications:
+            course = application.bot_data['course']
+            await application.initialize()
+            started.append(application)
+            await application.post_init(application)
+            if BOT_MODE == 'webhook':
+                # Боты делят один порт (на Railway доступен только PORT); путь webhook содержит имя бота
+                url_path = f"{WEBHOOK_PATH.strip('/')}/{course.name}".strip('/')
+                options = get_webhook_options(url_path, WEBHOOK_PORT)
+                await application.bot.set_webhook(
+                    options['webhook_url'], secret_token=options['secret_token'],
+                    max_connections=options['max_connections'],
+                )
+                webhook_routes.append((url_path, application))
+                logger.info("Бот %s ожидает обновлений на %s:%s/%s", course.name, WEBHOOK_LISTEN,
+                            WEBHOOK_PORT, url_path)
+            else:
+                await application.updater.start_polling()
+                logger.info("Бот %s ожидает сообщений", course.name)
+            await application.start()
+        if webhook_routes:
+            webhook_server = build_webhook_server(webhook_routes)
+            webhook_server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+        logger.info("Ботов запущено: %d", len(applications))
+        await stop_requested.wait()
+    finally:
+        if webhook_server is not None:
+            webhook_server.stop()
+        for application in started:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.post_stop(application)
+        for application in started:
+            await application.shutdown()
+            await application.post_shutdown(application)
 
 
 def main():
     """Основная функция запуска бота"""
     logger.info("Запуск бота...")
 
-    if not BOT_TOKEN or BOT_TOKEN == 'YOUR_BOT_TOKEN':
-        logger.error("Токен бота не установлен! Замените YOUR_BOT_TOKEN на реальный токен.")
-        return
+    try:
+        configs = load_bot_configs()
+    except (OSError, ValueError) as e:
+        logger.error("Не удалось прочитать BOTS_CONFIG: %s", e)
+        sys.exit(1)
+
+    missing = [config['name'] for config in configs if not config['token'] or config['token'] == 'YOUR_BOT_TOKEN']
+    if missing:
+        logger.error("BOT_TOKEN не установлен! Боты без токена: %s", ', '.join(missing))
+        sys.exit(1)
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        # Без публичного адреса PTB зарегистрировал бы в Telegram адрес вида http://0.0.0.0:порт/путь
+        logger.error("WEBHOOK_URL не установлен! Он обязателен при BOT_MODE=webhook")
+        sys.exit(1)
+    if len(configs) > 1 and WORKERS > 1:
+        logger.error("WORKERS > 1 поддерживается только для одного бота, в BOTS_CONFIG ботов: %d", len(configs))
+        sys.exit(1)
 
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
-
-        # Регистрация обработчиков команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("start_test", start_test))
-        application.add_handler(CommandHandler("my_mistakes", show_mistakes))
-
-        # Регистрация обработчиков callback'ов
-        application.add_handler(CallbackQueryHandler(handle_answer_selection, pattern="^select_"))
-        application.add_handler(CallbackQueryHandler(handle_answer_submission, pattern="^submit_answers$"))
-        application.add_handler(CallbackQueryHandler(next_question, pattern="^next_question$"))
-        application.add_handler(CallbackQueryHandler(finish_test_now, pattern="^finish_test_now$"))
-        application.add_handler(CallbackQueryHandler(finish_mistakes_practice, pattern="^finish_mistakes_practice$"))
-        application.add_handler(CallbackQueryHandler(handle_end_test, pattern="^end_test$"))
-        application.add_handler(CallbackQueryHandler(confirm_end_test, pattern="^confirm_end_test$"))
-        application.add_handler(CallbackQueryHandler(continue_test, pattern="^continue_test$"))
-        application.add_handler(CallbackQueryHandler(handle_mistakes_actions,
-                                                     pattern="^(view_mistakes|restart_test|practice_mistakes|end_mistakes_session)$"))
+        if len(configs) > 1:
+            # Боты делят event loop и пулы соединений: общий для запросов и отдельный для long polling
+            courses = create_courses(configs)
+            request = HTTPXRequest(connection_pool_size=HTTP_POOL_SIZE)
+            get_updates_request = HTTPXRequest(connection_pool_size=len(courses))
+            applications = [
+                build_application(course, serve_metrics=index == 0, request=request,
+                                  get_updates_request=get_updates_request)
+                for index, course in enumerate(courses)
+            ]
+            if BOT_MODE not in ('polling', 'webhook'):
+                logger.warning("Неизвестный режим BOT_MODE=%s, используется polling", BOT_MODE)
+            asyncio.run(run_bots(applications))
+            return
+
+        if WORKERS > 1:
+            if configs[0]['sessions'] == ':memory:':
+                logger.warning("SESSION_DB_PATH=:memory: не общий для обработчиков, сессии не переживут перезапуск")
+            dispatcher = ShardDispatcher(WORKERS)
+            dispatcher.start()
+            application = build_dispatcher_application(dispatcher, configs[0]['token'])
+        else:
+            application = build_application(create_courses(configs)[0])
 
         # Запуск бота
-        logger.info("Бот успешно запущен и ожидает сообщений...")
-        application.run_polling()
+        if BOT_MODE == 'webhook':
+            run_webhook(application)
+        else:
+            if BOT_MODE != 'polling':
+                logger.warning("Неизвестный режим BOT_MODE=%s, используется polling", BOT_MODE)
+            logger.info("Бот успешно запущен и ожидает сообщений...")
+            application.run_polling()
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}")
+    except Exception:
+        logger.exception("Критическая ошибка при запуске бота")
     finally:
         logger.info("Бот остановлен")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,175 @@
+"""Метрики бота в текстовом формате Prometheus без внешних зависимостей.
+
+Счетчики и гистограммы обновляются на event loop без блокировок: запись в
+словарь и список стоит доли микросекунды. Значения для датчиков считываются
+функциями только в момент запроса /metrics.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_TIMEOUT = 5.0
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Счетчик без меток виден в выдаче сразу, со значением 0
+        self._values = {} if self.labelnames else {(): 0}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """Датчик, значения которого вычисляются функциями при каждом запросе метрик"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._functions = {}  # метки -> функция значения
+        if function is not None:
+            self._functions[()] = function
+
+    def track(self, function, *labels):
+        """Задает функцию значения датчика для набора меток"""
+        self._functions[labels] = function
+
+    def collect(self):
+        for labels, function in self._functions.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {function()}"
+
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счетчики по корзинам (не накопленные), сумма, количество]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, function, extra_labels=None):
+        """Декоратор корутины: длительность вызова пишется с меткой по имени функции.
+
+        extra_labels(*args, **kwargs) возвращает значения остальных меток по аргументам вызова.
+        """
+        label = function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            labels = (label,) + extra_labels(*args, **kwargs) if extra_labels else (label,)
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - started, *labels)
+
+        return wrapper
+
+    def collect(self):
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames + ('le',), labels + (bound,))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            series_labels = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{series_labels} {total}"
+            yield f"{self.name}_count{series_labels} {count}"
+
+
+class MetricsRegistry:
+    """Набор метрик и HTTP-сервер для их выдачи"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, function=None, labelnames=()):
+        return self._register(Gauge(name, documentation, function, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Возвращает все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host, port):
+        """Запускает HTTP-сервер, отдающий метрики по GET /metrics"""
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+        return server
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # Заголовки запроса не нужны, но их нужно дочитать
+            while await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,446 @@
+"""Банк вопросов: проверка исходников, компиляция в бинарный файл и загрузка через mmap.
+
+Исходник банка — JSON (список объектов с полями id, question, options,
+correct_answers) или CSV с теми же колонками, где варианты и правильные
+ответы разделены символом «|».
+
+Компиляция:
+
+    python question_bank.py compile questions.json questions.bank
+
+Бинарный файл (little-endian, каждая секция выровнена на 8 байт):
+
+    заголовок            magic, версия формата, число вопросов и строк, версия банка
+    string_offsets       u32 × (строк + 1) — смещения строк в string_data
+    string_data          UTF-8 тексты всех уникальных строк подряд
+    ids                  u32 × вопросов — id вопросов по возрастанию; позиция id здесь — его слот
+    question_strings     u32 × вопросов — индекс текста вопроса слота
+    option_offsets       u32 × (вопросов + 1) — границы вариантов слота в option_strings
+    option_strings       u32 × вариантов — индексы текстов вариантов
+    correct_masks        u64 × вопросов — бит i установлен, если вариант i правильный
+    fingerprints         u64 × вопросов — отпечаток содержимого вопроса
+
+id вопроса стабилен между версиями банка: новые вопросы получают новые id,
+id удаленных больше не используются, а исправленный вопрос сохраняет id и
+меняет отпечаток. По отпечаткам новая версия банка и кеши отличают
+измененные вопросы от неизменных. Размер файла зависит только от числа
+вопросов, а не от величины id: слот находится двоичным поиском по ids.
+"""
+import argparse
+import bisect
+import csv
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'QBNK'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('<4sHHII16s')
+
+# Маска правильных ответов хранится в u64
+MAX_OPTIONS = 64
+# Подписи кнопок длиннее этого обрезаются клиентами Telegram
+MAX_BUTTON_LABEL_LENGTH = 64
+# Предел длины текста сообщения в Telegram; к вопросу добавляются служебные строки
+MAX_QUESTION_LENGTH = 3500
+# id хранятся в u32
+MAX_QUESTION_ID = 0xFFFFFFFF
+
+CSV_LIST_SEPARATOR = '|'
+
+
+class BankValidationError(Exception):
+    """Исходник банка содержит ошибки"""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} ошибок в банке вопросов")
+        self.errors = errors
+
+
+def read_source(path):
+    """Читает записи банка из JSON или CSV"""
+    if path.endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as file:
+            return [
+                {
+                    'id': int(row['id']),
+                    'question': row['question'],
+                    'options': [option.strip() for option in row['options'].split(CSV_LIST_SEPARATOR)],
+                    'correct_answers': [answer.strip() for answer in row['correct_answers'].split(CSV_LIST_SEPARATOR)],
+                }
+                for row in csv.DictReader(file)
+            ]
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def normalize_text(text):
+    """Приводит текст к виду для поиска почти одинаковых вопросов"""
+    return re.sub(r'[\W_]+', ' ', text.casefold().replace('ё', 'е')).strip()
+
+
+def validate_records(records, max_label_length=MAX_BUTTON_LABEL_LENGTH):
+    """Проверяет записи банка и возвращает (ошибки, предупреждения)"""
+    errors = []
+    warnings = []
+    ids_seen = set()
+    texts_seen = {}
+
+    for position, record in enumerate(records):
+        question_id = record.get('id')
+        where = f"запись {position} (id={question_id})"
+        if not isinstance(question_id, int) or isinstance(question_id, bool) or question_id < 0:
+            errors.append(f"{where}: id должен быть неотрицательным целым числом")
+        elif question_id > MAX_QUESTION_ID:
+            errors.append(f"{where}: id должен быть не больше {MAX_QUESTION_ID}")
+        elif question_id in ids_seen:
+            errors.append(f"{where}: id повторяется")
+        else:
+            ids_seen.add(question_id)
+
+        question = record.get('question')
+        options = record.get('options')
+        correct_answers = record.get('correct_answers')
+        if not isinstance(question, str) or not question.strip():
+            errors.append(f"{where}: пустой текст вопроса")
+            continue
+        if len(question) > MAX_QUESTION_LENGTH:
+            errors.append(f"{where}: текст вопроса длиннее {MAX_QUESTION_LENGTH} символов")
+
+        key = normalize_text(question)
+        if key in texts_seen:
+            other = texts_seen[key]
+            kind = "повторяет" if records[other]['question'] == question else "почти совпадает с"
+            errors.append(f"{where}: вопрос {kind} записью {other}")
+        else:
+            texts_seen[key] = position
+
+        if not isinstance(options, list) or not options:
+            errors.append(f"{where}: нет вариантов ответа")
+            continue
+        if len(options) > MAX_OPTIONS:
+            errors.append(f"{where}: больше {MAX_OPTIONS} вариантов ответа")
+        if len(set(options)) != len(options):
+            errors.append(f"{where}: варианты ответа повторяются")
+        for option in options:
+            if not isinstance(option, str) or not option.strip():
+                errors.append(f"{where}: пустой вариант ответа")
+            elif len(option) > max_label_length:
+                warnings.append(f"{where}: подпись кнопки длиннее {max_label_length} символов: {option!r}")
+
+        if not isinstance(correct_answers, list) or not correct_answers:
+            errors.append(f"{where}: не указаны правильные ответы")
+            continue
+        for answer in correct_answers:
+            if answer not in options:
+                errors.append(f"{where}: правильного ответа {answer!r} нет среди вариантов")
+
+    return errors, warnings
+
+
+def question_fingerprint(question, options, correct_mask):
+    """Отпечаток содержимого вопроса, всегда ненулевой"""
+    digest = hashlib.blake2b(
+        json.dumps([question, options, correct_mask], ensure_ascii=False).encode('utf-8'), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+def _pad(buffer):
+    buffer.extend(bytes(-len(buffer) % 8))
+
+
+def compile_records(records):
+    """Собирает бинарный банк из проверенных записей"""
+    strings = {}
+
+    def string_index(text):
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(strings)
+        return index
+
+    ordered = sorted(records, key=lambda record: record['id'])
+    ids = array('I', (record['id'] for record in ordered))
+    question_strings = array('I')
+    option_offsets = array('I', [0])
+    option_strings = array('I')
+    correct_masks = array('Q')
+    fingerprints = array('Q')
+    for record in ordered:
+        question_strings.append(string_index(record['question']))
+        answers = set(record['correct_answers'])
+        mask = 0
+        for index, option in enumerate(record['options']):
+            option_strings.append(string_index(option))
+            if option in answers:
+                mask |= 1 << index
+        option_offsets.append(len(option_strings))
+        correct_masks.append(mask)
+        fingerprints.append(question_fingerprint(record['question'], record['options'], mask))
+
+    string_offsets = array('I', [0])
+    string_data = bytearray()
+    for text in strings:
+        string_data.extend(text.encode('utf-8'))
+        string_offsets.append(len(string_data))
+
+    body = bytearray()
+    for section in (string_offsets, string_data, ids,
+                    question_strings, option_offsets, option_strings, correct_masks, fingerprints):
+        body.extend(section if isinstance(section, bytearray) else section.tobytes())
+        _pad(body)
+
+    # Отпечаток содержимого: сохраненные сессии действительны только для той же версии банка
+    version = hashlib.sha1(body).hexdigest()[:16].encode('ascii')
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ids), len(strings), version)
+    return header + bytes(-len(header) % 8) + body
+
+
+def _find_slot(ids, question_id):
+    """Возвращает позицию id в отсортированном столбце ids или None"""
+    # В банке без пропусков id совпадает со слотом, иначе — двоичный поиск
+    if 0 <= question_id < len(ids) and ids[question_id] == question_id:
+        return question_id
+    slot = bisect.bisect_left(ids, question_id)
+    if slot < len(ids) and ids[slot] == question_id:
+        return slot
+    return None
+
+
+def _slot_of(ids, question_id):
+    slot = _find_slot(ids, question_id)
+    if slot is None:
+        raise KeyError(question_id)
+    return slot
+
+
+class _IdColumn:
+    """Доступ к столбцу банка, упорядоченному по слотам, по id вопроса"""
+
+    __slots__ = ('_ids', '_values')
+
+    def __init__(self, ids, values):
+        self._ids = ids
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, question_id):
+        ids = self._ids
+        # Быстрый путь банка без пропусков; отрицательный id не совпадет ни с одним u32
+        if question_id < len(ids) and ids[question_id] == question_id:
+            return self._values[question_id]
+        return self._values[_slot_of(ids, question_id)]
+
+
+class _LazyColumn:
+    """Столбец банка, значения которого декодируются при первом обращении"""
+
+    __slots__ = ('_load', '_values')
+
+    def __init__(self, size, load):
+        self._load = load
+        self._values = [None] * size
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        value = self._values[index]
+        if value is None:
+            value = self._values[index] = self._load(index)
+        return value
+
+    def adopt(self, index, other, other_index):
+        """Берет значение из столбца другой версии банка, если оно уже декодировано"""
+        self._values[index] = other._values[other_index]
+
+
+class QuestionBank:
+    """Неизменяемый банк вопросов поверх скомпилированного бинарного файла.
+
+    Массивы смещений и масок читаются прямо из буфера, а тексты декодируются
+    и интернируются при первом обращении, поэтому загрузка не зависит от
+    размера банка. Сессии пользователей ссылаются на вопросы только по id;
+    столбцы индексируются по id, а слот id находится двоичным поиском.
+    """
+
+    __slots__ = (
+        'ids', 'questions', 'options', 'correct_answers', 'correct_masks', 'fingerprints', 'version',
+        '_fingerprints', '_text_columns', '_buffer',
+        '__weakref__',
+    )
+
+    def __init__(self, buffer):
+        if sys.byteorder != 'little':
+            raise ValueError("Бинарный банк поддерживается только на little-endian платформах")
+        view = memoryview(buffer)
+        magic, format_version, _, question_count, string_count, version = HEADER.unpack_from(view)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError("Неизвестный формат банка вопросов")
+        # Каждый вопрос занимает в файле не меньше 28 байт; иначе заголовок поврежден
+        if 28 * question_count > len(view):
+            raise ValueError("Число вопросов в заголовке банка не соответствует размеру файла")
+
+        offset = HEADER.size + (-HEADER.size % 8)
+
+        def section(size, typecode=None):
+            nonlocal offset
+            data = view[offset:offset + size]
+            offset += size + (-size % 8)
+            return data.cast(typecode) if typecode else data
+
+        string_offsets = section(4 * (string_count + 1), 'I')
+        string_data = section(string_offsets[-1])
+        self.ids = section(4 * question_count, 'I')
+        question_strings = section(4 * question_count, 'I')
+        option_offsets = section(4 * (question_count + 1), 'I')
+        option_strings = section(4 * option_offsets[-1], 'I')
+        correct_masks = section(8 * question_count, 'Q')
+        self._fingerprints = section(8 * question_count, 'Q')
+        self.correct_masks = _IdColumn(self.ids, correct_masks)
+        self.fingerprints = _IdColumn(self.ids, self._fingerprints)
+        self.version = version.decode('ascii')
+        self._buffer = buffer
+
+        strings = _LazyColumn(
+            string_count,
+            lambda index: sys.intern(str(string_data[string_offsets[index]:string_offsets[index + 1]], 'utf-8')),
+        )
+
+        def load_question(slot):
+            return strings[question_strings[slot]]
+
+        def load_options(slot):
+            return tuple(strings[index] for index in option_strings[option_offsets[slot]:option_offsets[slot + 1]])
+
+        def load_correct_answers(slot):
+            mask = correct_masks[slot]
+            return tuple(option for index, option in enumerate(options[slot]) if mask >> index & 1)
+
+        questions = _LazyColumn(question_count, load_question)
+        options = _LazyColumn(question_count, load_options)
+        correct_answers = _LazyColumn(question_count, load_correct_answers)
+        self._text_columns = (questions, options, correct_answers)
+        self.questions = _IdColumn(self.ids, questions)
+        self.options = _IdColumn(self.ids, options)
+        self.correct_answers = _IdColumn(self.ids, correct_answers)
+
+    @classmethod
+    def from_records(cls, records):
+        """Проверяет и компилирует записи в памяти"""
+        errors, _ = validate_records(records)
+        if errors:
+            raise BankValidationError(errors)
+        return cls(compile_records(records))
+
+    @classmethod
+    def open(cls, path):
+        """Отображает скомпилированный банк в память"""
+        with open(path, 'rb') as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        """Число вопросов"""
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return _find_slot(self.ids, question_id) is not None
+
+    def inherit(self, previous):
+        """Переносит уже декодированные тексты неизмененных вопросов из предыдущей версии.
+
+        Возвращает id вопросов, которые добавлены или изменены по сравнению с ней.
+        """
+        changed = []
+        for slot, question_id in enumerate(self.ids):
+            previous_slot = _find_slot(previous.ids, question_id)
+            if previous_slot is not None and self._fingerprints[slot] == previous._fingerprints[previous_slot]:
+                for column, previous_column in zip(self._text_columns, previous._text_columns):
+                    column.adopt(slot, previous_column, previous_slot)
+            else:
+                changed.append(question_id)
+        return changed
+
+    def format_options(self, question_id, mask):
+        """Возвращает через запятую тексты вариантов, отмеченных в маске"""
+        return ", ".join(
+            option for index, option in enumerate(self.options[question_id]) if mask >> index & 1
+        )
+
+
+def load_question_bank(bank_path, source_path):
+    """Загружает скомпилированный банк, а если его нет или он устарел — компилирует исходник"""
+    started = time.perf_counter()
+    bank = None
+    if os.path.exists(bank_path) and not (
+        os.path.exists(source_path) and os.path.getmtime(source_path) > os.path.getmtime(bank_path)
+    ):
+        try:
+            bank = QuestionBank.open(bank_path)
+            origin = bank_path
+        except ValueError as e:
+            logger.warning("Не удалось открыть банк %s: %s", bank_path, e)
+    if bank is None:
+        logger.warning("Скомпилированный банк %s отсутствует или устарел, компилируется %s", bank_path, source_path)
+        bank = QuestionBank.from_records(read_source(source_path))
+        origin = source_path
+    logger.info(
+        "Банк вопросов %s загружен из %s: %d вопросов за %.1f мс",
+        bank.version, origin, len(bank.ids), (time.perf_counter() - started) * 1000,
+    )
+    return bank
+
+
+def compile_command(args):
+    """Проверяет исходник и записывает бинарный банк"""
+    started = time.perf_counter()
+    records = read_source(args.source)
+    errors, warnings = validate_records(records, args.max_label_length)
+    for warning in warnings:
+        print(f"предупреждение: {warning}", file=sys.stderr)
+    for error in errors:
+        print(f"ошибка: {error}", file=sys.stderr)
+    if errors or (args.strict and warnings):
+        return 1
+
+    data = compile_records(records)
+    temporary_path = args.output + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(data)
+    # Замена целиком: запущенный бот продолжает читать старый файл через свое отображение
+    os.replace(temporary_path, args.output)
+
+    bank = QuestionBank(data)
+    print(
+        f"{args.output}: {len(bank.ids)} вопросов, {len(data)} байт, версия {bank.version}, "
+        f"предупреждений {len(warnings)}, {(time.perf_counter() - started) * 1000:.1f} мс"
+    )
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Компилятор банка вопросов")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compile_parser = subparsers.add_parser('compile', help="проверить исходник и собрать бинарный банк")
+    compile_parser.add_argument('source', help="JSON или CSV с вопросами")
+    compile_parser.add_argument('output', help="путь к бинарному банку")
+    compile_parser.add_argument('--max-label-length', type=int, default=MAX_BUTTON_LABEL_LENGTH)
+    compile_parser.add_argument('--strict', action='store_true', help="считать предупреждения ошибками")
+    args = parser.parse_args(argv)
+    return compile_command(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+"""Общая подготовка тестов: путь к модулям бота и окружение до импорта bot"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# bot читает настройки при импорте: сессии держим в памяти, а лог — без INFO
+os.environ['SESSION_DB_PATH'] = ':memory:'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
@@ -0,0 +1,137 @@
+"""Версии банка вопросов: освобождение после перезагрузок и переход сессий на новую версию"""
+import asyncio
+import gc
+import json
+import os
+
+import pytest
+
+import bot
+
+
+def write_source(path, revision, ids=range(20)):
+    records = [
+        {
+            'id': question_id,
+            'question': f"Вопрос {question_id}, редакция {revision}",
+            'options': ["Да", "Нет", "Не знаю"],
+            'correct_answers': ["Да"],
+        }
+        for question_id in ids
+    ]
+    with open(path, 'w', encoding='utf-8') as source_file:
+        json.dump(records, source_file, ensure_ascii=False)
+    # Время изменения должно отличаться от прошлой редакции
+    os.utime(path, ns=(revision * 10**9, revision * 10**9))
+
+
+def make_course(tmp_path, revision=1, ids=range(20)):
+    source_path = str(tmp_path / 'questions.json')
+    write_source(source_path, revision, ids)
+    banks = bot.BankRegistry.load(str(tmp_path / 'questions.bank'), source_path)
+    return bot.CourseBot('versions', 'token', banks, str(tmp_path / 'sessions.db')), source_path
+
+
+def test_reloads_keep_only_versions_in_use(tmp_path):
+    course, source_path = make_course(tmp_path)
+    first = course.banks.current.version
+    # Пользователь 1 проходит тест на первой версии, пользователь 2 начинает заново после каждой перезагрузки
+    bot.start_new_test(course, 1).get_current_question()
+
+    async def reload_five_times():
+        for revision in range(2, 7):
+            write_source(source_path, revision)
+            assert await bot.reload_question_bank(course)
+            bot.start_new_test(course, 2)
+
+    asyncio.run(reload_five_times())
+    current = course.banks.current.version
+    # Версия, на которой пользователь 2 был во время последней перезагрузки, освобождается при следующей проверке
+    assert len(course.banks.versions) == 3
+    course.sessions.release_unused_banks()
+    assert set(course.banks.versions) == {first, current}
+
+    # Новый тест переводит пользователя 1 на текущую версию, и первая становится не нужна
+    bot.start_new_test(course, 1)
+    assert course.sessions.release_unused_banks() == [first]
+    assert set(course.banks.versions) == {current}
+    gc.collect()
+    assert first not in bot.shared_banks
+    assert current in bot.shared_banks
+    course.sessions.close()
+
+
+def test_spilled_sessions_keep_their_version(tmp_path):
+    course, source_path = make_course(tmp_path)
+    first = course.banks.current.version
+    progress = bot.start_new_test(course, 1)
+    question_id = progress.get_current_question()
+    # Вытесненная из памяти, но еще не записанная сессия
+    course.sessions._evict(1, 'evicted_size')
+    del progress
+
+    write_source(source_path, 2)
+    asyncio.run(bot.reload_question_bank(course))
+    assert first in course.banks.versions
+
+    restored = course.sessions.get(1)
+    assert restored.bank.version == first
+    assert restored.current_question_id == question_id
+
+    # Записанная в базу сессия освободившейся версии при загрузке переходит на текущую с тем же билетом
+    seed = restored.seed
+    course.sessions._evict(1, 'evicted_size')
+    asyncio.run(course.sessions.flush())
+    del restored
+    assert course.sessions.release_unused_banks() == [first]
+    migrated = course.sessions.get(1)
+    assert migrated.bank is course.banks.current
+    assert (migrated.seed, migrated.current_question_id) == (seed, question_id)
+    course.sessions.close()
+
+
+def answer_some(progress, count):
+    """Отвечает на count вопросов, ошибаясь в каждом втором; возвращает показанные id"""
+    shown = []
+    for step in range(count):
+        question_id = progress.get_current_question()
+        shown.append(question_id)
+        if step % 2:
+            progress.handle_incorrect_answer(question_id, 2)
+        else:
+            progress.handle_correct_answer(question_id)
+    return shown
+
+
+@pytest.mark.parametrize('exam_size, new_ids, kept', [
+    (0, range(25), True),  # весь банк: добавлены вопросы
+    (0, range(19), False),  # весь банк: удален вопрос билета
+    (5, None, True),  # выборка: удалены только вопросы вне билета
+])
+def test_ticket_survives_restart_while_its_questions_exist(tmp_path, monkeypatch, exam_size, new_ids, kept):
+    monkeypatch.setattr(bot, 'EXAM_SIZE', exam_size)
+    course, _ = make_course(tmp_path)
+    progress = bot.start_new_test(course, 1)
+    shown = answer_some(progress, 3)
+    remaining = [progress.get_ticket_question(position) for position in range(progress.ticket_size)]
+    state = (progress.seed, progress.score, progress.cursor, dict(progress.mistakes))
+    asyncio.run(course.sessions.flush())
+    course.sessions.close()
+
+    # Перезапуск с перекомпилированным банком: тексты изменены, старой версии в памяти нет
+    if new_ids is None:
+        new_ids = [question_id for question_id in range(20) if question_id not in remaining][1:] + remaining
+    restarted, _ = make_course(tmp_path, 2, new_ids)
+    assert restarted.banks.current.version != course.banks.current.version
+    restored = restarted.sessions.get(1)
+    assert restored.bank is restarted.banks.current
+    if not kept:
+        assert (restored.score, restored.cursor, restored.mistakes) == (0, 0, {})
+        restarted.sessions.close()
+        return
+    assert (restored.seed, restored.score, restored.cursor, restored.mistakes) == state
+    assert [restored.get_ticket_question(position) for position in range(restored.ticket_size)] == remaining
+    # Тест продолжается: уже показанные вопросы первого прохода не повторяются
+    rest = answer_some(restored, restored.ticket_size - len(shown))
+    assert sorted(shown + rest) == sorted(remaining)
+    restarted.sessions.close()
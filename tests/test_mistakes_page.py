@@ -0,0 +1,67 @@
+"""Страница ошибок укладывается в лимит сообщения Telegram"""
+import time
+
+import pytest
+
+import bot
+from question_bank import QuestionBank
+
+
+def make_progress(question_texts):
+    records = [
+        {'id': question_id, 'question': text, 'options': ["Да 🩺", "Нет"], 'correct_answers': ["Да 🩺"]}
+        for question_id, text in enumerate(question_texts)
+    ]
+    progress = bot.UserProgress(bot.BankRegistry(QuestionBank.from_records(records)))
+    for question_id in range(len(records)):
+        progress.mistakes[question_id] = 2
+    return progress
+
+
+@pytest.mark.parametrize('filler', ['а', '🩺'])
+def test_long_page_fits_in_utf16_limit(filler):
+    # Символы вне BMP занимают в UTF-16 по две единицы
+    progress = make_progress([f"{index}: " + filler * 3000 for index in range(bot.MISTAKES_PAGE_SIZE)])
+    text, _ = bot.build_mistakes_page(progress, 0)
+    assert bot.utf16_length(text) <= bot.MAX_MESSAGE_LENGTH
+    assert text.count('Вопрос:') == bot.MISTAKES_PAGE_SIZE
+
+
+def test_short_page_is_not_shortened():
+    progress = make_progress(["Короткий вопрос", "Еще один"])
+    text, _ = bot.build_mistakes_page(progress, 0)
+    assert '…' not in text
+    assert "Короткий вопрос" in text
+
+
+def test_shorten_does_not_split_surrogate_pairs():
+    shortened = bot.shorten('🩺' * 10, 6)
+    assert shortened == '🩺' * 2 + '…'
+    assert bot.utf16_length(shortened) <= 6
+
+
+def button_data(reply_markup):
+    return [button.callback_data for row in reply_markup.inline_keyboard for button in row]
+
+
+def test_page_offers_practice_only_when_reviews_are_due():
+    progress = make_progress(["Первый", "Второй"])
+    _, reply_markup = bot.build_mistakes_page(progress, 0)
+    assert bot.CB_PRACTICE not in button_data(reply_markup)
+
+    progress.review_deck.add(0, time.time())
+    _, reply_markup = bot.build_mistakes_page(progress, 0)
+    assert bot.CB_PRACTICE in button_data(reply_markup)
+
+
+def test_clean_test_still_offers_due_reviews_from_earlier_tests():
+    progress = make_progress(["Первый", "Второй"])
+    progress.mistakes.clear()
+    text, reply_markup = bot.build_no_mistakes_screen(progress)
+    assert reply_markup is None
+    assert "нет ошибок" in text
+
+    progress.review_deck.add(1, time.time())
+    text, reply_markup = bot.build_no_mistakes_screen(progress)
+    assert bot.CB_PRACTICE in button_data(reply_markup)
+    assert text.endswith(": 1")
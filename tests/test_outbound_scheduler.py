@@ -0,0 +1,163 @@
+"""OutboundScheduler: RetryAfter, предохранитель и приоритеты"""
+import asyncio
+import time
+
+import pytest
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+import bot
+
+RETRY_AFTER = 0.3
+
+
+def make_scheduler():
+    return bot.OutboundScheduler('test', 1000, 1000, 1000, 3, 5, 30)
+
+
+def limited_once():
+    """Запрос, который первый раз получает RetryAfter"""
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(RETRY_AFTER)
+        return True
+
+    return callback, calls
+
+
+async def send(scheduler, callback, endpoint, data, priority=None):
+    return await scheduler.process_request(callback, (), {}, endpoint, data, priority)
+
+
+def test_retry_after_on_unlimited_method_does_not_pause_other_chats():
+    async def run():
+        scheduler = make_scheduler()
+        answer, answer_calls = limited_once()
+        answered = asyncio.create_task(send(scheduler, answer, 'answerCallbackQuery', {'callback_query_id': '1'}))
+        await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        assert await send(scheduler, lambda: asyncio.sleep(0, True), 'editMessageText', {'chat_id': 2})
+        edit_delay = time.monotonic() - started
+        assert await answered
+        return edit_delay, answer_calls
+
+    edit_delay, answer_calls = asyncio.run(run())
+    assert edit_delay < RETRY_AFTER / 2
+    assert len(answer_calls) == 2
+    assert answer_calls[1] - answer_calls[0] >= RETRY_AFTER
+
+
+def test_retry_after_pauses_only_the_chat():
+    async def run():
+        scheduler = make_scheduler()
+        edit, edit_calls = limited_once()
+        first = asyncio.create_task(send(scheduler, edit, 'editMessageText', {'chat_id': 1}))
+        await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        await send(scheduler, lambda: asyncio.sleep(0, True), 'editMessageText', {'chat_id': 2})
+        other_chat_delay = time.monotonic() - started
+        started = time.monotonic()
+        await send(scheduler, lambda: asyncio.sleep(0, True), 'editMessageText', {'chat_id': 1})
+        same_chat_delay = time.monotonic() - started
+        await first
+        return other_chat_delay, same_chat_delay
+
+    other_chat_delay, same_chat_delay = asyncio.run(run())
+    assert other_chat_delay < RETRY_AFTER / 2
+    assert same_chat_delay >= RETRY_AFTER * 0.8
+
+
+def test_retry_after_without_chat_pauses_all_limited_requests():
+    async def run():
+        scheduler = make_scheduler()
+        broadcast, _ = limited_once()
+        first = asyncio.create_task(send(scheduler, broadcast, 'sendMediaGroup', {}))
+        await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        await send(scheduler, lambda: asyncio.sleep(0, True), 'editMessageText', {'chat_id': 2})
+        delay = time.monotonic() - started
+        await first
+        return delay
+
+    assert asyncio.run(run()) >= RETRY_AFTER * 0.8
+
+
+BREAKER_COOLDOWN = 0.05
+
+
+async def open_breaker():
+    """Размыкает предохранитель двумя сетевыми ошибками и ждет конца паузы"""
+    scheduler = bot.OutboundScheduler('test', 1000, 1000, 1000, 0, 2, BREAKER_COOLDOWN)
+
+    async def unreachable():
+        raise NetworkError("connection refused")
+
+    for _ in range(2):
+        with pytest.raises(NetworkError):
+            await send(scheduler, unreachable, 'sendMessage', {'chat_id': 1})
+    with pytest.raises(NetworkError, match="предохранителем"):
+        await send(scheduler, lambda: asyncio.sleep(0, True), 'sendMessage', {'chat_id': 1})
+    await asyncio.sleep(BREAKER_COOLDOWN * 1.5)
+    return scheduler
+
+
+def test_probe_answered_with_other_error_closes_breaker():
+    async def run():
+        scheduler = await open_breaker()
+
+        async def blocked():
+            raise Forbidden("Forbidden: bot was blocked by the user")
+
+        with pytest.raises(Forbidden):
+            await send(scheduler, blocked, 'sendMessage', {'chat_id': 1})
+        assert await send(scheduler, lambda: asyncio.sleep(0, True), 'sendMessage', {'chat_id': 2})
+
+    asyncio.run(run())
+
+
+def test_cancelled_probe_frees_the_next_probe():
+    async def run():
+        scheduler = await open_breaker()
+        probe = asyncio.create_task(send(scheduler, lambda: asyncio.sleep(60), 'sendMessage', {'chat_id': 1}))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert await send(scheduler, lambda: asyncio.sleep(0, True), 'sendMessage', {'chat_id': 2})
+
+    asyncio.run(run())
+
+
+def test_interactive_requests_overtake_bulk():
+    async def run():
+        # Общий лимит 20 в секунду: после первых 20 запросов остальные ждут в очереди
+        scheduler = bot.OutboundScheduler('test', 20, 1000, 1000, 0, 5, 30)
+        order = []
+
+        def request(label):
+            async def callback():
+                order.append(label)
+                return True
+            return callback
+
+        tasks = [
+            asyncio.create_task(send(scheduler, request('bulk'), 'editMessageText', {'chat_id': index}, bot.PRIORITY_BULK))
+            for index in range(30)
+        ]
+        await asyncio.sleep(0)
+        tasks += [
+            asyncio.create_task(send(scheduler, request('interactive'), 'sendMessage', {'chat_id': 100 + index}))
+            for index in range(5)
+        ]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    # Первые 20 массовых запросов ушли сразу; из ожидавших интерактивные идут первыми
+    assert order[:20] == ['bulk'] * 20
+    assert order[20:25] == ['interactive'] * 5
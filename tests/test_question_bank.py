@@ -0,0 +1,57 @@
+"""Проверка записей и заголовка банка вопросов"""
+import pytest
+
+from question_bank import HEADER, QuestionBank, compile_records, validate_records
+
+
+def make_records(ids):
+    return [
+        {'id': question_id, 'question': f"Вопрос {question_id}", 'options': ["Да", "Нет"], 'correct_answers': ["Да"]}
+        for question_id in ids
+    ]
+
+
+def test_sparse_ids_take_one_slot_per_question():
+    bank = QuestionBank.from_records(make_records([0, 5, 900]))
+    assert list(bank.ids) == [0, 5, 900]
+    assert len(bank) == 3
+    assert bank.questions[900] == "Вопрос 900"
+    assert 5 in bank and 6 not in bank
+
+
+def test_shrunk_bank_keeps_large_stable_ids():
+    # От банка в тысячи вопросов остались несколько с большими id
+    ids = [3, 70_000, 1_000_000_000]
+    data = compile_records(make_records(ids))
+    bank = QuestionBank(data)
+    assert len(data) < 1024
+    assert [bank.questions[question_id] for question_id in ids] == [f"Вопрос {question_id}" for question_id in ids]
+    assert bank.correct_answers[70_000] == ("Да",)
+    assert 4 not in bank
+    with pytest.raises(KeyError):
+        bank.options[4]
+
+
+def test_id_above_u32_is_rejected():
+    errors, _ = validate_records(make_records([0, 1, 2 ** 32]))
+    assert len(errors) == 1
+    assert "id должен быть не больше" in errors[0]
+
+
+def test_inherit_matches_questions_by_id():
+    previous = QuestionBank.from_records(make_records([1, 2, 3]))
+    options = previous.options[2]
+    records = make_records([2, 3, 50])
+    records[1]['question'] = "Исправленный вопрос 3"
+    bank = QuestionBank.from_records(records)
+    assert bank.inherit(previous) == [3, 50]
+    assert bank.options[2] is options
+
+
+def test_header_with_too_many_questions_is_rejected():
+    data = bytearray(compile_records(make_records(range(10))))
+    fields = list(HEADER.unpack_from(data))
+    fields[3] = 1_000_000_000
+    HEADER.pack_into(data, 0, *fields)
+    with pytest.raises(ValueError):
+        QuestionBank(bytes(data))
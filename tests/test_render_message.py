@@ -0,0 +1,74 @@
+"""Обработка «message is not modified» в render_message"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import bot
+
+NOT_MODIFIED = "Message is not modified: specified new message content and reply markup are exactly the same"
+
+
+class Bot:
+    def __init__(self, error):
+        self.error = error
+        self.edits = []
+
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None, rate_limit_args=None):
+        self.edits.append(('text', rate_limit_args))
+        if self.error is not None:
+            raise self.error
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None, rate_limit_args=None):
+        self.edits.append(('markup', rate_limit_args))
+        if self.error is not None:
+            raise self.error
+
+
+class Query:
+    def __init__(self, error):
+        self.message = SimpleNamespace(message_id=10, chat_id=5)
+        self.bot = Bot(error)
+
+    def get_bot(self):
+        return self.bot
+
+
+def markup(label):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data='x')]])
+
+
+def render(error, last_render, priority=bot.PRIORITY_INTERACTIVE):
+    query = Query(error)
+    update = SimpleNamespace(callback_query=query, message=None)
+    progress = SimpleNamespace(last_render=last_render)
+    asyncio.run(bot.render_message(update, progress, "Вопрос", markup("Новая"), priority))
+    return progress, query.bot.edits
+
+
+@pytest.mark.parametrize('last_render', [
+    None,  # редактируется текст
+    (10, hash("Вопрос"), hash(markup("Старая"))),  # текст тот же, редактируется только клавиатура
+])
+def test_not_modified_is_not_an_error(last_render):
+    before = bot.render_stats['not_modified']
+    progress, _ = render(BadRequest(NOT_MODIFIED), last_render)
+    assert bot.render_stats['not_modified'] == before + 1
+    assert progress.last_render == (10, hash("Вопрос"), hash(markup("Новая")))
+
+
+@pytest.mark.parametrize('last_render', [None, (10, hash("Вопрос"), hash(markup("Старая")))])
+def test_other_bad_requests_are_raised(last_render):
+    with pytest.raises(BadRequest):
+        render(BadRequest("Message to edit not found"), last_render)
+
+
+@pytest.mark.parametrize('last_render, kind', [
+    (None, 'text'),
+    ((10, hash("Вопрос"), hash(markup("Старая"))), 'markup'),
+])
+def test_priority_reaches_scheduler(last_render, kind):
+    _, edits = render(None, last_render, bot.PRIORITY_BULK)
+    assert edits == [(kind, bot.PRIORITY_BULK)]
@@ -0,0 +1,236 @@
+"""Кодирование и декодирование сессий UserProgress.
+
+Восстановленная сессия должна выбирать те же вопросы, в том же порядке
+вариантов и с теми же номерами ошибок, что и исходная.
+"""
+import json
+import random
+import time
+
+import pytest
+
+import bot
+from question_bank import QuestionBank
+
+BANK_SIZE = 40
+
+
+def make_banks(size=BANK_SIZE, variant=''):
+    records = [
+        {
+            'id': question_id,
+            'question': f"Вопрос {variant}{question_id}",
+            'options': [f"Вариант {index}" for index in range(3 + question_id % 4)],
+            'correct_answers': ["Вариант 0"] if question_id % 2 else ["Вариант 0", "Вариант 2"],
+        }
+        for question_id in range(size)
+    ]
+    return bot.BankRegistry(QuestionBank.from_records(records))
+
+
+@pytest.fixture(autouse=True)
+def frozen_clock(monkeypatch):
+    # Время повторений хранится с точностью до миллисекунды; при неподвижных часах
+    # порядок колоды не зависит от того, когда шел тест
+    monkeypatch.setattr(time, 'time', lambda: 1_700_000_000.0)
+    random.seed(7)
+
+
+@pytest.fixture
+def banks():
+    return make_banks()
+
+
+def round_trip(progress, banks):
+    return bot.UserProgress.from_bytes(progress.to_bytes(), banks)
+
+
+def answer(progress, correct):
+    question_id = progress.get_current_question()
+    if correct:
+        progress.handle_correct_answer(question_id)
+    else:
+        progress.handle_incorrect_answer(question_id, 1)
+
+
+def finish_test(progress):
+    """Проходит тест до конца, ошибаясь в каждом третьем вопросе"""
+    step = 0
+    while progress.get_current_question() is not None:
+        answer(progress, step % 3 != 0)
+        step += 1
+
+
+def assert_same_draws(original, restored, steps=2 * BANK_SIZE):
+    """Проводит обе сессии по одним и тем же ответам и сравнивает выбранные вопросы"""
+    for step in range(steps):
+        assert restored.get_current_question() == original.get_current_question()
+        assert restored.option_order == original.option_order
+        assert restored.current_slot == original.current_slot
+        assert restored.get_progress_text() == original.get_progress_text()
+        if original.current_question_id is None:
+            assert restored.is_test_complete() and original.is_test_complete()
+            return
+        correct = step % 3 != 0
+        answer(original, correct)
+        answer(restored, correct)
+
+
+def test_fresh_session(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+
+    restored = round_trip(progress, banks)
+    assert restored.seed == progress.seed
+    assert restored.ticket_size == BANK_SIZE
+    assert restored.bank is banks.current
+    assert_same_draws(progress, restored)
+
+
+def test_session_with_current_question(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    progress.get_current_question()
+    progress.toggle_answer_selection(1)
+
+    restored = round_trip(progress, banks)
+    assert restored.current_question_id == progress.current_question_id
+    assert restored.selected_mask == progress.selected_mask
+    assert_same_draws(progress, restored)
+
+
+def test_retry_pass(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    # Первый проход с ошибками, затем одна исправленная ошибка во втором
+    for step in range(BANK_SIZE):
+        answer(progress, step % 4 != 0)
+    answer(progress, True)
+    progress.get_current_question()
+    assert progress.pass_number > 0
+    assert progress.current_slot is not None
+    assert any(progress.fixed)
+
+    restored = round_trip(progress, banks)
+    assert restored.pass_number == progress.pass_number
+    assert restored.cursor == progress.cursor
+    assert restored.fixed == progress.fixed
+    assert restored.mistakes == progress.mistakes
+    assert_same_draws(progress, restored)
+
+
+def test_later_passes_draw_only_unfixed_mistakes(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    for _ in range(BANK_SIZE):
+        progress.handle_incorrect_answer(progress.get_current_question(), 1)
+    # Первый проход повторов: исправлены все ошибки, кроме двух
+    unfixed = []
+    while progress.get_current_question() is not None and progress.pass_number == 1:
+        if len(unfixed) < 2:
+            unfixed.append(progress.current_slot)
+            progress.handle_incorrect_answer(progress.current_question_id, 1)
+        else:
+            progress.handle_correct_answer(progress.current_question_id)
+    assert progress.pass_number == 2
+    assert sorted(progress.get_pass_slots()) == sorted(unfixed)
+    assert len(progress.get_pass_order()) == 2
+
+    progress.handle_correct_answer(progress.current_question_id)
+    progress.get_current_question()
+    restored = round_trip(progress, banks)
+    assert restored.pass_fixed == progress.pass_fixed
+    assert restored.get_pass_slots() == progress.get_pass_slots()
+    assert_same_draws(progress, restored)
+
+
+def test_format_2_restarts_retry_pass(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    for step in range(BANK_SIZE):
+        answer(progress, step % 4 != 0)
+    answer(progress, True)
+    progress.get_current_question()
+    assert progress.pass_number == 1 and progress.pass_fixed
+
+    # В формате 2 за битовой маской сразу идет колода повторения
+    data = progress.to_bytes()
+    deck = bytearray()
+    bot.write_varint(deck, len(progress.review_deck))
+    for question_id, (box, due) in progress.review_deck.cards.items():
+        for value in (question_id, box, int(due * 1000)):
+            bot.write_varint(deck, value)
+    pass_fixed = bytearray()
+    bot.write_varint(pass_fixed, len(progress.pass_fixed))
+    for index in progress.pass_fixed:
+        bot.write_varint(pass_fixed, index)
+    assert data.endswith(pass_fixed + deck)
+    legacy_data = b'\x02' + data[1:len(data) - len(pass_fixed) - len(deck)] + deck
+
+    legacy = bot.UserProgress.from_bytes(legacy_data, banks)
+    assert (legacy.pass_number, legacy.cursor, legacy.current_question_id) == (progress.pass_number, 0, None)
+    assert legacy.fixed == progress.fixed
+    unfixed = [index for index in range(len(progress.mistakes)) if not progress.is_fixed(index)]
+    assert sorted(legacy.get_pass_slots()) == unfixed
+    # Тест доходит до конца: каждая неисправленная ошибка выпадает снова
+    finish_test(legacy)
+    assert legacy.is_test_complete()
+
+
+def test_practice_mode(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    finish_test(progress)
+    assert progress.start_mistakes_practice()
+    answer(progress, True)
+    progress.get_current_question()
+
+    restored = round_trip(progress, banks)
+    assert restored.mistakes_practice_mode
+    assert restored.review_deck.to_state() == progress.review_deck.to_state()
+    assert (restored.practice_total, restored.practice_done) == (progress.practice_total, progress.practice_done)
+    assert_same_draws(progress, restored)
+
+
+def test_unknown_bank_version_migrates(banks):
+    progress = bot.UserProgress(banks)
+    progress.initialize_test()
+    for step in range(10):
+        answer(progress, step % 2 == 0)
+    progress.get_current_question()
+
+    # После перезапуска загружена только другая версия банка, в которой меньше вопросов
+    other = make_banks(BANK_SIZE // 2, variant='новый ')
+    migrated = bot.UserProgress.from_bytes(progress.to_bytes(), other)
+    assert migrated.bank is other.current
+    assert migrated.ticket_size == BANK_SIZE // 2
+    assert (migrated.score, migrated.pass_number, migrated.cursor) == (0, 0, 0)
+    assert migrated.mistakes == {}
+    assert migrated.current_question_id is None
+    assert all(question_id in other.current for question_id in migrated.review_deck.cards)
+    assert set(migrated.review_deck.cards) == {
+        question_id for question_id in progress.review_deck.cards if question_id < BANK_SIZE // 2
+    }
+
+    assert_same_draws(migrated, round_trip(migrated, other))
+
+
+@pytest.mark.parametrize('state', [
+    # Сессия до появления колоды повторения
+    {'bank': 'deadbeef', 'score': 3, 'attempts': 0, 'practice': False, 'mask': 0, 'current': None,
+     'mistakes': [[7, 1], [5, 2]], 'pending': [[], [], 0], 'practice_pool': [[], [], 0]},
+    # Сессия с колодой, сохраненная во время отработки ошибок
+    {'bank': 'deadbeef', 'score': 1, 'attempts': 1, 'practice': True, 'mask': 0, 'current': 7,
+     'mistakes': [[7, 1], [5, 2]], 'deck': [[7, 0, 0.0], [5, 1, 0.0]], 'practice_progress': [2, 1]},
+])
+def test_legacy_json(banks, state):
+    legacy = bot.UserProgress.from_bytes(json.dumps(state).encode('utf-8'), banks)
+    assert legacy.bank is banks.current
+    assert legacy.mistakes_practice_mode == state['practice']
+    assert set(legacy.review_deck.cards) == {5, 7}
+    assert legacy.mistakes == ({7: 1, 5: 2} if state['practice'] else {})
+    assert legacy.current_question_id is None
+
+    restored = round_trip(legacy, banks)
+    assert restored.to_bytes() == legacy.to_bytes()
+    assert_same_draws(legacy, restored)
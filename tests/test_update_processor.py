@@ -0,0 +1,53 @@
+"""Очередность и общий лимит в PerUserUpdateProcessor"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot
+
+DURATION = 0.1
+
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+async def process_all(processor, user_ids):
+    """Обрабатывает по обновлению от каждого пользователя; возвращает события и время окончания"""
+    events = []
+    finished = {}
+    started = time.perf_counter()
+
+    async def handle(index, user_id):
+        events.append(('start', index))
+        await asyncio.sleep(DURATION)
+        events.append(('end', index))
+        finished[index] = time.perf_counter() - started
+
+    await asyncio.gather(*(
+        processor.process_update(make_update(user_id), handle(index, user_id))
+        for index, user_id in enumerate(user_ids)
+    ))
+    return events, finished
+
+
+def test_updates_of_one_user_run_in_order():
+    processor = bot.PerUserUpdateProcessor(4)
+    events, _ = asyncio.run(process_all(processor, [1, 1, 1]))
+    assert events == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+    assert processor.active_users() == 0
+
+
+def test_queued_updates_do_not_hold_concurrency_slots():
+    # Четыре обновления одного пользователя ждут друг друга, но не занимают лимит:
+    # обновление второго пользователя обрабатывается сразу
+    processor = bot.PerUserUpdateProcessor(4)
+    _, finished = asyncio.run(process_all(processor, [1, 1, 1, 1, 2]))
+    assert finished[4] < 2 * DURATION
+    assert finished[3] >= 4 * DURATION
+
+
+def test_concurrency_limit_applies_across_users():
+    processor = bot.PerUserUpdateProcessor(2)
+    _, finished = asyncio.run(process_all(processor, [1, 2, 3, 4]))
+    assert sorted(finished.values())[2] >= 2 * DURATION
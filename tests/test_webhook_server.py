@@ -0,0 +1,49 @@
+"""Общий webhook-сервер нескольких ботов"""
+import asyncio
+import socket
+from types import SimpleNamespace
+
+import httpx
+
+import bot
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def make_update(update_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}, 'text': '/start',
+    }}
+
+
+def test_updates_are_routed_by_path(monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', 'secret')
+
+    async def run():
+        alpha = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        beta = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        server = bot.build_webhook_server([('telegram/alpha', alpha), ('telegram/beta', beta)])
+        port = free_port()
+        server.listen(port, '127.0.0.1')
+        url = f'http://127.0.0.1:{port}/telegram'
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'secret'}
+        try:
+            async with httpx.AsyncClient() as client:
+                statuses = [
+                    (await client.post(f'{url}/alpha', json=make_update(1), headers=headers)).status_code,
+                    (await client.post(f'{url}/beta', json=make_update(2), headers=headers)).status_code,
+                    (await client.post(f'{url}/beta', json=make_update(3))).status_code,
+                    (await client.post(f'{url}/gamma', json=make_update(4), headers=headers)).status_code,
+                ]
+        finally:
+            server.stop()
+        return statuses, alpha.update_queue, beta.update_queue
+
+    statuses, alpha_queue, beta_queue = asyncio.run(run())
+    assert statuses == [200, 200, 403, 404]
+    assert alpha_queue.qsize() == 1 and alpha_queue.get_nowait().update_id == 1
+    assert beta_queue.qsize() == 1 and beta_queue.get_nowait().update_id == 2
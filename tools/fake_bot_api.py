@@ -0,0 +1,192 @@
+"""Локальная заглушка Telegram Bot API для проверки бота без сети.
+
+Отвечает на методы, которые использует бот, правдоподобными объектами и
+выводит каждый вызов в лог. Бот направляется на заглушку через
+переменную окружения TELEGRAM_API_URL:
+
+    python tools/fake_bot_api.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake python bot.py
+
+Обновления для getUpdates добавляются через FakeBotApi.push_update (так их
+подает tools/load_test.py). Задержка ответов, ответы 429 и сбои 502
+включаются параметрами --latency, --rate-429 и --failure-rate.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import random
+import time
+from urllib.parse import parse_qsl
+
+import tornado.ioloop
+import tornado.web
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger('fake_bot_api')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Fake bot', 'username': 'fake_test_bot'}
+
+# Служебные методы всегда отвечают сразу и без ошибок, чтобы бот мог запуститься
+CONTROL_METHODS = frozenset({'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook'})
+
+
+class FakeBotApi:
+    """Состояние заглушки: очередь обновлений, счетчики вызовов и внедряемые сбои"""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.call_counts = collections.Counter()
+        self.error_counts = collections.Counter()
+        self.updates = collections.deque()
+        self.updates_available = asyncio.Event()
+        self.listeners = []  # функции listener(method, params, result), вызываются после каждого ответа
+
+    def make_message(self, params, message_id=None):
+        chat_id = int(params.get('chat_id', 0))
+        message = {
+            'message_id': message_id or next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'reply_markup' in params:
+            message['reply_markup'] = params['reply_markup']
+        return message
+
+    def call(self, method, params):
+        result = None
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery'):
+            result = True
+        elif method == 'sendMessage':
+            result = self.make_message(params)
+        elif method in ('editMessageText', 'editMessageReplyMarkup'):
+            result = self.make_message(params, int(params.get('message_id', 0)))
+        for listener in self.listeners:
+            listener(method, params, result)
+        return result
+
+    def push_update(self, update):
+        """Ставит обновление в очередь getUpdates, назначая ему update_id"""
+        update['update_id'] = next(self.update_ids)
+        self.updates.append(update)
+        self.updates_available.set()
+        return update
+
+    async def get_updates(self, params):
+        """Long polling: отдает обновления начиная с offset или ждет их до timeout секунд"""
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+    def injected_error(self, method):
+        """Возвращает (HTTP-код, тело ответа) для внедряемого сбоя или None"""
+        if method in CONTROL_METHODS:
+            return None
+        roll = random.random()
+        if roll < self.rate_429:
+            self.error_counts['429'] += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        if roll < self.rate_429 + self.failure_rate:
+            self.error_counts['502'] += 1
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+        return None
+
+
+def parse_params(request):
+    """Разбирает параметры запроса: PTB передает их формой со значениями в JSON"""
+    content_type = request.headers.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(request.body or b'{}')
+
+    params = {}
+    for name, value in parse_qsl(request.body.decode('utf-8')):
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+class MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, token, method):
+        params = parse_params(self.request)
+        self.api.call_counts[method] += 1
+        if method == 'getUpdates':
+            self.write({'ok': True, 'result': await self.api.get_updates(params)})
+            return
+
+        if self.api.latency or self.api.jitter:
+            await asyncio.sleep(self.api.latency + random.uniform(0, self.api.jitter))
+        error = self.api.injected_error(method)
+        if error is not None:
+            status, body = error
+            self.set_status(status)
+            self.write(body)
+            return
+
+        result = self.api.call(method, params)
+        logger.info("%s %.200s", method, json.dumps(params, ensure_ascii=False))
+        if result is None:
+            self.set_status(404)
+            self.write({'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'})
+        else:
+            self.write({'ok': True, 'result': result})
+
+    get = post
+
+
+def make_app(api):
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", MethodHandler, {'api': api})])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка каждого ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429 Too Many Requests')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, с')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='доля ответов 502 Bad Gateway')
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.latency, args.jitter, args.rate_429, args.retry_after, args.failure_rate)
+    make_app(api).listen(args.port, args.host)
+    logger.info("Заглушка Bot API слушает http://%s:%s/bot", args.host, args.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
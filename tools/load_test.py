@@ -0,0 +1,272 @@
+"""Нагрузочный прогон бота на локальной заглушке Bot API.
+
+Запускает заглушку из tools/fake_bot_api.py в этом процессе, а bot.py —
+отдельным процессом, который получает обновления через getUpdates.
+Виртуальные ученики проходят тест по кругу: /start_test, выбор варианта,
+отправка ответа, следующий вопрос. Каждый ждет ответа бота на свое
+обновление, прежде чем отправить следующее.
+
+    python tools/load_test.py --learners 200 --duration 60
+    python tools/load_test.py --learners 50 --latency 0.05 --rate-429 0.01 --failure-rate 0.01
+
+Лимиты исходящих запросов бота по умолчанию сняты, чтобы измерялась
+пропускная способность самого бота; настоящие лимиты включаются через
+--bot-env OUTBOUND_GLOBAL_RATE=30 и т.п.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fake_bot_api
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Методы, которыми бот показывает ученику результат обработки обновления
+RESPONSE_METHODS = frozenset({'sendMessage', 'editMessageText', 'editMessageReplyMarkup'})
+
+# Коды операций из callback_data бота (версия формата, затем код)
+OP_SELECT = 's'
+OP_SUBMIT = 'a'
+FORWARD_OPS = ('n', 'f')  # следующий вопрос, завершение теста
+
+BOT_ENV_DEFAULTS = {
+    'BOT_MODE': 'polling',
+    'ANSWER_DEBOUNCE_SECONDS': '0',
+    'OUTBOUND_GLOBAL_RATE': '1000000',
+    'OUTBOUND_CHAT_RATE': '1000000',
+    'OUTBOUND_CHAT_BURST': '1000000',
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def read_rss_kb(pid):
+    """Резидентная память процесса в КБ; None, если /proc недоступен"""
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class LoadDriver:
+    """Подает обновления от имени учеников и сопоставляет им ответы бота"""
+
+    def __init__(self, api, response_timeout):
+        self.api = api
+        self.response_timeout = response_timeout
+        self.waiters = {}  # chat_id -> Future с ответом бота
+        self.latencies = []
+        self.sent = 0
+        self.timeouts = 0
+        self.tests_finished = 0
+        api.listeners.append(self.on_call)
+
+    def on_call(self, method, params, result):
+        if method not in RESPONSE_METHODS:
+            return
+        waiter = self.waiters.pop(int(params.get('chat_id') or 0), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(result)
+
+    async def send(self, user_id, update):
+        """Отправляет обновление и ждет ответа бота; None по таймауту"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[user_id] = waiter
+        started = time.perf_counter()
+        self.api.push_update(update)
+        self.sent += 1
+        try:
+            result = await asyncio.wait_for(waiter, self.response_timeout)
+        except asyncio.TimeoutError:
+            self.waiters.pop(user_id, None)
+            self.timeouts += 1
+            return None
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def make_user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Learner {user_id}'}
+
+    async def command(self, user_id, text):
+        return await self.send(user_id, {'message': {
+            'message_id': 0,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.make_user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        }})
+
+    async def callback(self, user_id, message, data):
+        return await self.send(user_id, {'callback_query': {
+            'id': f'{user_id}:{self.sent}',
+            'from': self.make_user(user_id),
+            'chat_instance': str(user_id),
+            'message': {
+                'message_id': message['message_id'],
+                'date': message['date'],
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': fake_bot_api.BOT_USER,
+                'text': message.get('text', ''),
+            },
+            'data': data,
+        }})
+
+
+def choose_action(message):
+    """Выбирает следующее нажатие ученика; None, если тест закончен"""
+    markup = message.get('reply_markup') or {}
+    callbacks = [button.get('callback_data', '') for row in markup.get('inline_keyboard', ()) for button in row]
+    operations = {data[1:2]: data for data in callbacks}
+    if OP_SUBMIT in operations:
+        return operations[OP_SUBMIT]
+    selects = [data for data in callbacks if data[1:2] == OP_SELECT]
+    if selects:
+        return random.choice(selects)
+    for operation in FORWARD_OPS:
+        if operation in operations:
+            return operations[operation]
+    return None
+
+
+async def run_learner(driver, user_id, deadline):
+    """Проходит тест по кругу до окончания времени прогона"""
+    message = await driver.command(user_id, '/start_test')
+    while time.monotonic() < deadline:
+        action = choose_action(message) if message is not None else None
+        if action is None:
+            if message is not None:
+                driver.tests_finished += 1
+            message = await driver.command(user_id, '/start_test')
+        else:
+            message = await driver.callback(user_id, message, action)
+
+
+async def run_load(args):
+    api = fake_bot_api.FakeBotApi(args.latency, args.jitter, args.rate_429, args.retry_after, args.failure_rate)
+    server = fake_bot_api.make_app(api).listen(args.port, '127.0.0.1')
+    driver = LoadDriver(api, args.response_timeout)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ, **BOT_ENV_DEFAULTS)
+        env.update({
+            'BOT_TOKEN': '123456:LOADTEST',
+            'TELEGRAM_API_URL': f'http://127.0.0.1:{args.port}/bot',
+            'SESSION_DB_PATH': os.path.join(temp_dir, 'sessions.db'),
+        })
+        env.update(item.split('=', 1) for item in args.bot_env)
+        log_file = open(args.bot_log, 'w') if args.bot_log else None
+        bot = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT_DIR, 'bot.py'),
+            cwd=ROOT_DIR, env=env, stdout=asyncio.subprocess.DEVNULL,
+            stderr=log_file or asyncio.subprocess.DEVNULL,
+        )
+        try:
+            # Бот готов, когда начал опрашивать getUpdates
+            while not api.call_counts['getUpdates']:
+                if bot.returncode is not None:
+                    raise RuntimeError(f"bot.py завершился с кодом {bot.returncode}")
+                await asyncio.sleep(0.1)
+            rss_before = read_rss_kb(bot.pid)
+
+            started = time.monotonic()
+            deadline = started + args.duration
+            learners = []
+            for index in range(args.learners):
+                learners.append(asyncio.create_task(run_learner(driver, 1000 + index, deadline)))
+                if args.ramp:
+                    await asyncio.sleep(args.ramp / args.learners)
+            await asyncio.gather(*learners)
+            elapsed = time.monotonic() - started
+            rss_after = read_rss_kb(bot.pid)
+        finally:
+            if bot.returncode is None:
+                bot.terminate()
+                try:
+                    await asyncio.wait_for(bot.wait(), 10)
+                except asyncio.TimeoutError:
+                    bot.kill()
+            # Отпускаем незавершенные long polling запросы перед остановкой сервера
+            api.updates_available.set()
+            await asyncio.sleep(0)
+            server.stop()
+            if log_file:
+                log_file.close()
+
+    latencies = sorted(driver.latencies)
+    memory_per_session = None
+    if rss_before is not None and rss_after is not None:
+        memory_per_session = round((rss_after - rss_before) / args.learners, 2)
+    return {
+        'learners': args.learners,
+        'duration_s': round(elapsed, 2),
+        'updates_sent': driver.sent,
+        'responses': len(latencies),
+        'timeouts': driver.timeouts,
+        'tests_finished': driver.tests_finished,
+        'throughput_per_s': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2)
+            for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+        },
+        'rss_kb': {'before': rss_before, 'after': rss_after},
+        'memory_per_session_kb': memory_per_session,
+        'api_calls': dict(api.call_counts),
+        'injected_errors': dict(api.error_counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--learners', type=int, default=100, help='число виртуальных учеников')
+    parser.add_argument('--duration', type=float, default=30.0, help='длительность прогона, с')
+    parser.add_argument('--ramp', type=float, default=1.0, help='время, за которое подключаются все ученики, с')
+    parser.add_argument('--port', type=int, default=8081, help='порт заглушки Bot API')
+    parser.add_argument('--response-timeout', type=float, default=15.0, help='ожидание ответа бота, с')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответов заглушки, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429 Too Many Requests')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, с')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='доля ответов 502 Bad Gateway')
+    parser.add_argument('--bot-env', action='append', default=[], metavar='NAME=VALUE',
+                        help='переменная окружения для bot.py, можно указать несколько раз')
+    parser.add_argument('--bot-log', help='файл для лога bot.py')
+    parser.add_argument('--json', action='store_true', help='вывести итог одним JSON-объектом')
+    args = parser.parse_args()
+
+    fake_bot_api.logger.setLevel('WARNING')
+    logging.getLogger('tornado.access').setLevel('WARNING')
+    report = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+
+    latency = report['latency_ms']
+    print(f"Ученики: {report['learners']}, длительность: {report['duration_s']} с")
+    print(f"Обновлений: {report['updates_sent']}, ответов: {report['responses']}, таймаутов: {report['timeouts']}")
+    print(f"Пройдено тестов: {report['tests_finished']}")
+    print(f"Пропускная способность: {report['throughput_per_s']} обновлений/с")
+    print(f"Задержка, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}")
+    print(f"Память бота, КБ: {report['rss_kb']['before']} -> {report['rss_kb']['after']}, "
+          f"на сессию: {report['memory_per_session_kb']}")
+    print(f"Вызовы API: {report['api_calls']}")
+    if report['injected_errors']:
+        print(f"Внедренные ошибки: {report['injected_errors']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Отправка записанных обновлений Telegram в webhook бота.
+
+Файл содержит по одному объекту Update в формате JSON на строку.
+Вместе с tools/fake_bot_api.py позволяет проверить режим webhook без сети:
+
+    python tools/fake_bot_api.py --port 8081 &
+    BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_PORT=8443 WEBHOOK_SECRET=secret \\
+        TELEGRAM_API_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake python bot.py &
+    python tools/replay_updates.py tools/sample_updates.jsonl \\
+        --url http://127.0.0.1:8443/telegram --secret secret
+"""
+import argparse
+import json
+import time
+
+import httpx
+
+
+def read_updates(path):
+    with open(path, encoding='utf-8') as updates_file:
+        for line in updates_file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='файл с обновлениями, по одному JSON на строку')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', help='значение WEBHOOK_SECRET бота')
+    parser.add_argument('--delay', type=float, default=0.2, help='пауза между обновлениями, с')
+    args = parser.parse_args()
+
+    headers = {}
+    if args.secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = args.secret
+
+    with httpx.Client(headers=headers) as client:
+        for update in read_updates(args.path):
+            started = time.perf_counter()
+            response = client.post(args.url, json=update)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"update {update.get('update_id')}: HTTP {response.status_code}, {elapsed:.1f} мс")
+            time.sleep(args.delay)
+
+
+if __name__ == '__main__':
+    main()